@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import tomllib
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+from utils.loop_monitor import monitor
+
+if TYPE_CHECKING:
+  from aiohttp.web import Response
+
+  from utils.extra_request import Request
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  debug_config = config["debug"]
+
+routes = web.RouteTableDef()
+
+
+@routes.get("/debug/loop/")
+async def get_debug_loop(request: Request) -> Response:
+  return web.json_response(monitor.get_stats())
+
+
+async def setup(app: web.Application) -> None:
+  for route in routes:
+    app.LOG.info(f"  ↳ {route}")
+  app.add_routes(routes)
+  if debug_config["loop_monitor"]:
+    app.LOG.info("starting event loop monitor")
+    monitor.interval = debug_config["loop_interval_ms"] / 1000
+    monitor.threshold = debug_config["loop_lag_threshold_ms"] / 1000
+    monitor.start()
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+from utils.metrics import registry
+
+if TYPE_CHECKING:
+  from aiohttp.web import Response
+
+  from utils.extra_request import Request
+
+routes = web.RouteTableDef()
+
+
+@routes.get("/metrics/")
+async def get_metrics(request: Request) -> Response:
+  return web.Response(
+    text=registry.render(),
+    content_type="text/plain",
+    charset="utf-8",
+    headers={"X-Prometheus-Version": "0.0.4"},
+  )
+
+
+async def setup(app: web.Application) -> None:
+  for route in routes:
+    app.LOG.info(f"  ↳ {route}")
+  app.add_routes(routes)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import tomllib
 from typing import TYPE_CHECKING
 
@@ -8,12 +9,17 @@ from aiohttp import web
 from aiohttp.web import Response
 
 from utils import jobs
+from utils.cleanup import CLEANUP
 from utils.cors import add_cors_routes
 from utils.extruder import png_to_stl
+from utils.greyscale_extruder import png_to_greyscale
 from utils.limiter import Limiter
 from utils.multicolor_extruder import (identify_colours, png_to_3mf,
                                        png_to_backed3mf)
-from utils.svg3 import png_to_svg
+from utils.palette import check_options
+from utils.simplify import DEFAULT_QUALITY, get_quality, qualities
+from utils.speculate import speculate
+from utils.tracers import DEFAULT_TRACER, get_tracer, tracers
 
 if TYPE_CHECKING:
   from utils.extra_request import Request
@@ -38,6 +44,24 @@ async def get_srv_get(request: Request) -> Response:
   return web.json_response(packet)
 
 
+@routes.get("/tracers/")
+@limiter.limit("60/m")
+async def get_tracers(request: Request) -> Response:
+  return web.json_response({
+    "default": DEFAULT_TRACER,
+    "tracers": [tracer.to_dict() for tracer in tracers.values()],
+  })
+
+
+@routes.get("/qualities/")
+@limiter.limit("60/m")
+async def get_qualities(request: Request) -> Response:
+  return web.json_response({
+    "default": DEFAULT_QUALITY,
+    "qualities": [quality.to_dict() for quality in qualities.values()],
+  })
+
+
 @routes.post("/extrude/")
 @limiter.limit("10/m")
 async def post_extrude(request: Request) -> Response:
@@ -46,9 +70,16 @@ async def post_extrude(request: Request) -> Response:
   z = float(request.query.get("z", 6.35))
   filename = request.query.get("filename", "extruded.png")
   filename = ".".join(filename.split(".")[:-1])
+  tracer = request.query.get("tracer")
+  quality = request.query.get("quality")
+  try:
+    get_tracer(tracer, filled=True)
+    get_quality(quality)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
   png_data = await request.read()
 
-  stl_data = await png_to_stl(png_data, z, x, y)
+  stl_data = await png_to_stl(png_data, z, x, y, tracer=tracer, quality=quality)
   resp: web.StreamResponse = web.StreamResponse()
   resp.headers["Content-Type"] = "model/stl"
   resp.headers["Content-Disposition"] = f"attachment; filename*={filename}.stl"
@@ -62,14 +93,30 @@ async def post_extrude(request: Request) -> Response:
 async def post_svg(request: Request) -> Response:
   filename = request.query.get("filename", "converted.svg")
   filename = ".".join(filename.split(".")[:-1])
+  try:
+    tracer = get_tracer(request.query.get("tracer"))
+    quality = get_quality(request.query.get("quality"))
+  except ValueError as e:
+    return Response(status=400, text=str(e))
   png_data = await request.read()
 
-  svg_data = await png_to_svg(png_data)
-  resp: web.StreamResponse = web.StreamResponse()
-  resp.headers["Content-Type"] = "image/svg+xml"
-  resp.headers["Content-Disposition"] = f"attachment; filename*={filename}.svg"
-  await resp.prepare(request)
-  await resp.write(svg_data.encode())
+  # Wait for the first chunk before sending the headers, so a failed trace
+  # is still a 500, then send the SVG in chunks rather than holding all of
+  # it in memory.
+  chunks = tracer.iter_svg(png_data, quality=quality)
+  try:
+    first = await anext(chunks)
+    resp: web.StreamResponse = web.StreamResponse()
+    resp.headers["Content-Type"] = "image/svg+xml"
+    resp.headers["Content-Disposition"] = f"attachment; filename*={filename}.svg"
+    resp.enable_chunked_encoding()
+    await resp.prepare(request)
+    await resp.write(first)
+    async for chunk in chunks:
+      await resp.write(chunk)
+  finally:
+    await chunks.aclose()
+  await resp.write_eof()
   return resp
 
 
@@ -81,9 +128,23 @@ async def post_3mf(request: Request) -> Response:
   z = float(request.query.get("z", 6.35))
   filename = request.query.get("filename", "extruded.png")
   filename = ".".join(filename.split(".")[:-1])
+  tracer = request.query.get("tracer")
+  quality = request.query.get("quality")
+  palette = request.query.get("palette")
+  cleanup = request.query.get("cleanup", str(CLEANUP)).lower() in ("1", "true")
+  try:
+    colours = int(request.query.get("colours", 0))
+    get_tracer(tracer, filled=True)
+    get_quality(quality)
+    check_options(colours, palette)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
   png_data = await request.read()
 
-  threemf_data = await png_to_3mf(png_data, z, x, y)
+  threemf_data = await png_to_3mf(
+    png_data, z, x, y, tracer=tracer, quality=quality, colours=colours, palette=palette,
+    cleanup=cleanup,
+  )
   resp: web.StreamResponse = web.StreamResponse()
   resp.headers["Content-Type"] = "model/3mf"
   resp.headers["Content-Disposition"] = f"attachment; filename*={filename}.3mf"
@@ -101,9 +162,23 @@ async def post_backed3mf(request: Request) -> Response:
   black_thickness = float(request.query.get("blackthickness", 0))
   filename = request.query.get("filename", "extruded.png")
   filename = ".".join(filename.split(".")[:-1])
+  tracer = request.query.get("tracer")
+  quality = request.query.get("quality")
+  palette = request.query.get("palette")
+  cleanup = request.query.get("cleanup", str(CLEANUP)).lower() in ("1", "true")
+  try:
+    colours = int(request.query.get("colours", 0))
+    get_tracer(tracer, filled=True)
+    get_quality(quality)
+    check_options(colours, palette)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
   png_data = await request.read()
 
-  threemf_data = await png_to_backed3mf(png_data, z, x, y, black_thickness)
+  threemf_data = await png_to_backed3mf(
+    png_data, z, x, y, black_thickness, tracer=tracer, quality=quality,
+    colours=colours, palette=palette, cleanup=cleanup,
+  )
   resp: web.StreamResponse = web.StreamResponse()
   resp.headers["Content-Type"] = "model/3mf"
   resp.headers["Content-Disposition"] = f"attachment; filename*={filename}.3mf"
@@ -112,12 +187,74 @@ async def post_backed3mf(request: Request) -> Response:
   return resp
 
 
+@routes.post("/greyscale/")
+@limiter.limit("10/m")
+async def post_greyscale(request: Request) -> Response:
+  invert = request.query.get("invert", "false").lower() in ("1", "true")
+  dither = request.query.get("dither", "false").lower() in ("1", "true")
+  file_format = request.query.get("format", "stl").lower()
+  filename = request.query.get("filename", "extruded.png")
+  filename = ".".join(filename.split(".")[:-1])
+  png_data = await request.read()
+
+  try:
+    x = float(request.query.get("x", 0))
+    y = float(request.query.get("y", 0))
+    z = float(request.query.get("z", 3.2))
+    base = float(request.query.get("base", 0.6))
+    layers = int(request.query.get("layers", 5))
+    islands = int(request.query.get("islands", 0))
+    model_data = await png_to_greyscale(
+      png_data, z, x, y, layers=layers, base=base, invert=invert,
+      island_threshold=islands, dither=dither, file_format=file_format,
+    )
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+  resp: web.StreamResponse = web.StreamResponse()
+  resp.headers["Content-Type"] = f"model/{file_format}"
+  resp.headers["Content-Disposition"] = f"attachment; filename*={filename}.{file_format}"
+  await resp.prepare(request)
+  await resp.write(model_data)
+  return resp
+
+
 @routes.post("/colouridentify/")
 @limiter.limit("10/m")
 async def post_colouridentify(request: Request) -> Response:
+  palette = request.query.get("palette")
+  coverage = request.query.get("coverage", "false").lower() in ("1", "true")
+  # Start on the 3MF these settings would make while the user picks the
+  # rest, see utils.speculate. The job then has to be sent the same ones.
+  speculating = request.query.get("speculate", "false").lower() in ("1", "true")
+  backed = request.query.get("backed", "false").lower() in ("1", "true")
+  tracer = request.query.get("tracer")
+  quality = request.query.get("quality")
+  cleanup = request.query.get("cleanup", str(CLEANUP)).lower() in ("1", "true")
+  try:
+    x = float(request.query.get("x", 0))
+    y = float(request.query.get("y", 0))
+    colours = int(request.query.get("colours", 0))
+    # Only count a sample of this many pixels, which may miss rare colours
+    max_samples = int(request.query.get("samples", 0))
+    check_options(colours, palette)
+    if speculating:
+      get_tracer(tracer, filled=True)
+      get_quality(quality)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
   png_data = await request.read()
 
-  hex_colours = identify_colours(png_data)
+  # Decoding and counting a big upload takes long enough to stall other requests
+  loop = asyncio.get_event_loop()
+  hex_colours = await loop.run_in_executor(None, functools.partial(
+    identify_colours, png_data, colours=colours, palette=palette, coverage=coverage,
+    max_samples=max_samples,
+  ))
+  if speculating:
+    speculate(
+      png_data, x, y, backed=backed, tracer=tracer, quality=quality,
+      colours=colours, palette=palette, cleanup=cleanup,
+    )
   return web.json_response(hex_colours)
 
 
@@ -164,6 +301,16 @@ async def get_job_download(request: Request) -> Response:
       await resp.write(file)
     return resp
 
+@routes.get("/job/trace/")
+async def get_job_trace(request: Request) -> Response:
+  job_id = request.query.get("id", None)
+  if job_id is None:
+    return Response(status=400,body="must pass id")
+  details = jobs.get_job_trace(job_id)
+  if not details["ok"]:
+    return web.json_response(details, status=404)
+  return web.json_response(details["trace"])
+
 @routes.post("/job/config/")
 async def post_job_config(request: Request) -> Response:
   data = await request.json()
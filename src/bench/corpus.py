@@ -0,0 +1,136 @@
+# Reproducible synthetic input images for the benchmarks
+from __future__ import annotations
+
+import io
+import os
+
+import numpy
+from PIL import Image, ImageDraw
+
+KINDS = ["logo", "antialiased", "photo", "pixelart"]
+DEFAULT_SIZES = [256, 1024]
+DEFAULT_COLOURS = [2, 8]
+
+# Generated PNGs are kept here so repeated runs skip generation.
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".corpus")
+
+
+class Case:
+  "One benchmark input: an image kind, its size and its number of colours."
+
+  kind: str
+  size: int
+  colours: int
+  seed: int
+
+  def __init__(self, kind: str, size: int, colours: int, seed: int = 0) -> None:
+    self.kind = kind
+    self.size = size
+    self.colours = colours
+    self.seed = seed
+
+  @property
+  def name(self) -> str:
+    return f"{self.kind}-{self.size}px-{self.colours}c"
+
+  @property
+  def pixels(self) -> int:
+    return self.size * self.size
+
+
+def make_palette(rng: numpy.random.Generator, colours: int) -> numpy.ndarray:
+  "White background first, then random distinct colours."
+  palette = {(255, 255, 255)}
+  while len(palette) < colours:
+    palette.add(tuple(int(c) for c in rng.integers(0, 255, 3)))
+  ordered = [(255, 255, 255)] + sorted(palette - {(255, 255, 255)})
+  return numpy.array(ordered, dtype=numpy.uint8)
+
+
+def draw_shapes(
+  rng: numpy.random.Generator, size: int, palette: numpy.ndarray, scale: int = 1
+) -> Image.Image:
+  "Draw flat coloured rectangles, ellipses and polygons on white."
+  canvas = size * scale
+  img = Image.new("RGB", (canvas, canvas), (255, 255, 255))
+  draw = ImageDraw.Draw(img)
+  shapes = max(len(palette) * 3, 8)
+  for i in range(shapes):
+    colour = tuple(int(c) for c in palette[1 + i % (len(palette) - 1)])
+    x0, y0 = rng.integers(0, canvas * 0.8, 2)
+    w, h = rng.integers(canvas // 20 + 1, canvas // 4 + 2, 2)
+    box = [int(x0), int(y0), int(x0 + w), int(y0 + h)]
+    kind = i % 3
+    if kind == 0:
+      draw.rectangle(box, fill=colour)
+    elif kind == 1:
+      draw.ellipse(box, fill=colour)
+    else:
+      points = rng.integers(0, canvas, (5, 2))
+      draw.polygon([tuple(int(v) for v in p) for p in points], fill=colour)
+  return img
+
+
+def generate(case: Case) -> Image.Image:
+  rng = numpy.random.default_rng(case.seed * 1000003 + case.size + case.colours)
+  palette = make_palette(rng, max(case.colours, 2))
+
+  if case.kind == "logo":
+    return draw_shapes(rng, case.size, palette)
+
+  if case.kind == "antialiased":
+    # Supersample and shrink, leaving blended shades along every edge.
+    big = draw_shapes(rng, case.size, palette, scale=4)
+    return big.resize((case.size, case.size), Image.Resampling.LANCZOS)
+
+  if case.kind == "photo":
+    # Smooth gradients from a few random blobs plus sensor noise.
+    coords = numpy.linspace(0, 1, case.size, dtype=numpy.float32)
+    xs, ys = numpy.meshgrid(coords, coords)
+    image = numpy.zeros((case.size, case.size, 3), dtype=numpy.float32)
+    for colour in palette:
+      cx, cy, spread = rng.random(3)
+      weight = numpy.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / (0.05 + spread * 0.2))
+      image += weight[..., None] * colour.astype(numpy.float32)
+    image /= image.max() / 255
+    image += rng.normal(0, 6, image.shape).astype(numpy.float32)
+    return Image.fromarray(numpy.clip(image, 0, 255).astype(numpy.uint8))
+
+  if case.kind == "pixelart":
+    cells = max(case.size // 16, 4)
+    grid = rng.integers(0, len(palette), (cells, cells))
+    small = Image.fromarray(palette[grid])
+    return small.resize((case.size, case.size), Image.Resampling.NEAREST)
+
+  raise ValueError(f"unknown image kind {case.kind}")
+
+
+def get_png(case: Case, *, use_cache: bool = True) -> bytes:
+  "Get the PNG bytes for a case, generating it if it is not cached."
+  path = os.path.join(CORPUS_DIR, f"{case.name}-s{case.seed}.png")
+  if use_cache and os.path.exists(path):
+    with open(path, "rb") as f:
+      return f.read()
+
+  stream = io.BytesIO()
+  generate(case).convert("RGBA").save(stream, "png")
+  png = stream.getvalue()
+  if use_cache:
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    with open(path, "wb") as f:
+      f.write(png)
+  return png
+
+
+def make_cases(
+  kinds: list[str] = None,
+  sizes: list[int] = None,
+  colours: list[int] = None,
+  seed: int = 0,
+) -> list[Case]:
+  cases = []
+  for kind in kinds or KINDS:
+    for size in sizes or DEFAULT_SIZES:
+      for colour_count in colours or DEFAULT_COLOURS:
+        cases.append(Case(kind, size, colour_count, seed))
+  return cases
@@ -0,0 +1,94 @@
+# A local stand-in for the auth service used by utils.authenticate.
+#
+# Tokens starting with "user-" are valid users, tokens starting with "key-"
+# are valid API keys, everything else is rejected. Run it on its own with
+#   python -m bench.fake_auth --port 8433 --latency 0.05
+# and point [auth] url in config.toml at it.
+from __future__ import annotations
+
+import argparse
+import asyncio
+
+from aiohttp import web
+
+
+class FakeAuth:
+  latency: float
+  requests: int
+
+  def __init__(self, *, latency: float = 0.0) -> None:
+    self.latency = latency
+    self.requests = 0
+
+  def make_app(self) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/api/user/get/", self.get_user)
+    app.router.add_get("/api/key/{token}", self.get_key)
+    app.router.add_get("/api/project/status/{project}", self.get_project)
+    return app
+
+  async def _respond(self) -> None:
+    self.requests += 1
+    if self.latency:
+      await asyncio.sleep(self.latency)
+
+  async def get_user(self, request: web.Request) -> web.Response:
+    await self._respond()
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if token.startswith("user-"):
+      return web.json_response({
+        "name": token,
+        "super_admin": False,
+        "email": f"{token}@example.com",
+        "token": token,
+      })
+    if token.startswith("key-"):
+      return web.Response(status=400, text="please use /key/ for api keys")
+    return web.Response(status=401, text="invalid token")
+
+  async def get_key(self, request: web.Request) -> web.Response:
+    await self._respond()
+    token = request.match_info["token"]
+    if not token.startswith("key-"):
+      return web.Response(status=404)
+    user = {
+      "username": f"owner-of-{token}",
+      "super_admin": False,
+      "email": "owner@example.com",
+      "token": "",
+    }
+    return web.json_response({
+      "name": token,
+      "id": token,
+      "data": "",
+      "user": user,
+      "project": {"id": 1, "name": "loadtest", "public": True, "open": True},
+    })
+
+  async def get_project(self, request: web.Request) -> web.Response:
+    await self._respond()
+    return web.json_response({"approval": "approved"})
+
+  async def start(self, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(self.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def _serve(host: str, port: int, latency: float) -> None:
+  await FakeAuth(latency=latency).start(host, port)
+  print(f"fake auth service on http://{host}:{port}")
+  await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run the fake auth service.")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8433)
+  parser.add_argument("--latency", type=float, default=0.0)
+  args = parser.parse_args()
+  try:
+    asyncio.run(_serve(args.host, args.port, args.latency))
+  except KeyboardInterrupt:
+    pass
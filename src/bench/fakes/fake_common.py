@@ -0,0 +1,32 @@
+# Shared behaviour of the stand-in tools in this directory.
+#
+# Put this directory first on PATH to run the pipeline without ImageMagick,
+# potrace, OpenSCAD or colorscad. Each tool sleeps to simulate work:
+#   FAKE_TOOL_LATENCY=0.05            base seconds for every tool
+#   FAKE_<TOOL>_LATENCY=0.5           override for one tool, e.g. FAKE_OPENSCAD_LATENCY
+#   FAKE_TOOL_LATENCY_PER_MB=0.1      extra seconds per MB of input
+#   FAKE_TOOL_FAIL=potrace            comma separated tools that exit 1
+import os
+import sys
+import time
+
+
+def simulate(tool: str, input_path: str = None) -> None:
+  if tool in os.environ.get("FAKE_TOOL_FAIL", "").split(","):
+    print(f"fake {tool}: failing on purpose", file=sys.stderr)
+    sys.exit(1)
+  latency = float(
+    os.environ.get(
+      f"FAKE_{tool.upper()}_LATENCY", os.environ.get("FAKE_TOOL_LATENCY", 0)
+    )
+  )
+  if input_path and os.path.exists(input_path):
+    per_mb = float(os.environ.get("FAKE_TOOL_LATENCY_PER_MB", 0))
+    latency += per_mb * os.path.getsize(input_path) / 1e6
+  time.sleep(latency)
+
+
+def get_flag(args: list[str], flag: str) -> str | None:
+  if flag in args:
+    return args[args.index(flag) + 1]
+  return None
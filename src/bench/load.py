@@ -0,0 +1,378 @@
+# HTTP load test against the whole app, run from src/:
+#   python -m bench.load                        start a server with fakes, load it, report
+#   python -m bench.load --url http://host:8432 load an already running server
+#   python -m bench.load serve --port 8500      only start the server with fakes
+#
+# The server started here uses the fake auth service in bench/fake_auth.py
+# and, unless --real-tools is passed, the stand-in tools in bench/fakes/.
+# Simulated clients are told apart by X-Forwarded-For, so rate limits apply
+# per client like they would in production.
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from typing import TYPE_CHECKING
+
+import aiohttp
+
+from bench.corpus import Case, get_png
+from bench.fake_auth import FakeAuth
+
+if TYPE_CHECKING:
+  from typing import Awaitable, Callable
+
+FAKES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakes")
+
+# flow name -> weight, used when --mix is not passed
+DEFAULT_MIX = {
+  "svg": 3,
+  "extrude": 1,
+  "3mf": 1,
+  "colouridentify": 4,
+  "job": 2,
+}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class Recorder:
+  "Latencies and outcomes of every request, by flow."
+
+  def __init__(self) -> None:
+    self.latencies: dict[str, list[float]] = {}
+    self.statuses: dict[str, dict[str, int]] = {}
+    self.queue_depths: list[int] = []
+    self.busy_workers: list[int] = []
+
+  def record(self, flow: str, status: int | str, latency: float) -> None:
+    statuses = self.statuses.setdefault(flow, {})
+    statuses[str(status)] = statuses.get(str(status), 0) + 1
+    if isinstance(status, int) and status < 400:
+      self.latencies.setdefault(flow, []).append(latency)
+
+  def report(self, elapsed: float) -> dict:
+    flows = {}
+    for flow, statuses in self.statuses.items():
+      total = sum(statuses.values())
+      latencies = self.latencies.get(flow, [])
+      flows[flow] = {
+        "requests": total,
+        "per_second": round(total / elapsed, 2),
+        "error_rate": round(1 - len(latencies) / total, 4) if total else 0,
+        "statuses": statuses,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p90_ms": round(percentile(latencies, 0.9) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+      }
+    depths = self.queue_depths or [0]
+    busy = self.busy_workers or [0]
+    return {
+      "elapsed_s": round(elapsed, 2),
+      "flows": flows,
+      "queue": {
+        "max_depth": max(depths),
+        "mean_depth": round(sum(depths) / len(depths), 2),
+        "max_busy_workers": max(busy),
+        "mean_busy_workers": round(sum(busy) / len(busy), 2),
+      },
+    }
+
+
+class LoadTest:
+  def __init__(
+    self,
+    url: str,
+    *,
+    mix: dict[str, float],
+    png: bytes,
+    clients: int,
+    auth_fraction: float,
+    job_timeout: float,
+  ) -> None:
+    self.url = url.rstrip("/")
+    self.mix = mix
+    self.png = png
+    self.png_b64 = base64.b64encode(png).decode()
+    self.clients = clients
+    self.auth_fraction = auth_fraction
+    self.job_timeout = job_timeout
+    self.recorder = Recorder()
+    self.flows: dict[str, Callable[..., Awaitable[None]]] = {
+      "svg": self.flow_svg,
+      "extrude": self.flow_extrude,
+      "3mf": self.flow_3mf,
+      "colouridentify": self.flow_colouridentify,
+      "job": self.flow_job,
+    }
+
+  def client_headers(self) -> dict[str, str]:
+    client = random.randrange(self.clients)
+    ip = f"10.{client // 65536 % 256}.{client // 256 % 256}.{client % 256}"
+    headers = {"X-Forwarded-For": ip}
+    if random.random() < self.auth_fraction:
+      headers["Authorization"] = f"Bearer user-{client}"
+    return headers
+
+  async def timed(
+    self, flow: str, session: aiohttp.ClientSession, method: str, path: str, **kwargs
+  ) -> tuple[int, bytes]:
+    start = time.perf_counter()
+    try:
+      async with session.request(method, self.url + path, **kwargs) as resp:
+        body = await resp.read()
+        status = resp.status
+    except Exception as e:
+      self.recorder.record(flow, type(e).__name__, time.perf_counter() - start)
+      raise
+    self.recorder.record(flow, status, time.perf_counter() - start)
+    return status, body
+
+  async def flow_svg(self, session: aiohttp.ClientSession, headers: dict) -> None:
+    await self.timed(
+      "svg", session, "POST", "/api/svg/?filename=load.png",
+      data=self.png, headers=headers,
+    )
+
+  async def flow_extrude(self, session: aiohttp.ClientSession, headers: dict) -> None:
+    await self.timed(
+      "extrude", session, "POST", "/api/extrude/?x=50&y=50&z=3&filename=load.png",
+      data=self.png, headers=headers,
+    )
+
+  async def flow_3mf(self, session: aiohttp.ClientSession, headers: dict) -> None:
+    await self.timed(
+      "3mf", session, "POST", "/api/3mf/?x=50&y=50&z=3&filename=load.png",
+      data=self.png, headers=headers,
+    )
+
+  async def flow_colouridentify(self, session: aiohttp.ClientSession, headers: dict) -> None:
+    await self.timed(
+      "colouridentify", session, "POST", "/api/colouridentify/",
+      data=self.png, headers=headers,
+    )
+
+  async def flow_job(self, session: aiohttp.ClientSession, headers: dict) -> None:
+    "Submit a job, poll until it is complete, then download it."
+    job_type = random.choice(["svg", "stl", "3mf"])
+    filename = f"load-{uuid.uuid4().hex}.{job_type}"
+    start = time.perf_counter()
+    status, _ = await self.timed(
+      "job_submit", session, "POST", "/api/job/submit/", headers=headers,
+      json={
+        "type": job_type,
+        "files": [self.png_b64],
+        "meta": {"filename": filename, "x": 50, "y": 50, "z": 3},
+      },
+    )
+    if status != 200:
+      self.recorder.record("job", status, time.perf_counter() - start)
+      return
+
+    job_id = None
+    while job_id is None:
+      if time.perf_counter() - start > self.job_timeout:
+        self.recorder.record("job", "timeout", time.perf_counter() - start)
+        return
+      await asyncio.sleep(0.25)
+      async with session.get(self.url + "/api/job/complete/") as resp:
+        complete = await resp.json()
+      for candidate, details in complete.items():
+        if details.get("filename") == filename:
+          job_id = candidate
+
+    status, _ = await self.timed(
+      "job_download", session, "GET", f"/api/job/download/?id={job_id}"
+    )
+    self.recorder.record("job", status, time.perf_counter() - start)
+
+  async def sample_queue(self, session: aiohttp.ClientSession) -> None:
+    while True:
+      try:
+        async with session.get(self.url + "/api/job/current/") as resp:
+          self.recorder.queue_depths.append(len(await resp.json()))
+        async with session.get(self.url + "/api/job/workers/") as resp:
+          workers = await resp.json()
+          busy = sum(1 for status in workers.values() if status != "idle")
+          self.recorder.busy_workers.append(busy)
+      except Exception:
+        pass
+      await asyncio.sleep(1)
+
+  async def run(self, rate: float, duration: float, max_inflight: int) -> dict:
+    "Start flows as a Poisson process at `rate` per second for `duration`."
+    names = list(self.mix)
+    weights = [self.mix[name] for name in names]
+    inflight: set[asyncio.Task] = set()
+    limit = asyncio.Semaphore(max_inflight)
+    connector = aiohttp.TCPConnector(limit=max_inflight)
+    timeout = aiohttp.ClientTimeout(total=self.job_timeout)
+
+    async def start_flow(name: str) -> None:
+      try:
+        await self.flows[name](session, self.client_headers())
+      except Exception:
+        pass
+      finally:
+        limit.release()
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+      sampler = asyncio.create_task(self.sample_queue(session))
+      start = time.perf_counter()
+      next_at = start
+      while next_at - start < duration:
+        await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+        if limit.locked():
+          # The server is not keeping up, count it instead of queueing more.
+          self.recorder.record("dropped", "client_limit", 0)
+        else:
+          await limit.acquire()
+          task = asyncio.create_task(
+            start_flow(random.choices(names, weights)[0])
+          )
+          inflight.add(task)
+          task.add_done_callback(inflight.discard)
+        next_at += random.expovariate(rate)
+      if inflight:
+        await asyncio.wait(inflight)
+      elapsed = time.perf_counter() - start
+      sampler.cancel()
+    return self.recorder.report(elapsed)
+
+
+async def serve(
+  port: int, auth_port: int, auth_latency: float, real_tools: bool
+) -> None:
+  "Run the real app, with the fake auth service and (optionally) fake tools."
+  if not real_tools:
+    os.environ["PATH"] = FAKES_DIR + os.pathsep + os.environ["PATH"]
+  await FakeAuth(latency=auth_latency).start("127.0.0.1", auth_port)
+
+  import main
+  from utils import authenticate
+
+  authenticate.AUTH_URL = f"http://127.0.0.1:{auth_port}"
+  main.config["srv"]["host"] = "127.0.0.1"
+  main.config["srv"]["port"] = port
+  await main.startup()
+
+
+async def wait_until_up(url: str, timeout: float = 30) -> None:
+  start = time.perf_counter()
+  async with aiohttp.ClientSession() as session:
+    while time.perf_counter() - start < timeout:
+      try:
+        async with session.get(url + "/api/srv/get/") as resp:
+          if resp.status == 200:
+            return
+      except aiohttp.ClientError:
+        pass
+      await asyncio.sleep(0.25)
+  raise TimeoutError(f"server at {url} did not come up")
+
+
+def parse_mix(mix: str | None) -> dict[str, float]:
+  "Parse `svg=3,job=1` into weights."
+  if not mix:
+    return dict(DEFAULT_MIX)
+  weights = {}
+  for part in mix.split(","):
+    name, weight = part.split("=")
+    if name not in DEFAULT_MIX:
+      raise ValueError(f"unknown flow {name}, pick from {list(DEFAULT_MIX)}")
+    weights[name] = float(weight)
+  return weights
+
+
+def main(argv: list[str] = None) -> int:
+  parser = argparse.ArgumentParser(description="Load test the web server.")
+  parser.add_argument("mode", nargs="?", choices=["run", "serve"], default="run")
+  parser.add_argument("--url", help="load this server instead of starting one")
+  parser.add_argument("--port", type=int, default=8500)
+  parser.add_argument("--auth-port", type=int, default=8501)
+  parser.add_argument("--auth-latency", type=float, default=0.02)
+  parser.add_argument(
+    "--tool-latency", type=float, default=0.05,
+    help="seconds each fake tool takes, see bench/fakes/fake_common.py",
+  )
+  parser.add_argument("--real-tools", action="store_true")
+  parser.add_argument("--rate", type=float, default=5, help="flows per second")
+  parser.add_argument("--duration", type=float, default=30)
+  parser.add_argument("--max-inflight", type=int, default=200)
+  parser.add_argument("--mix", help="flow weights, e.g. svg=3,job=1")
+  parser.add_argument("--clients", type=int, default=50)
+  parser.add_argument("--auth-fraction", type=float, default=0.5)
+  parser.add_argument("--job-timeout", type=float, default=120)
+  parser.add_argument("--image-kind", default="logo")
+  parser.add_argument("--image-size", type=int, default=256)
+  parser.add_argument("--image-colours", type=int, default=4)
+  parser.add_argument("--output", help="also write the report as JSON here")
+  args = parser.parse_args(argv)
+
+  os.environ.setdefault("FAKE_TOOL_LATENCY", str(args.tool_latency))
+
+  if args.mode == "serve":
+    import uvloop
+    try:
+      uvloop.run(
+        serve(args.port, args.auth_port, args.auth_latency, args.real_tools)
+      )
+    except KeyboardInterrupt:
+      pass
+    return 0
+
+  server = None
+  url = args.url
+  if url is None:
+    url = f"http://127.0.0.1:{args.port}"
+    command = [
+      sys.executable, "-m", "bench.load", "serve",
+      "--port", str(args.port),
+      "--auth-port", str(args.auth_port),
+      "--auth-latency", str(args.auth_latency),
+    ]
+    if args.real_tools:
+      command.append("--real-tools")
+    server = subprocess.Popen(
+      command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+  try:
+    asyncio.run(wait_until_up(url))
+    png = get_png(Case(args.image_kind, args.image_size, args.image_colours))
+    test = LoadTest(
+      url,
+      mix=parse_mix(args.mix),
+      png=png,
+      clients=args.clients,
+      auth_fraction=args.auth_fraction,
+      job_timeout=args.job_timeout,
+    )
+    report = asyncio.run(test.run(args.rate, args.duration, args.max_inflight))
+  finally:
+    if server is not None:
+      server.terminate()
+      server.wait()
+
+  print(json.dumps(report, indent=2))
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,305 @@
+# Benchmark every pipeline stage against the synthetic corpus.
+#
+# Run from src/:
+#   python -m bench.run                          quick matrix, external tools skipped
+#   python -m bench.run --tools fake             use the stand-ins in bench/fakes/
+#   python -m bench.run --sizes 256 8192 --colours 2 64 --kinds logo photo
+#   python -m bench.run --save-baseline          store results as the new baseline
+#   python -m bench.run --check                  exit 1 on a regression vs the baseline
+#   python -m bench.run --compare-tracers        time every tracer, with node counts and sizes
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import sys
+import time
+import tracemalloc
+from typing import TYPE_CHECKING
+
+from bench.corpus import KINDS, get_png, make_cases
+
+if TYPE_CHECKING:
+  from typing import Any, Callable
+
+  from bench.corpus import Case
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKES_DIR = os.path.join(BENCH_DIR, "fakes")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baselines.json")
+
+
+class Stage:
+  """A benchmarked function. `run` takes the PNG bytes and the case.
+
+  Stages that shell out to ImageMagick/potrace/OpenSCAD/colorscad set
+  `needs_tools`, and are skipped unless real or fake tools are enabled."""
+
+  name: str
+  run: Callable[[bytes, Case], Any]
+  needs_tools: bool
+
+  def __init__(
+    self, name: str, run: Callable[[bytes, Case], Any], needs_tools: bool = False
+  ) -> None:
+    self.name = name
+    self.run = run
+    self.needs_tools = needs_tools
+
+
+def _identify_colours(png: bytes, case: Case) -> Any:
+  from utils.multicolor_extruder import identify_colours
+  return identify_colours(png)
+
+
+def _separate_png(png: bytes, case: Case) -> Any:
+  from utils.multicolor_extruder import separate_png
+  return separate_png(png)
+
+
+def _quantize_image(png: bytes, case: Case) -> Any:
+  from utils.quantize import quantize_image
+  return quantize_image(png, case.colours)
+
+
+def _svg_canny(png: bytes, case: Case) -> Any:
+  from utils.svg import png_to_svg
+  return png_to_svg(png)
+
+
+def _svg_sobel(png: bytes, case: Case) -> Any:
+  from utils.svg2 import png_to_svg
+  return png_to_svg(png)
+
+
+def _svg_potrace(png: bytes, case: Case) -> Any:
+  from utils.svg3 import png_to_svg
+  return png_to_svg(png)
+
+
+def _png_to_stl(png: bytes, case: Case) -> Any:
+  from utils.extruder import png_to_stl
+  return png_to_stl(png, 5, 100, 100)
+
+
+def _png_to_3mf(png: bytes, case: Case) -> Any:
+  from utils.multicolor_extruder import png_to_3mf
+  return png_to_3mf(png, 2, 100, 100)
+
+
+def _png_to_backed3mf(png: bytes, case: Case) -> Any:
+  from utils.multicolor_extruder import png_to_backed3mf
+  return png_to_backed3mf(png, 2, 100, 100, 1)
+
+
+def _png_to_greyscale(png: bytes, case: Case) -> Any:
+  from utils.greyscale_extruder import png_to_greyscale
+  return png_to_greyscale(png, 3.2, 100, 100, layers=min(case.colours, 8))
+
+
+STAGES: dict[str, Stage] = {
+  stage.name: stage
+  for stage in [
+    Stage("identify_colours", _identify_colours),
+    Stage("separate_png", _separate_png),
+    Stage("quantize_image", _quantize_image),
+    Stage("svg_canny", _svg_canny),
+    Stage("svg_sobel", _svg_sobel),
+    Stage("svg_potrace", _svg_potrace, needs_tools=True),
+    Stage("png_to_stl", _png_to_stl, needs_tools=True),
+    Stage("png_to_3mf", _png_to_3mf, needs_tools=True),
+    Stage("png_to_backed3mf", _png_to_backed3mf, needs_tools=True),
+    Stage("png_to_greyscale", _png_to_greyscale),
+  ]
+}
+
+
+def _trace_with(name: str) -> Callable[[bytes, Case], Any]:
+  def trace(png: bytes, case: Case) -> Any:
+    from utils.tracers import get_tracer
+    return get_tracer(name).trace(png)
+  return trace
+
+
+def tracer_stages() -> list[Stage]:
+  from utils.tracers import tracers
+  return [
+    Stage(f"tracer:{tracer.name}", _trace_with(tracer.name), not tracer.in_process)
+    for tracer in tracers.values()
+  ]
+
+
+SVG_COORDINATES = re.compile(r'(?:points|d)="([^"]*)"')
+SVG_NUMBER = re.compile(r"-?\d*\.?\d+(?:e-?\d+)?")
+
+
+def count_nodes(svg: str) -> int:
+  "Count the coordinate pairs in the polylines and paths of an SVG."
+  return sum(
+    len(SVG_NUMBER.findall(coordinates)) // 2
+    for coordinates in SVG_COORDINATES.findall(svg)
+  )
+
+
+def measure(stage: Stage, png: bytes, case: Case, repeats: int) -> dict:
+  """Time a stage, keeping the best of `repeats` runs.
+
+  A first warm-up run is made under tracemalloc for the peak memory, as
+  tracing allocations slows everything down too much to time it as well."""
+  loop = asyncio.new_event_loop()
+
+  def call() -> Any:
+    result = stage.run(png, case)
+    if asyncio.iscoroutine(result):
+      result = loop.run_until_complete(result)
+    return result
+
+  try:
+    tracemalloc.start()
+    try:
+      call()
+      peak = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+
+    best = float("inf")
+    for _ in range(repeats):
+      start = time.perf_counter()
+      call()
+      best = min(best, time.perf_counter() - start)
+  finally:
+    loop.close()
+  return {
+    "seconds": best,
+    "megapixels_per_second": case.pixels / 1e6 / best if best else None,
+    "peak_mb": peak / 1e6,
+  }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+  "List the results that are more than `tolerance` slower than the baseline."
+  regressions = []
+  for key, result in results.items():
+    if key not in baseline or "seconds" not in result:
+      continue
+    before = baseline[key]["seconds"]
+    after = result["seconds"]
+    if before > 0 and after > before * (1 + tolerance):
+      regressions.append(
+        f"{key}: {before:.4f}s -> {after:.4f}s"
+        f" (+{(after / before - 1) * 100:.0f}%)"
+      )
+  return regressions
+
+
+def main(argv: list[str] = None) -> int:
+  parser = argparse.ArgumentParser(
+    description="Benchmark the conversion pipeline stages."
+  )
+  parser.add_argument("--stages", nargs="+", choices=list(STAGES))
+  parser.add_argument("--kinds", nargs="+", choices=KINDS)
+  parser.add_argument("--sizes", nargs="+", type=int)
+  parser.add_argument("--colours", nargs="+", type=int)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--repeats", type=int, default=3)
+  parser.add_argument(
+    "--tools", choices=["skip", "fake", "real"], default="skip",
+    help="how to run stages that need external tools",
+  )
+  parser.add_argument("--baseline", default=BASELINE_PATH)
+  parser.add_argument("--save-baseline", action="store_true")
+  parser.add_argument("--check", action="store_true")
+  parser.add_argument(
+    "--tolerance", type=float, default=0.25,
+    help="fraction slower than the baseline that counts as a regression",
+  )
+  parser.add_argument(
+    "--compare-tracers", action="store_true",
+    help="benchmark every registered tracer instead of the stages",
+  )
+  parser.add_argument("--output", help="also write the results as JSON here")
+  args = parser.parse_args(argv)
+
+  if args.tools == "fake":
+    os.environ["PATH"] = FAKES_DIR + os.pathsep + os.environ["PATH"]
+
+  if args.compare_tracers:
+    stages = tracer_stages()
+  else:
+    stages = [STAGES[name] for name in args.stages or STAGES]
+  cases = make_cases(args.kinds, args.sizes, args.colours, args.seed)
+
+  results: dict[str, dict] = {}
+  for case in cases:
+    png = get_png(case)
+    for stage in stages:
+      key = f"{stage.name}/{case.name}"
+      if stage.needs_tools and args.tools == "skip":
+        results[key] = {"skipped": "needs external tools"}
+        print(f"{key:<48} skipped, needs external tools (--tools fake or real)")
+        continue
+      try:
+        results[key] = measure(stage, png, case, args.repeats)
+        if args.compare_tracers:
+          svg = asyncio.run(stage.run(png, case))
+          results[key]["nodes"] = count_nodes(svg)
+          results[key]["svg_kb"] = len(svg.encode()) / 1e3
+      except Exception as e:
+        results[key] = {"error": repr(e)}
+      result = results[key]
+      if "seconds" in result and args.compare_tracers:
+        print(
+          f"{key:<48} {result['seconds']:>9.4f}s"
+          f" {result['nodes']:>9} nodes"
+          f" {result['svg_kb']:>9.1f} KB"
+        )
+      elif "seconds" in result:
+        print(
+          f"{key:<48} {result['seconds']:>9.4f}s"
+          f" {result['megapixels_per_second']:>9.2f} MP/s"
+          f" {result['peak_mb']:>9.1f} MB peak"
+        )
+      else:
+        print(f"{key:<48} error {result.get('error')}")
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+
+  exit_code = 0
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline.get("results", {}), args.tolerance)
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions and args.check:
+      exit_code = 1
+
+  if args.save_baseline:
+    stored = {}
+    if os.path.exists(args.baseline):
+      with open(args.baseline) as f:
+        stored = json.load(f).get("results", {})
+    stored.update({k: v for k, v in results.items() if "seconds" in v})
+    with open(args.baseline, "w") as f:
+      json.dump(
+        {
+          "machine": platform.node(),
+          "python": sys.version.split()[0],
+          "results": stored,
+        },
+        f,
+        indent=2,
+        sort_keys=True,
+      )
+    print(f"saved baseline to {args.baseline}")
+
+  return exit_code
+
+
+if __name__ == "__main__":
+  sys.exit(main())
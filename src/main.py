@@ -110,7 +110,8 @@ async def startup():
     try: await session.close()   # noqa: E701
     except: pass  # noqa: E722, E701
 
-try:
-  uvloop.run(startup(), debug=True)
-except KeyboardInterrupt:
-  print("Server shut down.")
\ No newline at end of file
+if __name__ == "__main__":
+  try:
+    uvloop.run(startup(), debug=True)
+  except KeyboardInterrupt:
+    print("Server shut down.")
\ No newline at end of file
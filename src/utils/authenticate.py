@@ -1,19 +1,31 @@
 # Handle authentication and request verification
 from __future__ import annotations
 
+import asyncio
+import functools
 import hashlib
 import json
+import logging
 import time
+import tomllib
+from collections import OrderedDict
 from enum import Enum
 from typing import TYPE_CHECKING
 
+from aiohttp import ClientError
 from aiohttp.web import Response
 
+from utils.metrics import watch_cache
+
 if TYPE_CHECKING:
+  from typing import Awaitable, Callable
+
   from aiohttp import ClientSession
 
   from .extra_request import Application, Request
 
+LOG = logging.getLogger(__name__)
+
 
 class Approval(Enum):
   DEFAULT = 0
@@ -85,82 +97,207 @@ class Project:
     self.description = description
 
 
-# Hashed auth token -> user, expiry
-auth_cache: dict[str, tuple[User, int]] = {}
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  AUTH_URL: str = config["auth"]["url"].rstrip("/")
+  AUTH_CACHE_SIZE: int = config["auth"]["cache_size"]
+  AUTH_CACHE_TTL: float = config["auth"]["cache_ttl"]
+  AUTH_NEGATIVE_TTL: float = config["auth"]["negative_ttl"]
+  AUTH_REFRESH_AFTER: float = config["auth"]["refresh_after"]
 
 
-# All this does is authenticate a user existing.
-async def authenticate(
-  request: Request, *, cs: ClientSession = None, use_cache=True
-) -> User | Response | Key:
-  app: Application = request.app
-  if cs is None:
-    cs = app.cs
+class AuthCache:
+  """Bounded TTL cache of auth lookups, keyed by the hashed token.
 
-  # We prioritize header authentication over cookie authentication.
-  auth_token = request.cookies.get("Authorization", None)
-  auth_token = request.headers.get("Authorization", auth_token)
+  Rejected tokens are stored as `None` for `negative_ttl` seconds. Entries
+  older than `refresh_after` are still served, but trigger a background
+  refresh so hot tokens never wait on the auth service. Concurrent lookups
+  of the same token share a single request."""
 
-  if auth_token is None:
-    return Response(
-      status=401, body="pass Authorization header or Authorization cookie."
-    )
+  entries: OrderedDict[str, tuple[User | Key | None, float]]
+  inflight: dict[str, asyncio.Task]
 
-  auth_token = auth_token.removeprefix("Bearer ")
+  def __init__(
+    self,
+    *,
+    max_size: int = 4096,
+    ttl: float = 600,
+    negative_ttl: float = 30,
+    refresh_after: float = 480,
+  ) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.refresh_after = refresh_after
+    self.entries = OrderedDict()
+    self.inflight = {}
+    self.stats = {"hits": 0, "misses": 0, "negative_hits": 0, "refreshes": 0}
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def get(self, token_hash: str) -> tuple[User | Key | None, float] | None:
+    "Get a live (value, age) entry, or None if it is missing or expired."
+    entry = self.entries.get(token_hash)
+    if entry is None:
+      return None
+    value, stored_at = entry
+    age = time.monotonic() - stored_at
+    if age >= (self.ttl if value is not None else self.negative_ttl):
+      del self.entries[token_hash]
+      return None
+    self.entries.move_to_end(token_hash)
+    return value, age
+
+  def put(self, token_hash: str, value: User | Key | None) -> None:
+    self.entries[token_hash] = (value, time.monotonic())
+    self.entries.move_to_end(token_hash)
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+
+  def clear(self) -> None:
+    self.entries.clear()
+
+  def fetch(
+    self, token_hash: str, lookup: Callable[[], Awaitable[User | Key | None]]
+  ) -> asyncio.Task:
+    "Start (or join) the lookup for a token, storing the result when done."
+    task = self.inflight.get(token_hash)
+    if task is not None:
+      return task
+
+    async def _run() -> User | Key | None:
+      try:
+        value = await lookup()
+        self.put(token_hash, value)
+        return value
+      finally:
+        self.inflight.pop(token_hash, None)
+
+    task = asyncio.get_running_loop().create_task(_run())
+    self.inflight[token_hash] = task
+    return task
+
+  async def lookup(
+    self,
+    token_hash: str,
+    lookup: Callable[[], Awaitable[User | Key | None]],
+  ) -> User | Key | None:
+    entry = self.get(token_hash)
+    if entry is not None:
+      value, age = entry
+      if value is None:
+        self.stats["negative_hits"] += 1
+        return None
+      self.stats["hits"] += 1
+      if age >= self.refresh_after and token_hash not in self.inflight:
+        self.stats["refreshes"] += 1
+        task = self.fetch(token_hash, lookup)
+        # A failed refresh keeps serving the old entry until it expires.
+        task.add_done_callback(_log_refresh_failure)
+      return value
+
+    self.stats["misses"] += 1
+    # Shield it so one cancelled request does not fail everyone waiting.
+    return await asyncio.shield(self.fetch(token_hash, lookup))
+
+
+def _log_refresh_failure(task: asyncio.Task) -> None:
+  if not task.cancelled() and task.exception() is not None:
+    LOG.warning(f"background auth refresh failed: {task.exception()!r}")
 
-  # Get the hash of it for cache checking
-  if use_cache:
-    token_hash = hashlib.sha512(auth_token.encode()).hexdigest()
-    if token_hash in auth_cache:
-      details = auth_cache[token_hash]
-      current_time = time.time()
-      if current_time < details[1]:
-        return details[0]
 
-  # Now we want to send the request
+# Hashed auth token -> user/key, or None for a rejected token
+auth_cache = AuthCache(
+  max_size=AUTH_CACHE_SIZE,
+  ttl=AUTH_CACHE_TTL,
+  negative_ttl=AUTH_NEGATIVE_TTL,
+  refresh_after=AUTH_REFRESH_AFTER,
+)
+watch_cache("auth", auth_cache.stats)
+
+# Answers of the auth service that mean the token itself is bad
+REJECTED_STATUSES = {400, 401, 404}
+
+
+async def lookup_token(
+  auth_token: str, *, cs: ClientSession
+) -> User | Key | None:
+  """Ask the auth service who a token belongs to. None means it was rejected.
+
+  Any other answer raises RuntimeError, so an outage is never cached as a
+  rejection."""
   # Removing and adding Bearer is mildly redundant
   headers = {"Authorization": f"Bearer {auth_token}"}
 
-  async with cs.get(
-    "https://auth.skystuff.cc/api/user/get/", headers=headers
-  ) as resp:
+  async with cs.get(f"{AUTH_URL}/api/user/get/", headers=headers) as resp:
     if resp.status == 200:
       data = json.loads(await resp.text())
-      u = User(
+      return User(
         username=data["name"],
         super_admin=data["super_admin"],
         email=data["email"],
         token=data["token"],
       )
-
-      token_hash = hashlib.sha512(auth_token.encode()).hexdigest()
-      current_time = time.time()
-      auth_cache[token_hash] = (u, current_time + 600)
-
-      return u
     elif resp.status == 400:
       text = await resp.text()
       if not text.startswith("please use /key/"):
-        return Response(status=401, body="invalid token")
-      async with cs.get(
-        "https://auth.skystuff.cc/api/key/" + auth_token
-      ) as kresp:
+        return None
+      async with cs.get(f"{AUTH_URL}/api/key/{auth_token}") as kresp:
+        if kresp.status in REJECTED_STATUSES:
+          return None
         if kresp.status != 200:
-          return Response(status=401, body="invalid token")
+          raise RuntimeError(f"auth service answered {kresp.status} for a key")
         data = json.loads(await kresp.text())
         project = Project(**data["project"])
         user = User(**data["user"])
-        key = Key(
+        return Key(
           name=data["name"],
           id=data["id"],
           data=data["data"],
           user=user,
           project=project,
         )
-        return key
+    elif resp.status in REJECTED_STATUSES:
+      return None
+    else:
+      raise RuntimeError(f"auth service answered {resp.status}")
+
 
+# All this does is authenticate a user existing.
+async def authenticate(
+  request: Request, *, cs: ClientSession = None, use_cache=True
+) -> User | Response | Key:
+  app: Application = request.app
+  if cs is None:
+    cs = app.cs
+
+  # We prioritize header authentication over cookie authentication.
+  auth_token = request.cookies.get("Authorization", None)
+  auth_token = request.headers.get("Authorization", auth_token)
+
+  if auth_token is None:
+    return Response(
+      status=401, body="pass Authorization header or Authorization cookie."
+    )
+
+  auth_token = auth_token.removeprefix("Bearer ")
+
+  try:
+    if use_cache:
+      token_hash = hashlib.sha512(auth_token.encode()).hexdigest()
+      result = await auth_cache.lookup(
+        token_hash, functools.partial(lookup_token, auth_token, cs=cs)
+      )
     else:
-      return Response(status=401, body="invalid token")
+      result = await lookup_token(auth_token, cs=cs)
+  except (RuntimeError, ClientError) as e:
+    LOG.warning(f"auth lookup failed: {e!r}")
+    return Response(status=503, body="authentication is unavailable, try again later.")
+
+  if result is None:
+    return Response(status=401, body="invalid token")
+  return result
 
 
 async def get_project_status(
@@ -168,7 +305,7 @@ async def get_project_status(
 ) -> Approval | False:
   headers = {"Authorization": f"Bearer {user.token}"}
   async with cs.get(
-    f"https://auth.skystuff.cc/api/project/status/{project_name}",
+    f"{AUTH_URL}/api/project/status/{project_name}",
     headers=headers,
   ) as resp:
     if resp.status != 200:
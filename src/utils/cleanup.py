@@ -0,0 +1,120 @@
+# Clean up the channel labels of an image before they are traced
+from __future__ import annotations
+
+import tomllib
+
+import cv2
+import numpy
+
+from utils.islands import label_islands
+from utils.simplify import NOZZLE_WIDTH
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  CLEANUP = config.get("cleanup", {}).get("enabled", True)
+  # Islands smaller than this many mm² can't be printed, 0 keeps them all.
+  MIN_AREA_MM2 = config.get("cleanup", {}).get("min_area_mm2", 0.16)
+
+# A pixel with at most this many of its own channel in its 3x3 window,
+# itself included, is a fringe: a speck, a spur or a one pixel wide line.
+FRINGE_SUPPORT = 3
+# Rounds of growing the channels around a removed speck into it
+FILL_ITERATIONS = 4
+# Labels of pixels that are yet to be filled in
+UNKNOWN = -2
+
+
+def get_min_area(width: int, height: int, x: float, y: float, area_mm2: float = MIN_AREA_MM2) -> int:
+  "Get the smallest printable island in pixels, for an image printed `x` by `y` mm."
+  if area_mm2 <= 0 or x <= 0 or y <= 0:
+    return 0
+  pixel_area = (x / width) * (y / height)
+  return int(area_mm2 / pixel_area)
+
+
+def get_pixel_size(width: int, height: int, x: float, y: float) -> float:
+  "Get the size in mm of a pixel of an image printed `x` by `y` mm, 0 if unknown."
+  if x <= 0 or y <= 0:
+    return 0.0
+  return max(x / width, y / height)
+
+
+def count_neighbours(labels: numpy.ndarray, count: int) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+  """Count the labels in every pixel's 3x3 window, from -1 (nothing drawn)
+  to `count` - 1, one label at a time to keep memory flat.
+
+  Returns the most common label around each pixel other than its own, how
+  many pixels have it, and how many have the pixel's own label."""
+  best_label = numpy.full(labels.shape, -1, dtype=labels.dtype)
+  best_count = numpy.zeros(labels.shape, dtype=numpy.uint8)
+  own_count = numpy.zeros(labels.shape, dtype=numpy.uint8)
+  for label in range(-1, count):
+    mask = labels == label
+    window = cv2.boxFilter(
+      mask.view(numpy.uint8), -1, (3, 3), normalize=False,
+      borderType=cv2.BORDER_CONSTANT,
+    )
+    other = numpy.where(mask, 0, window)
+    better = other > best_count
+    best_label[better] = label
+    best_count[better] = other[better]
+    own_count[mask] = window[mask]
+  return best_label, best_count, own_count
+
+
+def mode_filter(labels: numpy.ndarray, count: int, support: int = FRINGE_SUPPORT) -> numpy.ndarray:
+  """Give fringe pixels to the channel most common around them.
+
+  Anti-aliased edges leave thin bands and specks of in-between colours,
+  which each trace into many tiny paths. Pixels with `support` or fewer of
+  their own channel around them are reassigned; the edges of solid shapes
+  have more than that, so they stay where they are."""
+  best_label, best_count, own_count = count_neighbours(labels, count)
+  fringe = (own_count <= support) & (best_count >= own_count)
+  labels = labels.copy()
+  labels[fringe] = best_label[fringe]
+  return labels
+
+
+def remove_specks(
+  labels: numpy.ndarray, count: int, min_area: int, connectivity: int = 8
+) -> numpy.ndarray:
+  """Fill islands of any channel smaller than `min_area` pixels with the
+  channels around them.
+
+  The islands are found with their connected-component stats, then the
+  surrounding channels grow into them a ring at a time. Anything still
+  unfilled after that is dropped."""
+  labels = labels.copy()
+  for label in range(count):
+    islands, island_labels, stats = label_islands(labels == label, connectivity)
+    small = stats[:, cv2.CC_STAT_AREA] < min_area
+    small[0] = False  # Label 0 is the background, not an island.
+    if small.any():
+      labels[small[island_labels]] = UNKNOWN
+
+  for _ in range(FILL_ITERATIONS):
+    unknown = labels == UNKNOWN
+    if not unknown.any():
+      break
+    best_label, best_count, _ = count_neighbours(labels, count)
+    filled = unknown & (best_count > 0)
+    labels[filled] = best_label[filled]
+  labels[labels == UNKNOWN] = -1
+  return labels
+
+
+def clean_labels(labels: numpy.ndarray, count: int, x: float = 0, y: float = 0) -> numpy.ndarray:
+  """Remove the fringes, then islands too small to print, from the labels
+  of an image printed `x` by `y` mm.
+
+  Fringes are only removed while a pixel is narrower than the nozzle, as a
+  one pixel wide line is printable otherwise. Nothing is removed if the
+  print size isn't known."""
+  height, width = labels.shape
+  if 0 < get_pixel_size(width, height, x, y) < NOZZLE_WIDTH:
+    labels = mode_filter(labels, count)
+  min_area = get_min_area(width, height, x, y)
+  if min_area > 1:
+    labels = remove_specks(labels, count, min_area)
+  return labels
@@ -6,9 +6,17 @@ from io import BytesIO
 
 import aiofiles
 import aiofiles.os
+import numpy
 from PIL import Image
 
-from utils.svg3 import png_to_svg
+from utils.image_context import ImageContext
+from utils.layout import get_placement, measure_mask
+from utils.preprocess import downsample_image
+from utils.simplify import Quality, get_quality
+from utils.stage_cache import digest, stage_cache
+from utils.tools import run_tool
+from utils.tracers import Tracer, get_tracer
+from utils.tracing import span
 
 LOG = logging.getLogger(__name__)
 
@@ -32,7 +40,7 @@ thickness = {height}; // Adjust this value as needed
 convexity = 50; // Increase if you encounter issues with complex shapes
 
 resize([{x},{y},0])
-  linear_extrude(height = thickness, convexity = convexity, center = true, $fn=1024) {{
+  linear_extrude(height = thickness, convexity = convexity, center = true, $fn={fn}) {{
   import_image("{image}");
 }}"""
 
@@ -42,70 +50,125 @@ def make_job_id() -> str:
   return "".join(random.choices(pool, k=16))
 
 
-async def png_to_stl(png: bytes, z: float, x: float = 0, y: float = 0, *, size_based_on_total_image_size: bool = False, error_empty_svg: bool = False) -> bytes:
-  job_id: str = make_job_id()
+def get_print_size(box: dict[str, int], x: float, y: float, size_based_on_total_image_size: bool) -> tuple[float, float]:
+  """Get the size in mm the whole image prints at, from the box of its drawn part.
+
+  `x` and `y` are the size of the whole image if `size_based_on_total_image_size`,
+  otherwise of the drawn part, which is what OpenSCAD resizes. 0 means unknown."""
+  if size_based_on_total_image_size:
+    return x, y
+  drawn_width = box["right"] - box["left"]
+  drawn_height = box["bottom"] - box["top"]
+  return (
+    x * box["width"] / drawn_width if drawn_width > 0 else 0,
+    y * box["height"] / drawn_height if drawn_height > 0 else 0,
+  )
 
+
+def prepare_png(png: bytes, x: float, y: float, size_based_on_total_image_size: bool) -> tuple[bytes, dict[str, int]]:
+  """Measure the drawn part of a PNG, shrinking it first if the print can't
+  show that much detail. Returns the PNG to trace and the box."""
+  context = ImageContext.from_png(png)
+  box = measure_mask(context.drawn())
+  image = Image.fromarray(context.pixels)
+  resized = downsample_image(image, *get_print_size(box, x, y, size_based_on_total_image_size))
+  if resized is image:
+    return png, box
+  stream = BytesIO()
+  resized.save(stream, "png", compress_level=1)
+  return stream.getvalue(), measure_mask(ImageContext(numpy.asarray(resized)).drawn())
+
+
+def get_trace_key(
+  png: bytes, box: dict[str, int], x: float, y: float, size_based_on_total_image_size: bool,
+  engine: Tracer, preset: Quality,
+) -> tuple[tuple, float]:
+  """Get the tolerance to trace a PNG with, and the stage cache key of the
+  SVG that comes out, which depends on nothing else."""
+  # Simplify the outlines as far as the printer can't tell the difference.
+  tolerance = preset.get_tolerance(
+    box["width"], box["height"], *get_print_size(box, x, y, size_based_on_total_image_size)
+  )
+  return ("trace", digest(png), engine.name, preset.name, tolerance), tolerance
+
+
+async def cache_trace(
+  png: bytes, box: dict[str, int], x: float = 0, y: float = 0, *,
+  size_based_on_total_image_size: bool = False, tracer: str = None, quality: str = None,
+) -> None:
+  "Trace a PNG into the stage cache, for a `png_to_stl` with the same arguments to use."
+  engine = get_tracer(tracer, filled=True)
+  preset = get_quality(quality)
+  key, tolerance = get_trace_key(png, box, x, y, size_based_on_total_image_size, engine, preset)
+  if key in stage_cache:
+    return
   await aiofiles.os.makedirs("/tmp/extruder/", exist_ok=True)
+  svg_path = f"/tmp/extruder/{make_job_id()}.svg"
+  await engine.to_file(png, svg_path, quality=preset, tolerance=tolerance)
+  async with aiofiles.open(svg_path, "rb") as f:
+    svg = await f.read()
+  await aiofiles.os.remove(svg_path)
+  stage_cache.put(key, svg, len(svg))
 
-  # convert to svg
-  svg = await png_to_svg(png)
 
-  if "path" not in svg and error_empty_svg:
-    raise ValueError("SVG was empty!")
+async def png_to_stl(png: bytes, z: float, x: float = 0, y: float = 0, *, size_based_on_total_image_size: bool = False, error_empty_svg: bool = False, tracer: str = None, quality: str = None, box: dict[str, int] = None) -> bytes:
+  """Trace a PNG and extrude it `z` mm thick.
 
-  async with aiofiles.open(f"/tmp/extruder/{job_id}.svg", "w") as f:
-    await f.write(svg)
+  `box` is the drawn part of the PNG from `measure_mask`, if the caller
+  has already measured it, otherwise the PNG is decoded to measure it."""
+  job_id: str = make_job_id()
+  engine = get_tracer(tracer, filled=True)
+  preset = get_quality(quality)
 
-  if not size_based_on_total_image_size:
-    x=x
-    y=y
-  else:
-    # Get the actual height of the object comapred to the canvas in pixels, versus just the height of the object
-    png_buffer = BytesIO(png)
-    img = Image.open(png_buffer)
-    img.convert("L")
-    width, height = img.size
-    top = height
-    bottom = 0
-    left = width
-    right = 0
-
-    pixels = img.load()
-
-    for image_y in range(height):
-      for image_x in range(width):
-        r, g, b, a = pixels[image_x, image_y]
-        if r*g*b != 255*255*255:
-          # This pixel is something other than white, mark it.
-          if image_y > bottom:
-            bottom = image_y
-          if image_x > right:
-            right = image_x
-          if image_y < top:
-            top = image_y
-          if image_x < left:
-            left = image_x
-    
-    # Now use the numbers to calculate the total size
-    total_image_height = height - top - (height - bottom)
-    total_image_width = width - left - (width - right)
-
-    x_scalar = total_image_width / width
-    y_scalar = total_image_height / height
-    x = x * x_scalar
-    y = y * y_scalar
+  await aiofiles.os.makedirs("/tmp/extruder/", exist_ok=True)
+
+  # Don't trace more pixels than the print can show
+  if box is None:
+    with span("measure", stage="preprocess", png_bytes=len(png)):
+      loop = asyncio.get_event_loop()
+      png, box = await loop.run_in_executor(
+        None, prepare_png, png, x, y, size_based_on_total_image_size
+      )
+
+  # convert to svg, written straight to where OpenSCAD will read it from
+  svg_path = f"/tmp/extruder/{job_id}.svg"
+  key, tolerance = get_trace_key(png, box, x, y, size_based_on_total_image_size, engine, preset)
+  # It may already have been traced ahead of time, see utils.speculate
+  svg = stage_cache.get(key)
+  with span(
+    "png_to_svg", stage="trace", png_bytes=len(png), tracer=engine.name,
+    quality=preset.name, tolerance=round(tolerance, 3), cached=svg is not None,
+  ) as trace_span:
+    if svg is None:
+      await engine.to_file(png, svg_path, quality=preset, tolerance=tolerance)
+    else:
+      async with aiofiles.open(svg_path, "wb") as f:
+        await f.write(svg)
+    trace_span.set(svg_bytes=await aiofiles.os.path.getsize(svg_path))
+
+  if error_empty_svg:
+    async with aiofiles.open(svg_path, "rb") as f:
+      if b"path" not in await f.read():
+        await aiofiles.os.remove(svg_path)
+        raise ValueError("SVG was empty!")
+
+  if size_based_on_total_image_size:
+    # Get the actual size of the object compared to the canvas in pixels, versus just the size of the object
+    placement = get_placement(box, x, y)
+    x, y = placement["x"], placement["y"]
 
   scad_script = SCAD_SCRIPT_TEMPLATE.format(
-    image=f"/tmp/extruder/{job_id}.svg", height=str(z), x=x, y=y
+    image=f"/tmp/extruder/{job_id}.svg", height=str(z), x=x, y=y, fn=preset.fn
   )
   async with aiofiles.open(f"/tmp/extruder/{job_id}.scad", "w") as f:
     await f.write(scad_script)
 
-  proc = await asyncio.subprocess.create_subprocess_shell(
-    f"OpenSCAD-2021.01-x86_64.AppImage -o /tmp/extruder/{job_id}.stl /tmp/extruder/{job_id}.scad", stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
-  )
-  returncode = await proc.wait()
-  if returncode == 0:
+  with span("openscad", stage="extrude"):
+    openscad = await run_tool(
+      "openscad",
+      f"OpenSCAD-2021.01-x86_64.AppImage -o /tmp/extruder/{job_id}.stl /tmp/extruder/{job_id}.scad",
+    )
+  if openscad.ok:
     async with aiofiles.open(f"/tmp/extruder/{job_id}.stl", "rb") as f:
       stl_bytes = await f.read()
 
@@ -119,6 +182,5 @@ async def png_to_stl(png: bytes, z: float, x: float = 0, y: float = 0, *, size_b
 
     return stl_bytes
   else:
-    LOG.error((await proc.stdout.read()).decode())
-    LOG.error((await proc.stderr.read()).decode())
+    openscad.log_output()
     raise RuntimeError("openscad failure")
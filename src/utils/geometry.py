@@ -0,0 +1,239 @@
+# Geometry helpers shared by the OpenCV tracers (svg.py and svg2.py)
+from __future__ import annotations
+
+import numpy
+
+# A structure representing an SVG polyline
+Polyline = list[tuple[int, int]]
+
+# Neighbouring grid cells to search. Only half of them are needed, as a pair
+# of cells found from one side is never searched again from the other.
+HALF_NEIGHBOURHOOD = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+
+
+def find_close_points(
+  points: numpy.ndarray, max_distance: float
+) -> tuple[numpy.ndarray, numpy.ndarray]:
+  """Find every pair of points at most `max_distance` apart.
+
+  The points are hashed into a grid of `max_distance` sized cells, so only
+  points in neighbouring cells are ever compared. Returns two index arrays,
+  each pair is listed once with the lower index first."""
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+  empty = numpy.empty(0, dtype=numpy.intp)
+  if len(points) < 2 or max_distance <= 0:
+    return empty, empty
+
+  # Shift the cells by one, so the neighbours of row 0 don't wrap around.
+  cells = numpy.floor(points / max_distance).astype(numpy.int64)
+  cells -= cells.min(axis=0) - 1
+  rows = int(cells[:, 1].max()) + 2
+  keys = cells[:, 0] * rows + cells[:, 1]
+  order = numpy.argsort(keys, kind="stable")
+  sorted_keys = keys[order]
+
+  firsts, seconds = [], []
+  for dx, dy in HALF_NEIGHBOURHOOD:
+    targets = keys + (dx * rows + dy)
+    lo = numpy.searchsorted(sorted_keys, targets, side="left")
+    hi = numpy.searchsorted(sorted_keys, targets, side="right")
+    counts = hi - lo
+    if not counts.any():
+      continue
+    # Expand each point into one candidate per point in the target cell.
+    first = numpy.repeat(numpy.arange(len(points)), counts)
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    second = order[numpy.repeat(lo, counts) + offsets]
+    if (dx, dy) == (0, 0):
+      keep = first < second
+      first, second = first[keep], second[keep]
+    firsts.append(first)
+    seconds.append(second)
+  if not firsts:
+    return empty, empty
+
+  first = numpy.concatenate(firsts)
+  second = numpy.concatenate(seconds)
+  distances = numpy.hypot(*(points[first] - points[second]).T)
+  close = distances <= max_distance
+  first, second = first[close], second[close]
+  swap = first > second
+  first[swap], second[swap] = second[swap], first[swap]
+  return first, second
+
+
+def find_close_ends(
+  polylines: list[Polyline], max_distance: float = 5.0, resolution: int = 2
+) -> list[Polyline]:
+  """
+  Find close ends of polylines.
+
+  Finds the start and end of every polyline, and uses a grid hash to find
+  the ends of other polylines that are at most max_distance away.
+
+  Returns the polylines, followed by a polyline bridging each pair of close
+  ends. Every bridge is only made once, and ends that already touch are not
+  bridged.
+
+  The resolution argument is how many points the joining polyline consists of."""
+  output_polylines = list(polylines)
+  if not polylines:
+    return output_polylines
+
+  ends = numpy.array(
+    [(polyline[0], polyline[-1]) for polyline in polylines], dtype=numpy.float64
+  ).reshape(-1, 2)
+  first, second = find_close_points(ends, max_distance)
+  # Ends of the same polyline are next to each other in `ends`.
+  other = (first // 2) != (second // 2)
+  first, second = first[other], second[other]
+
+  # Bridge each pair of distinct coordinates once, whichever ends they are.
+  segments = numpy.stack([ends[first], ends[second]], axis=1)
+  flip = (segments[:, 0, 0] > segments[:, 1, 0]) | (
+    (segments[:, 0, 0] == segments[:, 1, 0]) & (segments[:, 0, 1] > segments[:, 1, 1])
+  )
+  segments[flip] = segments[flip][:, ::-1]
+  segments = segments[(segments[:, 0] != segments[:, 1]).any(axis=1)]
+  if not len(segments):
+    return output_polylines
+  segments = numpy.unique(segments.reshape(-1, 4), axis=0).reshape(-1, 2, 2)
+
+  steps = numpy.linspace(0, 1, resolution)[numpy.newaxis, :, numpy.newaxis]
+  bridges = segments[:, :1] + steps * (segments[:, 1:] - segments[:, :1])
+  output_polylines.extend(
+    [tuple(point) for point in bridge] for bridge in bridges.tolist()
+  )
+  return output_polylines
+
+
+def get_polyline_signatures(
+  points: numpy.ndarray, starts: numpy.ndarray
+) -> dict[str, numpy.ndarray]:
+  """Summarise polylines stored back to back in one (N, 2) array, where
+  polyline i starts at starts[i]. Returns arrays of the point count, length
+  and bounding box of every polyline."""
+  counts = numpy.diff(numpy.append(starts, len(points)))
+  steps = numpy.hypot(*numpy.diff(points, axis=0).T)
+  # Don't count the jump from the end of one polyline to the next.
+  steps = numpy.append(steps, 0)
+  steps[starts[1:] - 1] = 0
+  return {
+    "count": counts,
+    "length": numpy.add.reduceat(steps, starts),
+    "min": numpy.minimum.reduceat(points, starts),
+    "max": numpy.maximum.reduceat(points, starts),
+  }
+
+
+def find_overlapping_boxes(
+  box_min: numpy.ndarray, box_max: numpy.ndarray, margin: float, cell_size: float = 64
+) -> tuple[numpy.ndarray, numpy.ndarray]:
+  """Find every pair of boxes less than `margin` apart.
+
+  Each box, grown by half the margin, is added to every grid cell it covers,
+  and only boxes sharing a cell are compared. Returns two index arrays, each
+  pair is listed once with the lower index first."""
+  empty = numpy.empty(0, dtype=numpy.intp)
+  if len(box_min) < 2:
+    return empty, empty
+  low = numpy.floor((box_min - margin / 2) / cell_size).astype(numpy.int64)
+  high = numpy.floor((box_max + margin / 2) / cell_size).astype(numpy.int64)
+  shift = low.min(axis=0)
+  low -= shift
+  high -= shift
+  rows = int(high[:, 1].max()) + 1
+
+  # One entry per box per cell it covers
+  spans = high - low + 1
+  counts = spans[:, 0] * spans[:, 1]
+  box = numpy.repeat(numpy.arange(len(box_min)), counts)
+  offset = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+  cell_x = low[box, 0] + offset // spans[box, 1]
+  cell_y = low[box, 1] + offset % spans[box, 1]
+  keys = cell_x * rows + cell_y
+  order = numpy.argsort(keys, kind="stable")
+  keys, box = keys[order], box[order]
+
+  # Pair every entry with the entries after it in the same cell.
+  group_end = numpy.searchsorted(keys, keys, side="right")
+  after = group_end - numpy.arange(len(keys)) - 1
+  first = numpy.repeat(numpy.arange(len(keys)), after)
+  second = first + 1 + (
+    numpy.arange(after.sum()) - numpy.repeat(numpy.cumsum(after) - after, after)
+  )
+  first, second = box[first], box[second]
+  first, second = numpy.minimum(first, second), numpy.maximum(first, second)
+  pairs = numpy.unique(first * len(box_min) + second)
+  first, second = numpy.divmod(pairs, len(box_min))
+
+  gap = numpy.maximum(
+    box_min[first] - box_max[second], box_min[second] - box_max[first]
+  ).clip(min=0)
+  close = numpy.hypot(*gap.T) < margin
+  return first[close], second[close]
+
+
+def find_distinct_polylines(
+  polylines: list[numpy.ndarray], threshold: float = 0.9
+) -> list[int]:
+  """Find near duplicate polylines, scored the same way as svg.path_similarity.
+
+  Polylines are checked in order, and one is dropped when it is more similar
+  than `threshold` to any polyline that hasn't been dropped. Returns the
+  indexes of the polylines to keep.
+
+  Only pairs whose point count, length and bounding box are close enough
+  to pass the threshold are scored, and those are scored all at once."""
+  if len(polylines) < 2:
+    return list(range(len(polylines)))
+  counts = numpy.array([len(polyline) for polyline in polylines])
+  starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+  points = numpy.concatenate(polylines).reshape(-1, 2).astype(numpy.float64)
+  signatures = get_polyline_signatures(points, starts)
+
+  # The score is 0.25 for matching point counts, 0.25 for matching lengths
+  # and 0.5 for the mean distance between points. Each part has to make up
+  # for the others being perfect, which bounds how different a pair can be.
+  slack = 1 - threshold
+  max_count_diff = 15 * slack / 0.25
+  max_length_diff = 100 * slack / 0.25
+  max_distance = 200 * slack / 0.5
+  # Every point lies in its bounding box, so the mean distance between two
+  # polylines can't be less than the gap between their boxes.
+  first, second = find_overlapping_boxes(
+    signatures["min"], signatures["max"], max_distance
+  )
+  count_diff = numpy.abs(counts[first] - counts[second])
+  length_diff = numpy.abs(signatures["length"][first] - signatures["length"][second])
+  possible = (count_diff < max_count_diff) & (length_diff < max_length_diff)
+  first, second = first[possible], second[possible]
+  count_diff, length_diff = count_diff[possible], length_diff[possible]
+  if not len(first):
+    return list(range(len(polylines)))
+
+  # Mean distance between the points of each pair, as far as the shorter goes
+  shared = numpy.minimum(counts[first], counts[second])
+  pair = numpy.repeat(numpy.arange(len(first)), shared)
+  offset = numpy.arange(shared.sum()) - numpy.repeat(numpy.cumsum(shared) - shared, shared)
+  distances = numpy.hypot(
+    *(points[starts[first][pair] + offset] - points[starts[second][pair] + offset]).T
+  )
+  mean_distance = numpy.bincount(pair, distances, len(first)) / shared
+
+  score = (
+    (1 - count_diff / 15) * 0.25
+    + (1 - length_diff / 100) * 0.25
+    + (1 - mean_distance / 200) * 0.5
+  )
+  similar = score > threshold
+  neighbours: dict[int, list[int]] = {}
+  for a, b in zip(first[similar].tolist(), second[similar].tolist()):
+    neighbours.setdefault(a, []).append(b)
+    neighbours.setdefault(b, []).append(a)
+
+  dropped: set[int] = set()
+  for index in sorted(neighbours):
+    if any(other not in dropped for other in neighbours[index]):
+      dropped.add(index)
+  return [index for index in range(len(polylines)) if index not in dropped]
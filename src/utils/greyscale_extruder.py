@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import tomllib
+from io import BytesIO
+
+import numpy
+from PIL import Image
+
+from utils.greyscale_utils import (
+  generate_supports,
+  identify_small_islands,
+  turn_bitmap_3d,
+)
+from utils.heightmap import heightmap_to_triangles
+from utils.mesh import count_open_edges, write_3mf, write_stl
+from utils.quantize import get_palette, quantize_image
+from utils.tracing import annotate, span
+
+LOG = logging.getLogger(__name__)
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  CHECK_MESHES = config.get("debug", {}).get("check_meshes", False)
+
+FORMATS = {
+  "stl": write_stl,
+  "3mf": write_3mf,
+}
+
+
+def get_pixel_size(
+  width: int, height: int, x: float = 0, y: float = 0
+) -> tuple[float, float]:
+  "Size of one pixel in mm. A size of 0 keeps the aspect ratio of the other."
+  if x and y:
+    return x / width, y / height
+  if x:
+    return x / width, x / width
+  if y:
+    return y / height, y / height
+  return 1, 1
+
+
+def png_to_heightmap(
+  png: bytes,
+  layers: int = 5,
+  *,
+  invert: bool = False,
+  island_threshold: int = 0,
+  dither: bool = False,
+) -> numpy.ndarray:
+  """Quantize a PNG into a 2D array of how many layers tall each pixel is.
+
+  Darker pixels are taller, as they let less light through when printed as
+  a lithophane. `invert` makes lighter pixels taller instead."""
+  bitmap = quantize_image(png, layers, dither=dither)
+  palette = numpy.asarray(get_palette(layers))
+  if invert:
+    bitmap = 255 - bitmap
+    palette = 255 - palette
+  bitmap_3d = turn_bitmap_3d(bitmap, numpy.sort(palette)[::-1])
+
+  if island_threshold:
+    removed = 0
+    for i, layer in enumerate(bitmap_3d):
+      bitmap_3d[i], report = identify_small_islands(layer, island_threshold, True)
+      removed += len(report)
+    if removed:
+      LOG.info(f"greyscale: removed {removed} small islands")
+    bitmap_3d = generate_supports(bitmap_3d)
+
+  return bitmap_3d.sum(axis=0, dtype=numpy.int32)
+
+
+def heightmap_to_model(
+  heights: numpy.ndarray,
+  layers: int,
+  z: float,
+  base: float,
+  pixel_size: tuple[float, float],
+  file_format: str = "stl",
+) -> bytes:
+  "Mesh a heightmap with `layers` levels, from `base` to `z` mm tall."
+  if layers > 1:
+    z_values = numpy.linspace(base, z, layers)
+  else:
+    z_values = numpy.array([z])
+  triangles = heightmap_to_triangles(heights, z_values, *pixel_size)
+  if CHECK_MESHES:
+    open_edges = count_open_edges(triangles)
+    if open_edges:
+      LOG.error(f"greyscale: mesh has {open_edges} open edges")
+  return FORMATS[file_format](triangles)
+
+
+async def png_to_greyscale(
+  png: bytes,
+  z: float,
+  x: float = 0,
+  y: float = 0,
+  *,
+  layers: int = 5,
+  base: float = 0.6,
+  invert: bool = False,
+  island_threshold: int = 0,
+  dither: bool = False,
+  file_format: str = "stl",
+) -> bytes:
+  """Turn a PNG into a lithophane style model, `layers` steps from `base`
+  to `z` mm thick, without tracing or OpenSCAD."""
+  if file_format not in FORMATS:
+    raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+  if layers < 1:
+    raise ValueError("layers must be at least 1")
+  if not 0 < base <= z:
+    raise ValueError("base must be above 0 and at most z")
+
+  width, height = Image.open(BytesIO(png)).size
+  pixel_size = get_pixel_size(width, height, x, y)
+
+  loop = asyncio.get_event_loop()
+  with span("quantize", stage="quantize", layers=layers):
+    heights = await loop.run_in_executor(
+      None,
+      lambda: png_to_heightmap(
+        png, layers, invert=invert, island_threshold=island_threshold,
+        dither=dither,
+      ),
+    )
+  with span("mesh", stage="mesh") as mesh_span:
+    model = await loop.run_in_executor(
+      None, heightmap_to_model, heights, layers, z, base, pixel_size, file_format
+    )
+    mesh_span.set(model_bytes=len(model))
+  annotate(width=width, height=height)
+  return model
@@ -0,0 +1,182 @@
+# Turn a 2D array of height levels straight into a closed triangle mesh.
+#
+# Every pixel is a flat topped column. Columns of the same height next to
+# each other in a row share one top face, and a wall is only made where two
+# neighbouring columns differ, so the triangle count follows the amount of
+# detail in the image rather than the number of pixels.
+#
+# Merged faces are split at every vertex of a neighbouring face that lands
+# on one of their edges, so there are no T-junctions: each edge is shared by
+# two triangles that run along it in opposite directions. The exception is
+# where two columns only touch at a corner, which then has four walls.
+from __future__ import annotations
+
+import numpy
+
+
+def get_runs(keys: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+  "Find the runs of equal values along each row. Returns (row, start, end) arrays."
+  rows, width = keys.shape
+  starts = numpy.ones(keys.shape, dtype=bool)
+  starts[:, 1:] = keys[:, 1:] != keys[:, :-1]
+  row, start = numpy.nonzero(starts)
+  end = numpy.empty_like(start)
+  end[:-1] = start[1:]
+  end[-1:] = width
+  # The last run of each row ends at the edge, not at the next row's start.
+  row_ends = numpy.append(row[1:] != row[:-1], True)
+  end[row_ends] = width
+  return row, start, end
+
+
+def make_triangles(*corners: tuple[numpy.ndarray, ...]) -> numpy.ndarray:
+  "Fill the three (x, y, level) corners of N triangles into an (N, 3, 3) array."
+  count = max(len(part) for corner in corners for part in corner if numpy.ndim(part))
+  triangles = numpy.empty((count, 3, 3), dtype=numpy.int32)
+  for index, corner in enumerate(corners):
+    for axis, part in enumerate(corner):
+      triangles[:, index, axis] = part
+  return triangles
+
+
+def split_side(
+  apex: tuple[numpy.ndarray, ...],
+  x: numpy.ndarray,
+  y: numpy.ndarray,
+  start: numpy.ndarray,
+  end: numpy.ndarray,
+  others: tuple[numpy.ndarray, numpy.ndarray],
+) -> numpy.ndarray:
+  """Fan the vertical side of N walls, from level `start` to `end` at corner
+  (x, y), out to the `apex` corner across the wall.
+
+  `others` are the levels of the two columns on the far side of the corner,
+  where other walls start and stop, so the side is split at them too."""
+  low = numpy.minimum(start, end)
+  high = numpy.maximum(start, end)
+  first = numpy.minimum(*others)
+  second = numpy.maximum(*others)
+  # Levels outside the side repeat the one below, leaving an empty step.
+  first = numpy.where((first > low) & (first < high), first, low)
+  second = numpy.where((second > first) & (second < high), second, first)
+  points = numpy.stack([low, first, second, high], axis=-1)
+  wall, step = numpy.nonzero(points[:, 1:] != points[:, :-1])
+  lower = points[wall, step]
+  upper = points[wall, step + 1]
+  # Walk the side in the direction it runs round the wall.
+  rising = (end > start)[wall]
+  return make_triangles(
+    tuple(part[wall] for part in apex),
+    (x[wall], y[wall], numpy.where(rising, lower, upper)),
+    (x[wall], y[wall], numpy.where(rising, upper, lower)),
+  )
+
+
+def heightmap_to_triangles(
+  heights: numpy.ndarray,
+  z_values: numpy.ndarray,
+  pixel_width: float = 1,
+  pixel_height: float = 1,
+) -> numpy.ndarray:
+  """Mesh a heightmap into an (N, 3, 3) array of outward facing triangles.
+
+  `heights` is a 2D integer array indexed [y, x] like an image, and
+  `z_values[level]` is the top of a column at that level. Row 0 of the image
+  ends up at the back of the model, so it is not mirrored when viewed from
+  above."""
+  heights = numpy.asarray(heights)[::-1]
+  rows, width = heights.shape
+  # Shift the levels up by one, so 0 can stand for the ground around the model.
+  z_lookup = numpy.concatenate([[0.0], numpy.asarray(z_values, dtype=numpy.float64)])
+  levels = heights.astype(numpy.int64) + 1
+  padded = numpy.pad(levels, 1)
+
+  # Top faces, one per run of equal height in a row
+  row, start, end = get_runs(levels)
+  run_ids = numpy.zeros(levels.shape, dtype=numpy.int64)
+  run_ids[row, start] = 1
+  run_ids = run_ids.cumsum().reshape(levels.shape) - 1
+
+  # Each line between two rows, including the front and back edges, is
+  # split wherever either row changes height. Those pieces are the edges of
+  # the top faces along the line, and of the walls between the rows.
+  below = padded[:-1, 1:-1]
+  above = padded[1:, 1:-1]
+  line, piece_start, piece_end = get_runs(below * (levels.max() + 1) + above)
+  below = below[line, piece_start]
+  above = above[line, piece_start]
+
+  # Each top is fanned from its back left corner over the pieces of its
+  # front edge, and from its front right corner over those of its back edge.
+  pieces = line < rows
+  top_line, first, last, level = line[pieces], piece_start[pieces], piece_end[pieces], above[pieces]
+  top = run_ids[top_line, first]
+  front_tops = make_triangles(
+    (first, top_line, level), (last, top_line, level), (start[top], top_line + 1, level),
+  )
+  pieces = line > 0
+  top_line, first, last, level = line[pieces], piece_start[pieces], piece_end[pieces], below[pieces]
+  top = run_ids[top_line - 1, first]
+  back_tops = make_triangles(
+    (end[top], top_line - 1, level), (last, top_line, level), (first, top_line, level),
+  )
+
+  # Walls between rows, including the outer front and back walls, one per
+  # piece of the line where the rows differ. Each faces the lower row.
+  steps = below != above
+  line, piece_start, piece_end = line[steps], piece_start[steps], piece_end[steps]
+  below, above = below[steps], above[steps]
+  y_walls = [
+    split_side(
+      (piece_start, line, below), piece_end, line, below, above,
+      (padded[line, piece_end + 1], padded[line + 1, piece_end + 1]),
+    ),
+    split_side(
+      (piece_end, line, above), piece_start, line, above, below,
+      (padded[line, piece_start], padded[line + 1, piece_start]),
+    ),
+  ]
+
+  # Walls between columns in the same row, including the outer left and
+  # right walls. The winding follows the sign of the step, so every wall
+  # faces towards the lower column.
+  row, edge = numpy.nonzero(padded[1:-1, :-1] != padded[1:-1, 1:])
+  left = padded[row + 1, edge]
+  right = padded[row + 1, edge + 1]
+  x_walls = [
+    split_side(
+      (edge, row, right), edge, row + 1, right, left,
+      (padded[row + 2, edge], padded[row + 2, edge + 1]),
+    ),
+    split_side(
+      (edge, row + 1, left), edge, row, left, right,
+      (padded[row, edge], padded[row, edge + 1]),
+    ),
+  ]
+
+  # The bottom is a fan around the outline, which has a corner wherever one
+  # of the outer walls does, so it meets them without any gaps.
+  front = numpy.unique(numpy.append(get_runs(levels[:1])[1], width))
+  back = numpy.unique(numpy.append(get_runs(levels[-1:])[1], width))[::-1]
+  side = numpy.arange(rows + 1)
+  outline = numpy.concatenate([
+    numpy.stack([front, numpy.zeros_like(front)], axis=-1)[:-1],
+    numpy.stack([numpy.full_like(side, width), side], axis=-1)[:-1],
+    numpy.stack([back, numpy.full_like(back, rows)], axis=-1)[:-1],
+    numpy.stack([numpy.zeros_like(side), side[::-1]], axis=-1)[:-1],
+  ]).astype(numpy.float64)
+  outline = numpy.concatenate([outline, numpy.zeros((len(outline), 1))], axis=-1)
+  centre = numpy.array([width / 2, rows / 2, 0])
+  bottom = numpy.stack(
+    numpy.broadcast_arrays(centre, numpy.roll(outline, -1, axis=0), outline),
+    axis=1,
+  )
+
+  corners = numpy.concatenate([front_tops, back_tops, *y_walls, *x_walls])
+  triangles = numpy.empty((len(corners) + len(bottom), 3, 3), dtype=numpy.float32)
+  for part, source in [(triangles[:len(corners)], corners), (triangles[len(corners):], bottom)]:
+    part[..., 0] = source[..., 0] * pixel_width
+    part[..., 1] = source[..., 1] * pixel_height
+  triangles[:len(corners), :, 2] = z_lookup[corners[..., 2]]
+  triangles[len(corners):, :, 2] = 0
+  return triangles
@@ -0,0 +1,168 @@
+# Decode an image once per job, and share its pixels between the stages
+from __future__ import annotations
+
+import io
+from typing import TYPE_CHECKING
+
+import numpy
+from PIL import Image
+
+from utils.cleanup import clean_labels
+from utils.layout import measure_labels, measure_mask, merge_boxes
+from utils.palette import (SKIPPED_COLOUR, get_palette, pack_rgb,
+                           parse_palette, reduce_colours, unpack_rgb)
+from utils.preprocess import downsample_image
+
+if TYPE_CHECKING:
+  from typing import Callable
+
+def mask_to_png(mask: numpy.ndarray) -> bytes:
+  "Encode a mask as a black on white PNG."
+  stream = io.BytesIO()
+  Image.fromarray(~mask).save(stream, "png", compress_level=1)
+  return stream.getvalue()
+
+
+class ChannelMask:
+  """A channel mask packed 8 pixels to a byte, with its bounding box.
+
+  The rows are laid out like a PBM raster, set bits being drawn pixels, so
+  `to_pbm` costs nothing but a header. The mask is only unpacked, or made
+  into an image, when something asks for it."""
+
+  bits: numpy.ndarray
+  width: int
+  height: int
+  box: dict[str, int]
+
+  def __init__(self, bits: numpy.ndarray, width: int, box: dict[str, int]) -> None:
+    self.bits = bits
+    self.width = width
+    self.height = bits.shape[0]
+    self.box = box
+
+  @classmethod
+  def from_mask(cls, mask: numpy.ndarray, box: dict[str, int] = None) -> ChannelMask:
+    "Pack a bool mask, measuring it unless its box is already known."
+    return cls(numpy.packbits(mask, axis=1), mask.shape[1], box or measure_mask(mask))
+
+  @property
+  def area(self) -> int:
+    return self.box["area"]
+
+  @property
+  def nbytes(self) -> int:
+    return self.bits.nbytes
+
+  def unpack(self) -> numpy.ndarray:
+    return numpy.unpackbits(self.bits, axis=1, count=self.width).view(bool)
+
+  def to_pbm(self) -> bytes:
+    "Encode the mask as a binary PBM, which potrace reads as it is."
+    return f"P4\n{self.width} {self.height}\n".encode() + self.bits.tobytes()
+
+  def to_image(self) -> Image.Image:
+    "Make a black on white image of the mask."
+    # Pillow's "1" mode has set bits white, so read them inverted.
+    return Image.frombytes("1", (self.width, self.height), self.bits.tobytes(), "raw", "1;I")
+
+  def to_png(self) -> bytes:
+    stream = io.BytesIO()
+    self.to_image().save(stream, "png", compress_level=1)
+    return stream.getvalue()
+
+
+class ImageContext:
+  """An image decoded once for a job, and the colour channels in it.
+
+  Stages share the decoded pixels and the channel masks made from them,
+  instead of each opening a PNG again. Once separated, only the bit-packed
+  channel masks are kept, and a channel is only encoded where an external
+  tool needs it as a file."""
+
+  pixels: numpy.ndarray | None
+  width: int
+  height: int
+  channels: list[str]
+  masks: dict[str, ChannelMask]
+
+  def __init__(self, pixels: numpy.ndarray) -> None:
+    self.pixels = pixels
+    self.height, self.width = pixels.shape[:2]
+    self.channels = []
+    self.masks = {}
+
+  @classmethod
+  def from_png(
+    cls, png_data: bytes, x: float = 0, y: float = 0, *, preserve_colours: bool = True
+  ) -> ImageContext:
+    "Decode a PNG, shrunk to the detail an `x` by `y` mm print can show."
+    image = Image.open(io.BytesIO(png_data))
+    image = downsample_image(image, x, y, preserve_colours=preserve_colours)
+    return cls(numpy.asarray(image.convert("RGBA")))
+
+  def drawn(self) -> numpy.ndarray:
+    "Get a mask of every pixel that isn't pure white."
+    return (self.pixels[..., :3] != 255).any(axis=-1)
+
+  def reduce_colours(self, colours: int = 0, palette: str | list[str] = None) -> None:
+    """Snap the pixels to a filament `palette`, or reduce them to the
+    `colours` that cover the image best, so anti-aliased edges don't each
+    become a channel of their own. Does nothing if neither is set."""
+    if palette:
+      chosen = parse_palette(palette)
+    elif colours:
+      chosen = get_palette(self.pixels, colours)
+    else:
+      return
+    self.pixels = reduce_colours(self.pixels, chosen)
+
+  def get_labels(self, match: Callable[[numpy.ndarray], list[str]]) -> tuple[numpy.ndarray, list[str]]:
+    """Label every pixel with the index of its channel, or -1 where no
+    channel is drawn. `match` names the channels of an (N, 3) array of
+    colours at once, and colours that match the same name share one."""
+    packed = pack_rgb(self.pixels[..., :3])
+    colours, inverse = numpy.unique(packed.ravel(), return_inverse=True)
+    names = match(unpack_rgb(colours))
+
+    channels: dict[str, int] = {}
+    lookup = numpy.full(len(colours), -1, dtype=numpy.int16)
+    for index, (colour, name) in enumerate(zip(colours.tolist(), names)):
+      if colour == SKIPPED_COLOUR:
+        continue
+      lookup[index] = channels.setdefault(name, len(channels))
+    return lookup[inverse].reshape(packed.shape), list(channels)
+
+  def separate(
+    self, match: Callable[[numpy.ndarray], list[str]], generate_background: bool = False,
+    *, cleanup: bool = False, x: float = 0, y: float = 0,
+  ) -> list[str]:
+    """Split the image into bit-packed channel masks, see `get_labels`.
+
+    With `cleanup`, fringe pixels go to the channel around them and islands
+    too small for an `x` by `y` mm print are removed first, see
+    `utils.cleanup`, and channels left with nothing drawn are dropped. A
+    "background" channel of everything drawn is added if
+    `generate_background` is set. The pixels aren't needed after this, so
+    they are dropped to keep only the masks in memory."""
+    labels, channels = self.get_labels(match)
+    self.pixels = None
+    if cleanup:
+      labels = clean_labels(labels, len(channels), x, y)
+    boxes = measure_labels(labels, len(channels))
+    self.masks = {
+      channel: ChannelMask.from_mask(labels == index, box)
+      for index, (channel, box) in enumerate(zip(channels, boxes))
+      if box["area"]
+    }
+    if generate_background:
+      self.masks["background"] = ChannelMask.from_mask(
+        labels >= 0, merge_boxes(boxes, self.width, self.height)
+      )
+    self.channels = list(self.masks)
+    return self.channels
+
+  def export(self, channel: str) -> tuple[bytes, dict[str, int]]:
+    "Get a channel as a PBM for the tools, and its bounding box."
+    mask = self.masks[channel]
+    return mask.to_pbm(), mask.box
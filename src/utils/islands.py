@@ -0,0 +1,41 @@
+# Connected component ("island") detection on boolean masks
+from __future__ import annotations
+
+import cv2
+import numpy
+
+
+def label_islands(
+  mask: numpy.ndarray, connectivity: int = 4
+) -> tuple[int, numpy.ndarray, numpy.ndarray]:
+  """Label the connected regions of a 2D mask.
+
+  Returns the number of labels (including 0, the background), the [y, x]
+  label array, and per-label stats as rows of [left, top, width, height,
+  area], indexed by label."""
+  if connectivity not in (4, 8):
+    raise ValueError("connectivity must be 4 or 8")
+  count, labels, stats, _ = cv2.connectedComponentsWithStats(
+    numpy.ascontiguousarray(mask, dtype=numpy.uint8),
+    connectivity=connectivity,
+    ltype=cv2.CV_32S,
+  )
+  return count, labels, stats
+
+
+def find_small_islands(
+  mask: numpy.ndarray, area_threshold: int, connectivity: int = 4
+) -> tuple[numpy.ndarray, list[dict[str, int]]]:
+  """Find islands of at most `area_threshold` pixels.
+
+  Returns a mask of the pixels belonging to small islands, and a report
+  with the bounding box and area of each of them."""
+  count, labels, stats = label_islands(mask, connectivity)
+  small = stats[:, cv2.CC_STAT_AREA] <= area_threshold
+  small[0] = False  # Label 0 is the background, not an island.
+
+  report = [
+    {"x": x, "y": y, "width": width, "height": height, "area": area}
+    for x, y, width, height, area in stats[small].tolist()
+  ]
+  return small[labels], report
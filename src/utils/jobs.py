@@ -8,12 +8,18 @@ import asyncio
 from asyncio import Queue
 from typing import TYPE_CHECKING
 
+from utils.cleanup import CLEANUP
 from utils.extruder import png_to_stl
+from utils.greyscale_extruder import png_to_greyscale
+from utils.metrics import CallbackMetric, registry
 from utils.multicolor_extruder import (
   png_to_3mf,
   png_to_backed3mf,
 )
-from utils.svg3 import png_to_svg
+from utils.png_stacker import pngs_to_stacked3mf
+from utils.simplify import get_quality
+from utils.tracers import get_tracer
+from utils.tracing import span
 
 if TYPE_CHECKING:
   from typing import Awaitable, Callable
@@ -41,6 +47,41 @@ last_worker_id: int = 0
 # }
 workers: dict[int, dict[str, asyncio.Task|str]] = {}
 
+
+def _queue_depth() -> dict[tuple, float]:
+  return {(): job_queue.qsize()}
+
+def _worker_counts() -> dict[tuple, float]:
+  idle = busy = 0
+  for worker in workers.values():
+    if worker is None or not worker["living"]:
+      continue
+    if worker.get("status", "idle") == "idle":
+      idle += 1
+    else:
+      busy += 1
+  return {("idle",): idle, ("busy",): busy}
+
+def _result_store() -> dict[tuple, float]:
+  size = 0
+  for result in jobs_done.values():
+    file = result.get("file")
+    if file is not None:
+      size += len(file)
+  return {("jobs",): len(jobs_done), ("bytes",): size}
+
+registry.register(CallbackMetric(
+  "extruder_job_queue_depth", "Jobs waiting for a worker.", _queue_depth
+))
+registry.register(CallbackMetric(
+  "extruder_job_workers", "Living job workers, by state.", _worker_counts,
+  ("state",),
+))
+registry.register(CallbackMetric(
+  "extruder_job_results", "Finished jobs waiting to be downloaded.",
+  _result_store, ("unit",),
+))
+
 async def submit_job(job_details: dict) -> None:
   await job_queue.put(job_details)
 
@@ -69,6 +110,15 @@ def get_completed_jobs() -> dict:
       output[k] = {"ok": v["ok"], "filename": v["filename"]}
   return output
 
+def get_job_trace(job_id: str) -> dict:
+  "Get the timing spans of a completed job, without removing it"
+  if job_id not in jobs_done:
+    return {
+      "ok": False,
+      "error": "job does not exist"
+    }
+  return {"ok": True, "trace": jobs_done[job_id].get("trace")}
+
 def complete_job(job_id: str) -> dict:
   "Retrive a job, and remove it from the list of completed jobs"
   if job_id not in jobs_done:
@@ -106,8 +156,9 @@ def details_checker(
 
 def decode_files(files: list[str]) -> list[bytes]:
   output = []
-  for file in files:
-    output.append(base64.b64decode(file))
+  with span("decode_files", files=len(files)):
+    for file in files:
+      output.append(base64.b64decode(file))
   return output
 
 
@@ -122,7 +173,10 @@ async def job_png_to_svg(details: dict) -> dict:
   decoded = decode_files(details["files"])
 
   try:
-    svg_data = await png_to_svg(decoded[0])
+    tracer = get_tracer(details["meta"].get("tracer"))
+    quality = get_quality(details["meta"].get("quality"))
+    with span("png_to_svg", stage="trace", tracer=tracer.name, quality=quality.name):
+      svg_data = await tracer.trace(decoded[0], quality=quality)
     return {"ok": True, "file": svg_data, "filename": details["meta"]["filename"]}
   except Exception as e:
     LOG.exception("png->svg: exception while converting")
@@ -141,7 +195,10 @@ async def job_png_to_stl(details: dict) -> dict:
   y = details["meta"]["y"]
   z = details["meta"]["z"]
   try:
-    stl_data = await png_to_stl(decoded[0], z, x, y)
+    stl_data = await png_to_stl(
+      decoded[0], z, x, y, tracer=details["meta"].get("tracer"),
+      quality=details["meta"].get("quality"),
+    )
     return {"ok": True, "file": stl_data, "filename": details["meta"]["filename"]}
   except Exception as e:
     LOG.exception("png->stl: exception while converting")
@@ -160,7 +217,13 @@ async def job_png_to_3mf(details: dict) -> dict:
   y = details["meta"]["y"]
   z = details["meta"]["z"]
   try:
-    tmf_data = await png_to_3mf(decoded[0], z, x, y)
+    tmf_data = await png_to_3mf(
+      decoded[0], z, x, y, tracer=details["meta"].get("tracer"),
+      quality=details["meta"].get("quality"),
+      colours=details["meta"].get("colours", 0),
+      palette=details["meta"].get("palette"),
+      cleanup=details["meta"].get("cleanup", CLEANUP),
+    )
     return {"ok": True, "file": tmf_data, "filename": details["meta"]["filename"]}
   except Exception as e:
     LOG.exception("png->3mf: exception while converting")
@@ -180,16 +243,71 @@ async def job_png_to_backed_3mf(details: dict) -> dict:
   z = details["meta"]["z"]
   black_thickness = details["meta"]["black_thickness"]
   try:
-    tmf_data = await png_to_backed3mf(decoded[0], z, x, y, black_thickness)
+    tmf_data = await png_to_backed3mf(
+      decoded[0], z, x, y, black_thickness, tracer=details["meta"].get("tracer"),
+      quality=details["meta"].get("quality"),
+      colours=details["meta"].get("colours", 0),
+      palette=details["meta"].get("palette"),
+      cleanup=details["meta"].get("cleanup", CLEANUP),
+    )
     return {"ok": True, "file": tmf_data, "filename": details["meta"]["filename"]}
   except Exception as e:
     LOG.exception("png->b3mf: exception while converting")
     return {"ok": False, "error": str(e), "filename": details["meta"]["filename"]}
 
 
+async def job_png_to_greyscale(details: dict) -> dict:
+  "Turn a PNG into a layered greyscale STL or 3MF"
+  verify = details_checker(details, "greyscale", ["x", "y", "z"])
+  if not verify["ok"]:
+    LOG.error("png->greyscale: failed details checker")
+    return verify
+
+  decoded = decode_files(details["files"])
+  meta = details["meta"]
+  try:
+    model_data = await png_to_greyscale(
+      decoded[0],
+      meta["z"],
+      meta["x"],
+      meta["y"],
+      layers=meta.get("layers", 5),
+      base=meta.get("base", 0.6),
+      invert=meta.get("invert", False),
+      island_threshold=meta.get("islands", 0),
+      dither=meta.get("dither", False),
+      file_format=meta.get("format", "stl"),
+    )
+    return {"ok": True, "file": model_data, "filename": meta["filename"]}
+  except Exception as e:
+    LOG.exception("png->greyscale: exception while converting")
+    return {"ok": False, "error": str(e), "filename": meta["filename"]}
+
+
 async def job_stacked_pngs_to_multicolour_3mf(details: dict) -> dict:
-  "Stack PNGs into a 3MF"
-  pass
+  "Stack PNGs into a 3MF, one file per layer starting from the bottom"
+  verify = details_checker(details, "stacked_3mf", ["x", "y", "z"])
+  if not verify["ok"]:
+    LOG.error("pngs->s3mf: failed details checker")
+    return verify
+
+  decoded = decode_files(details["files"])
+  x = details["meta"]["x"]
+  y = details["meta"]["y"]
+  z = details["meta"]["z"]
+  black_thickness = details["meta"].get("black_thickness", 0)
+  try:
+    tmf_data = await pngs_to_stacked3mf(
+      decoded, z, x, y, black_thickness, tracer=details["meta"].get("tracer"),
+      quality=details["meta"].get("quality"),
+      colours=details["meta"].get("colours", 0),
+      palette=details["meta"].get("palette"),
+      cleanup=details["meta"].get("cleanup", CLEANUP),
+    )
+    return {"ok": True, "file": tmf_data, "filename": details["meta"]["filename"]}
+  except Exception as e:
+    LOG.exception("pngs->s3mf: exception while converting")
+    return {"ok": False, "error": str(e), "filename": details["meta"]["filename"]}
 
 
 converters: dict[str, Callable[[dict, None], Awaitable[dict]]] = {
@@ -197,6 +315,7 @@ converters: dict[str, Callable[[dict, None], Awaitable[dict]]] = {
   "stl": job_png_to_stl,
   "3mf": job_png_to_3mf,
   "backed_3mf": job_png_to_backed_3mf,
+  "greyscale": job_png_to_greyscale,
   "stacked_3mf": job_stacked_pngs_to_multicolour_3mf
 }
 
@@ -219,7 +338,13 @@ async def job_consumer(worker_id: int):
         workers[worker_id]["status"] = f"{job['type']} / {job['meta']['filename']}"
       except Exception:
         workers[worker_id]["status"] = f"{job['type']} / unknown filename"
-      result = await converter(job)
+      with span("job", job_id=job_id, type=job["type"]) as job_span:
+        result = await converter(job)
+      if not isinstance(result, dict):
+        # A converter that returns nothing must not take the worker down.
+        LOG.error(f"Worker/#{worker_id}/{job_id}: {job['type']} returned {result!r}")
+        result = {"ok": False, "error": "converter returned no result"}
+      result["trace"] = job_span.to_dict()
       jobs_done[job_id] = result
     job_queue.task_done()
     LOG.info(f"Worker/#{worker_id}: return to idle")
@@ -0,0 +1,112 @@
+# Measure where each colour channel is drawn, and where it goes on the print
+from __future__ import annotations
+
+import numpy
+
+# Rows of the label array counted at a time, to bound the index arrays
+ROWS_PER_CHUNK = 256
+
+
+def empty_box(width: int, height: int) -> dict[str, int]:
+  "An inside out box for nothing drawn, left at the width and right at 0."
+  return {
+    "left": width, "right": 0, "top": height, "bottom": 0, "area": 0,
+    "cx": width / 2, "cy": height / 2, "width": width, "height": height,
+  }
+
+
+def measure_mask(mask: numpy.ndarray) -> dict[str, int]:
+  "Find the bounding box, area and centroid of the set pixels in a mask."
+  return measure_labels(mask.view(numpy.int8) - 1, 1)[0]
+
+
+def measure_labels(labels: numpy.ndarray, count: int) -> list[dict[str, int]]:
+  """Find the bounding box, area and centroid of every label at once.
+
+  `labels` holds a label from 0 to `count` - 1 for each pixel, or -1 for
+  none. Boxes are inclusive, in pixels, and "cx"/"cy" is the centroid."""
+  height, width = labels.shape
+  row_counts = numpy.zeros((height, count), dtype=numpy.int64)
+  column_counts = numpy.zeros((width, count), dtype=numpy.int64)
+  column_index = numpy.arange(width) * count
+
+  for top in range(0, height, ROWS_PER_CHUNK):
+    chunk = labels[top:top + ROWS_PER_CHUNK]
+    rows = len(chunk)
+    valid = chunk >= 0
+    keys = chunk.astype(numpy.int64)
+    # Count each label per row, and per column, in one bincount each.
+    row_keys = (keys + (numpy.arange(rows) * count)[:, None])[valid]
+    row_counts[top:top + rows] = numpy.bincount(
+      row_keys, minlength=rows * count
+    ).reshape(rows, count)
+    column_keys = (keys + column_index)[valid]
+    column_counts += numpy.bincount(
+      column_keys, minlength=width * count
+    ).reshape(width, count)
+
+  area = column_counts.sum(axis=0)
+  rows_drawn = row_counts > 0
+  columns_drawn = column_counts > 0
+  top = rows_drawn.argmax(axis=0)
+  bottom = height - 1 - rows_drawn[::-1].argmax(axis=0)
+  left = columns_drawn.argmax(axis=0)
+  right = width - 1 - columns_drawn[::-1].argmax(axis=0)
+  safe_area = numpy.maximum(area, 1)
+  cx = (column_counts * numpy.arange(width)[:, None]).sum(axis=0) / safe_area
+  cy = (row_counts * numpy.arange(height)[:, None]).sum(axis=0) / safe_area
+
+  boxes = []
+  for label in range(count):
+    if not area[label]:
+      boxes.append(empty_box(width, height))
+      continue
+    boxes.append({
+      "left": int(left[label]),
+      "right": int(right[label]),
+      "top": int(top[label]),
+      "bottom": int(bottom[label]),
+      "area": int(area[label]),
+      "cx": float(cx[label]),
+      "cy": float(cy[label]),
+      "width": width,
+      "height": height,
+    })
+  return boxes
+
+
+def merge_boxes(boxes: list[dict[str, int]], width: int, height: int) -> dict[str, int]:
+  "Get the box of several labels together, like a background of all of them."
+  drawn = [box for box in boxes if box["area"]]
+  if not drawn:
+    return empty_box(width, height)
+  area = sum(box["area"] for box in drawn)
+  return {
+    "left": min(box["left"] for box in drawn),
+    "right": max(box["right"] for box in drawn),
+    "top": min(box["top"] for box in drawn),
+    "bottom": max(box["bottom"] for box in drawn),
+    "area": area,
+    "cx": sum(box["cx"] * box["area"] for box in drawn) / area,
+    "cy": sum(box["cy"] * box["area"] for box in drawn) / area,
+    "width": width,
+    "height": height,
+  }
+
+
+def get_placement(box: dict[str, int], x: float, y: float) -> dict[str, float]:
+  """Place a channel on a print `x` by `y` mm.
+
+  Returns its drawn size in mm, and the offset of the middle of its box
+  from the middle of the image in mm ("ox", "oy", with y pointing up, as
+  in OpenSCAD), along with the box itself."""
+  width, height = box["width"], box["height"]
+  middle_x = (box["right"] + box["left"]) / 2
+  middle_y = (box["top"] + box["bottom"]) / 2
+  return {
+    **box,
+    "x": x * (box["right"] - box["left"]) / width,
+    "y": y * (box["bottom"] - box["top"]) / height,
+    "ox": (middle_x - width / 2) * x / width,
+    "oy": (height / 2 - middle_y) * y / height,
+  }
@@ -12,6 +12,7 @@ from aiohttp.web import Response
 
 from utils.authenticate import authenticate
 from utils.logger import get_origin_ip
+from utils.metrics import RATELIMIT_REJECTIONS
 
 if TYPE_CHECKING:
   from ipaddress import IPv4Address
@@ -187,7 +188,8 @@ class Limiter:
         )
         if not hasattr(user, "username"):
           if force_auth:
-            return Response(status=401)
+            # Pass on why, so an auth outage isn't reported as a bad token.
+            return user if isinstance(user, Response) else Response(status=401)
           else:
             ident = None
         else:
@@ -220,6 +222,7 @@ class Limiter:
       # calculate next free
       current_time = int(time.time())
       time_until_free = user_limits[0] - current_time
+      RATELIMIT_REJECTIONS.inc(route_name)
       return Response(status=429, headers={"Retry-After": str(time_until_free)})
     else:
       # add current request to window, return None
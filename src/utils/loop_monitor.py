@@ -0,0 +1,167 @@
+# Event loop lag measurement and blocking call detection
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from asyncio import AbstractEventLoop
+
+LOG = logging.getLogger(__name__)
+
+# Frames from files under here are reported as the likely culprit of a stall.
+SOURCE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LoopMonitor:
+  """Measure how late the event loop wakes up, and catch what blocks it.
+
+  A heartbeat coroutine sleeps for `interval` seconds and records how much
+  longer than that it actually took. A watchdog thread samples the loop
+  thread's stack whenever the heartbeat is more than `threshold` seconds
+  overdue, so a stall is recorded with where it was spent."""
+
+  def __init__(
+    self,
+    *,
+    interval: float = 0.05,
+    threshold: float = 0.1,
+    history: int = 1200,
+    max_stalls: int = 100,
+    max_samples: int = 50,
+  ) -> None:
+    self.interval = interval
+    self.threshold = threshold
+    self.max_samples = max_samples
+    self.lags: deque[float] = deque(maxlen=history)
+    self.stalls: deque[dict] = deque(maxlen=max_stalls)
+    self.total_stalls = 0
+    self.max_lag = 0.0
+    self.last_beat = time.monotonic()
+    self.loop_thread_id: int | None = None
+    self.task: asyncio.Task | None = None
+    self.thread: threading.Thread | None = None
+    self.running = False
+    # Stack samples of the stall currently in progress
+    self._samples: list[tuple[str, ...]] = []
+    self._stall_started: float | None = None
+
+  def start(self, loop: AbstractEventLoop = None) -> None:
+    if self.running:
+      return
+    if loop is None:
+      loop = asyncio.get_event_loop()
+    self.running = True
+    self.loop_thread_id = threading.get_ident()
+    self.last_beat = time.monotonic()
+    self.task = loop.create_task(self._heartbeat())
+    self.thread = threading.Thread(
+      target=self._watchdog, name="loop-monitor", daemon=True
+    )
+    self.thread.start()
+
+  def stop(self) -> None:
+    self.running = False
+    if self.task is not None:
+      self.task.cancel()
+
+  async def _heartbeat(self) -> None:
+    while self.running:
+      before = time.monotonic()
+      await asyncio.sleep(self.interval)
+      now = time.monotonic()
+      lag = max(now - before - self.interval, 0.0)
+      self.lags.append(lag)
+      if lag > self.max_lag:
+        self.max_lag = lag
+      self.last_beat = now
+      if lag >= self.threshold:
+        self._finish_stall(lag)
+
+  def _watchdog(self) -> None:
+    period = min(self.threshold / 2, self.interval)
+    while self.running:
+      time.sleep(period)
+      overdue = time.monotonic() - self.last_beat - self.interval
+      if overdue < self.threshold:
+        continue
+      if self._stall_started is None:
+        self._stall_started = self.last_beat
+        self._samples = []
+      if len(self._samples) < self.max_samples:
+        stack = self._sample_stack()
+        if stack:
+          self._samples.append(stack)
+
+  def _sample_stack(self) -> tuple[str, ...]:
+    frame = sys._current_frames().get(self.loop_thread_id)
+    if frame is None:
+      return ()
+    return tuple(
+      f"{summary.filename}:{summary.lineno} in {summary.name}"
+      for summary in traceback.extract_stack(frame)
+    )
+
+  def _finish_stall(self, lag: float) -> None:
+    samples = self._samples
+    self._samples = []
+    self._stall_started = None
+
+    stacks = Counter(samples).most_common()
+    culprit = None
+    if stacks:
+      culprit = get_culprit(stacks[0][0])
+
+    stall = {
+      "time": time.time(),
+      "duration_ms": round(lag * 1000, 2),
+      "culprit": culprit,
+      "samples": [
+        {"count": count, "stack": list(stack)} for stack, count in stacks
+      ],
+    }
+    self.stalls.append(stall)
+    self.total_stalls += 1
+    LOG.warning(
+      f"event loop blocked for {stall['duration_ms']}ms"
+      f" (in {culprit or 'unknown, stall was shorter than a sample'})"
+    )
+
+  def get_stats(self) -> dict:
+    lags = sorted(self.lags)
+    if lags:
+      mean = sum(lags) / len(lags)
+      p50 = lags[len(lags) // 2]
+      p99 = lags[min(int(len(lags) * 0.99), len(lags) - 1)]
+    else:
+      mean = p50 = p99 = 0.0
+    return {
+      "running": self.running,
+      "interval_ms": self.interval * 1000,
+      "threshold_ms": self.threshold * 1000,
+      "current_lag_ms": round(self.lags[-1] * 1000, 3) if lags else 0.0,
+      "mean_lag_ms": round(mean * 1000, 3),
+      "p50_lag_ms": round(p50 * 1000, 3),
+      "p99_lag_ms": round(p99 * 1000, 3),
+      "max_lag_ms": round(self.max_lag * 1000, 3),
+      "total_stalls": self.total_stalls,
+      "stalls": list(self.stalls),
+    }
+
+
+def get_culprit(stack: tuple[str, ...]) -> str | None:
+  "Find the innermost frame of a stack that belongs to this project."
+  for line in reversed(stack):
+    if line.startswith(SOURCE_ROOT) and __file__ not in line:
+      return line.removeprefix(SOURCE_ROOT).lstrip("/")
+  return stack[-1] if stack else None
+
+
+monitor = LoopMonitor()
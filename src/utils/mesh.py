@@ -0,0 +1,133 @@
+# Write triangle meshes as STL or 3MF without going through OpenSCAD
+from __future__ import annotations
+
+import io
+import zipfile
+
+import numpy
+
+STL_DTYPE = numpy.dtype([
+  ("normal", "<f4", (3,)),
+  ("vertices", "<f4", (3, 3)),
+  ("attributes", "<u2"),
+])
+
+THREEMF_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+  <Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+  <Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>
+</Types>
+"""
+
+THREEMF_RELS = """<?xml version="1.0" encoding="UTF-8"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+  <Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>
+</Relationships>
+"""
+
+THREEMF_MODEL_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<model unit="millimeter" xml:lang="en-US" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">
+  <resources>
+    <object id="1" type="model">
+      <mesh>
+        <vertices>
+"""
+
+THREEMF_MODEL_MIDDLE = """        </vertices>
+        <triangles>
+"""
+
+THREEMF_MODEL_FOOTER = """        </triangles>
+      </mesh>
+    </object>
+  </resources>
+  <build>
+    <item objectid="1"/>
+  </build>
+</model>
+"""
+
+
+def get_normals(triangles: numpy.ndarray) -> numpy.ndarray:
+  "Unit normals of an (N, 3, 3) triangle array, following the winding order."
+  normals = numpy.cross(
+    triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+  )
+  lengths = numpy.linalg.norm(normals, axis=1, keepdims=True)
+  lengths[lengths == 0] = 1
+  return normals / lengths
+
+
+def write_stl(triangles: numpy.ndarray, name: str = "extruded") -> bytes:
+  "Write an (N, 3, 3) triangle array as a binary STL."
+  records = numpy.zeros(len(triangles), dtype=STL_DTYPE)
+  records["normal"] = get_normals(triangles)
+  records["vertices"] = triangles
+  header = name.encode()[:80].ljust(80, b" ")
+  count = numpy.array([len(triangles)], dtype="<u4").tobytes()
+  return header + count + records.tobytes()
+
+
+def index_triangles(
+  triangles: numpy.ndarray,
+) -> tuple[numpy.ndarray, numpy.ndarray]:
+  "Split an (N, 3, 3) triangle array into unique vertices and vertex indexes."
+  flat = numpy.ascontiguousarray(triangles.reshape(-1, 3))
+  # Comparing each vertex as one opaque 12 byte value is much faster than
+  # numpy.unique(axis=0), which sorts column by column.
+  keys = flat.view(numpy.dtype((numpy.void, flat.itemsize * 3))).ravel()
+  _, first, indexes = numpy.unique(keys, return_index=True, return_inverse=True)
+  return flat[first], indexes.reshape(-1, 3)
+
+
+def format_rows(fmt: str, rows: numpy.ndarray) -> str:
+  stream = io.StringIO()
+  numpy.savetxt(stream, rows, fmt=fmt)
+  return stream.getvalue()
+
+
+def write_3mf(triangles: numpy.ndarray) -> bytes:
+  "Write an (N, 3, 3) triangle array as a single object 3MF file."
+  vertices, indexes = index_triangles(triangles)
+  model = io.StringIO()
+  model.write(THREEMF_MODEL_HEADER)
+  model.write(format_rows(
+    '          <vertex x="%.4f" y="%.4f" z="%.4f"/>', vertices
+  ))
+  model.write(THREEMF_MODEL_MIDDLE)
+  model.write(format_rows(
+    '          <triangle v1="%d" v2="%d" v3="%d"/>', indexes
+  ))
+  model.write(THREEMF_MODEL_FOOTER)
+
+  stream = io.BytesIO()
+  with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+    archive.writestr("[Content_Types].xml", THREEMF_CONTENT_TYPES)
+    archive.writestr("_rels/.rels", THREEMF_RELS)
+    archive.writestr("3D/3dmodel.model", model.getvalue())
+  return stream.getvalue()
+
+
+def get_volume(triangles: numpy.ndarray) -> float:
+  "Signed volume enclosed by a closed, outward facing mesh."
+  return float(numpy.einsum(
+    "ij,ij->i",
+    triangles[:, 0],
+    numpy.cross(triangles[:, 1], triangles[:, 2]),
+  ).sum() / 6)
+
+
+def count_open_edges(triangles: numpy.ndarray) -> int:
+  """Count the edges of a mesh that no other triangle runs back along.
+
+  Every directed edge of a closed, consistently wound mesh has a reverse,
+  so this is 0 for a mesh that slicers won't need to repair."""
+  _, indexes = index_triangles(triangles)
+  start = indexes.ravel()
+  end = indexes[:, [1, 2, 0]].ravel()
+  count = int(indexes.max()) + 1
+  edges, edge_counts = numpy.unique(start * count + end, return_counts=True)
+  reverses, reverse_counts = numpy.unique(end * count + start, return_counts=True)
+  found = numpy.searchsorted(reverses, edges).clip(max=len(reverses) - 1)
+  matched = numpy.where(reverses[found] == edges, reverse_counts[found], 0)
+  return int(numpy.abs(edge_counts - matched).sum())
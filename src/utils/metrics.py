@@ -0,0 +1,226 @@
+# Minimal Prometheus text format metrics
+from __future__ import annotations
+
+import bisect
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Callable, Iterator
+
+  LabelValues = tuple[str, ...]
+
+# Buckets in seconds, from a fast API call up to a huge multicolour render.
+DEFAULT_BUCKETS = (
+  0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+
+def format_labels(names: tuple[str, ...], values: LabelValues) -> str:
+  if not names:
+    return ""
+  pairs = []
+  for name, value in zip(names, values):
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    escaped = escaped.replace("\n", "\\n")
+    pairs.append(f'{name}="{escaped}"')
+  return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value: float) -> str:
+  if value == float("inf"):
+    return "+Inf"
+  if float(value).is_integer():
+    return str(int(value))
+  return repr(float(value))
+
+
+class Metric:
+  type: str = "untyped"
+
+  def __init__(
+    self, name: str, description: str, labels: tuple[str, ...] = ()
+  ) -> None:
+    self.name = name
+    self.description = description
+    self.label_names = tuple(labels)
+
+  def header(self) -> list[str]:
+    return [
+      f"# HELP {self.name} {self.description}",
+      f"# TYPE {self.name} {self.type}",
+    ]
+
+  def render(self) -> list[str]:
+    raise NotImplementedError
+
+
+class Counter(Metric):
+  type = "counter"
+
+  def __init__(
+    self, name: str, description: str, labels: tuple[str, ...] = ()
+  ) -> None:
+    super().__init__(name, description, labels)
+    self.values: dict[LabelValues, float] = {}
+
+  def inc(self, *labels: str, amount: float = 1) -> None:
+    self.values[labels] = self.values.get(labels, 0) + amount
+
+  def render(self) -> list[str]:
+    lines = self.header()
+    for labels, value in self.values.items():
+      lines.append(
+        f"{self.name}{format_labels(self.label_names, labels)} "
+        f"{format_value(value)}"
+      )
+    return lines
+
+
+class Gauge(Counter):
+  type = "gauge"
+
+  def set(self, *labels: str, value: float) -> None:
+    self.values[labels] = value
+
+
+class CallbackMetric(Metric):
+  "A metric whose values are computed when it is scraped."
+
+  def __init__(
+    self,
+    name: str,
+    description: str,
+    callback: Callable[[], dict[LabelValues, float]],
+    labels: tuple[str, ...] = (),
+    *,
+    type: str = "gauge",
+  ) -> None:
+    super().__init__(name, description, labels)
+    self.callback = callback
+    self.type = type
+
+  def render(self) -> list[str]:
+    lines = self.header()
+    for labels, value in self.callback().items():
+      lines.append(
+        f"{self.name}{format_labels(self.label_names, labels)} "
+        f"{format_value(value)}"
+      )
+    return lines
+
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(
+    self,
+    name: str,
+    description: str,
+    labels: tuple[str, ...] = (),
+    *,
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+  ) -> None:
+    super().__init__(name, description, labels)
+    self.buckets = tuple(sorted(buckets))
+    # labels -> [per-bucket counts (not cumulative), sum, count]
+    self.values: dict[LabelValues, list] = {}
+
+  def observe(self, *labels: str, value: float) -> None:
+    entry = self.values.get(labels)
+    if entry is None:
+      entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+      self.values[labels] = entry
+    entry[0][bisect.bisect_left(self.buckets, value)] += 1
+    entry[1] += value
+    entry[2] += 1
+
+  @contextmanager
+  def time(self, *labels: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(*labels, value=time.perf_counter() - start)
+
+  def render(self) -> list[str]:
+    lines = self.header()
+    bucket_names = self.label_names + ("le",)
+    for labels, (counts, total, count) in self.values.items():
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+        cumulative += bucket_count
+        bucket_labels = format_labels(
+          bucket_names, labels + (format_value(bound),)
+        )
+        lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+      label_str = format_labels(self.label_names, labels)
+      lines.append(f"{self.name}_sum{label_str} {format_value(total)}")
+      lines.append(f"{self.name}_count{label_str} {count}")
+    return lines
+
+
+class Registry:
+  def __init__(self) -> None:
+    self.metrics: dict[str, Metric] = {}
+
+  def register(self, metric: Metric) -> Metric:
+    self.metrics[metric.name] = metric
+    return metric
+
+  def render(self) -> str:
+    lines = []
+    for metric in self.metrics.values():
+      lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS: Histogram = registry.register(Histogram(
+  "extruder_http_request_duration_seconds",
+  "Time taken to handle HTTP requests, by route.",
+  ("method", "route", "status"),
+))
+STAGE_SECONDS: Histogram = registry.register(Histogram(
+  "extruder_stage_duration_seconds",
+  "Time taken by each conversion pipeline stage.",
+  ("stage",),
+))
+SUBPROCESSES: Counter = registry.register(Counter(
+  "extruder_subprocesses_total",
+  "External tools run, by tool and exit code.",
+  ("tool", "exit_code"),
+))
+RATELIMIT_REJECTIONS: Counter = registry.register(Counter(
+  "extruder_ratelimit_rejections_total",
+  "Requests rejected by the rate limiter, by route.",
+  ("route",),
+))
+
+# cache name -> the cache's own stats dict, e.g. {"hits": 1, "misses": 2}
+watched_caches: dict[str, dict[str, int]] = {}
+
+
+def watch_cache(name: str, stats: dict[str, int]) -> None:
+  "Export a cache's stats dict. It is read in place on every scrape."
+  watched_caches[name] = stats
+
+
+def _cache_requests() -> dict[LabelValues, float]:
+  output = {}
+  for cache, stats in watched_caches.items():
+    for result, count in stats.items():
+      output[(cache, result)] = count
+  return output
+
+
+CACHE_REQUESTS: CallbackMetric = registry.register(CallbackMetric(
+  "extruder_cache_requests_total",
+  "Cache lookups, by cache and result.",
+  _cache_requests,
+  ("cache", "result"),
+  type="counter",
+))
+
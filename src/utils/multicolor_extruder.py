@@ -1,13 +1,23 @@
-from PIL import Image
 import aiofiles.os
-import concurrent.futures
-import time
-import io
 import random
 import logging
 import asyncio
+import functools
+from typing import Callable
+
+import numpy
 
 from utils.extruder import png_to_stl
+from utils.tools import get_executor, run_tool
+from utils.image_context import ImageContext
+from utils.layout import get_placement
+from utils.cleanup import CLEANUP
+from utils.palette import (MATCH_CHUNK, check_options, colour_histogram,
+                           parse_palette, unpack_rgb)
+from utils.simplify import get_quality
+from utils.stage_cache import digest, stage_cache
+from utils.tracers import get_tracer
+from utils.tracing import annotate, span
 import aiofiles
 
 LOG = logging.getLogger(__name__)
@@ -172,31 +182,32 @@ for name,hex in OPENSCAD_COLOURS.items():
   g = int(hex[2:4], 16)
   b = int(hex[4:6], 16)
   rgb_openscad_colours[(r, g, b, )] = name
+# The distance along each channel from every value to every named colour,
+# in dict order, so colours are matched with lookups instead of arithmetic
+openscad_names = list(rgb_openscad_colours.values())
+openscad_distances = numpy.abs(
+  numpy.arange(256)[None, :, None] - numpy.array(list(rgb_openscad_colours)).T[:, None, :]
+).astype(numpy.int16)
+
+def get_closest_matches(colours: numpy.ndarray) -> list[str]:
+  "Get the human name of the closest colour to each of an (N, 3) array of RGB colours"
+  colours = colours.astype(numpy.uint8)
+  nearest = numpy.empty(len(colours), dtype=numpy.intp)
+  for start in range(0, len(colours), MATCH_CHUNK):
+    chunk = colours[start:start + MATCH_CHUNK]
+    # Manhattan Distance, the first of any ties wins
+    distances = openscad_distances[0][chunk[:, 0]]
+    distances += openscad_distances[1][chunk[:, 1]]
+    distances += openscad_distances[2][chunk[:, 2]]
+    nearest[start:start + MATCH_CHUNK] = distances.argmin(axis=1)
+  return [openscad_names[index] for index in nearest]
 
 def get_closest_match(source: str) -> str:
   "Get the closest colour to the source hex, return the human name of it"
-  if source in openscad_colour_cache:
-    return openscad_colour_cache[source]
-  sr = int(source[0:2], 16)
-  sg = int(source[2:4], 16)
-  sb = int(source[4:6], 16)
-
-  # Manhattan Distance
-  def distance(col1, col2):
-    return sum(abs(c1 - c2) for c1, c2 in zip(col1, col2))
-
-  lowest_distance = float("inf")
-  source_colour = [sr,sg,sb]
-  closest_colour = []
-  for colour in rgb_openscad_colours.keys():
-    dist = distance(colour, source_colour)
-    if dist < lowest_distance:
-      closest_colour = colour
-      lowest_distance = dist
-
-  openscad_colour_cache[source] = rgb_openscad_colours[closest_colour]
-
-  return rgb_openscad_colours[closest_colour]
+  if source not in openscad_colour_cache:
+    rgb = numpy.array([[int(source[i:i + 2], 16) for i in (0, 2, 4)]])
+    openscad_colour_cache[source] = get_closest_matches(rgb)[0]
+  return openscad_colour_cache[source]
 
 
 # models dict should have `filepath`, `colour`, and `offset_x` and `offset_y`
@@ -260,98 +271,48 @@ combined_model();"""
 
   return script
 
-def identify_colours(png_data: bytes) -> dict[str, str]:
-  "Identify individual colours and match their names in a dict of hex: name"
-  png_bytesio = io.BytesIO(png_data)
-  img = Image.open(png_bytesio).convert("RGBA")
-
-  # get hex colors
-  colour_counts = img.getcolors(img.size[0] * img.size[1])
-  LOG.info("got total colours in the image)")
-
-  hex_colours: dict[str, str] = {}
-  for count, rgba in colour_counts:
-    r, g, b, a = rgba
-    hex_value = f"{r:02x}{g:02x}{b:02x}"
-    if hex_value == "fefefe":
-      continue
-    human_colour = get_closest_match(hex_value)
-    hex_colours[hex_value] = human_colour
-  
+def identify_colours(
+  png_data: bytes, *, colours: int = 0, palette: str = None, coverage: bool = False,
+  max_samples: int = 0,
+) -> dict[str, str] | dict[str, dict]:
+  """Identify individual colours and match their names in a dict of hex: name,
+  most common first.
+
+  With `coverage` each hex maps to {"name", "coverage"} instead, coverage
+  being the fraction of the counted pixels that colour covers. Every pixel
+  is counted, unless `max_samples` is set, when bigger images are counted
+  from an even sample. That is faster, but can miss colours that only
+  cover a few pixels, which `separate` would still make channels for."""
+  context = ImageContext.from_png(png_data)
+  if colours or palette:
+    # Show the colours that will be separated after reducing them
+    context.reduce_colours(colours, palette)
+
+  packed, counts = colour_histogram(context.pixels, max_samples)
+  LOG.info(f"got {len(packed)} colours in the image")
+  order = numpy.argsort(counts, kind="stable")[::-1]
+  packed, counts = packed[order], counts[order]
+  names = get_closest_matches(unpack_rgb(packed))
+  total = max(int(counts.sum()), 1)
+
+  hex_colours = {}
+  for colour, count, name in zip(packed.tolist(), counts.tolist(), names):
+    if coverage:
+      hex_colours[f"{colour:06x}"] = {"name": name, "coverage": count / total}
+    else:
+      hex_colours[f"{colour:06x}"] = name
   return hex_colours
 
-  
 
 def separate_png(png_data: bytes, generate_background: bool = False) -> dict[str, bytes]:
   "Separate a PNG into separate PNGs by colour"
 
-  "The dict will be hex:png_bytes, where hex is just FFFFFF, and the png_bytes is a black and white image for the svg converter"
+  "The dict will be name:png_bytes, where the png_bytes is a black and white image for the svg converter"
   LOG.info("Converting multicolour image into separate colour images")
-  png_bytesio = io.BytesIO(png_data)
-  img = Image.open(png_bytesio).convert("RGBA")
-
-  # get hex colors
-  color_counts = img.getcolors(img.size[0] * img.size[1])
-  LOG.info("got total colours in the image)")
-
-  hex_colours: set[str] = set()
-  for count, rgba in color_counts:
-    r, g, b, a = rgba
-    hex_value = f"{r:02x}{g:02x}{b:02x}"
-    if hex_value == "fefefe":
-      continue
-    human_colour = get_closest_match(hex_value)
-    hex_colours.add(human_colour)
-
-  pixels = img.load()
-  width, height = img.size
-
-  outputs = {}
-  for color in hex_colours:
-    LOG.info(color)
-    outputs[color] = Image.new(
-      "RGBA", (width, height), color=(255, 255, 255, 255)
-    )
-    outputs[color].pixels = outputs[color].load()
-  if generate_background:
-    outputs["background"] = Image.new("RGBA", (width, height), color=(255,255,255,255))
-
-  LOG.info(f"made {len(outputs.keys())} image objects for each colour")
-
-  last_time = time.time()
-  last_pixels = 0
-  for y in range(height):
-    for x in range(width):
-      last_pixels += 1
-      if (time.time() - last_time) > 1:
-        last_time = time.time()
-        LOG.info(f"processed {last_pixels} in 1 second")
-        LOG.info(f"processed {y*width+x}/{width*height} ({round((y*width+x)/(width*height)*100,1)}%) pixels")
-        remaining_pixels = (width*height) - (y*width+x)
-        eta = round(remaining_pixels/last_pixels, 1)
-        LOG.info(f"ETA: {eta}s")
-        last_pixels = 0
-      rgba = pixels[x, y]
-      r, g, b, a = rgba
-      hex_value = f"{r:02x}{g:02x}{b:02x}"
-      if hex_value == "fefefe":
-        continue
-      human_colour = get_closest_match(hex_value)
-      outputs[human_colour].putpixel((x, y), (0, 0, 0, 255))
-      if generate_background:
-        outputs["background"].putpixel((x, y), (0, 0, 0, 255))
-
-  LOG.info("separated each colour channel")
-
-  output_pngs = {}
-  for color, img in outputs.items():
-    stream = io.BytesIO()
-    img.save(stream, "png")
-    output_pngs[color] = stream.getvalue()
-
-  LOG.info("saved each colour channel")
-
-  return output_pngs
+  context = ImageContext.from_png(png_data)
+  context.separate(get_closest_matches, generate_background)
+  LOG.info(f"separated {len(context.channels)} colour channels")
+  return {channel: context.masks[channel].to_png() for channel in context.channels}
 
 
 def make_id() -> str:
@@ -387,68 +348,24 @@ combined_model();"""
 
 
 async def generate_multicolour_part(
-  images: dict[str, bytes], z: float, x: float = 0, y: float = 0
+  context: ImageContext, z: float, x: float = 0, y: float = 0, *, tracer: str = None, quality: str = None
 ) -> bytes:
-  "Take multiple images by hexadecimal colour, and output a 3MF file."
+  "Take an image separated into colour channels, and output a 3MF file."
   coloured_stls: dict[str, bytes] = {}
   # based off of the center of each image
   sizes: dict[str, dict[str, int]] = {}  # The real
-  # Convert each image to an STL
-  for colour, image in images.items():
+  # Convert each channel to an STL
+  for colour in context.channels:
     LOG.info(f"getting data for {colour} channel")
+    image, box = context.export(colour)
     try:
-      coloured_stls[colour] = await png_to_stl(image, z, x, y, size_based_on_total_image_size=True, error_empty_svg=True)
+      with span("png_to_stl", colour=colour):
+        coloured_stls[colour] = await png_to_stl(image, z, x, y, size_based_on_total_image_size=True, error_empty_svg=True, tracer=tracer, quality=quality, box=box)
     except ValueError:
       coloured_stls[colour] = "SKIPPED"
       continue
-    png_buffer = io.BytesIO(image)
-    img = Image.open(png_buffer)
-    img.convert("L")
-    width, height = img.size
-    top = height
-    bottom = 0
-    left = width
-    right = 0
-
-    pixels = img.load()
-
-    area = 0
-
-    for image_y in range(height):
-      for image_x in range(width):
-        r, g, b, a = pixels[image_x, image_y]
-        if r * g * b != 255 * 255 * 255:
-          area += 1
-          # This pixel is something other than white, mark it.
-          if image_y > bottom:
-            bottom = image_y
-          if image_x > right:
-            right = image_x
-          if image_y < top:
-            top = image_y
-          if image_x < left:
-            left = image_x
-
     # Now insert these into the sizes for postprocessing
-    center_x = (right + left) / 2
-    center_y = (top + bottom) / 2
-
-    height_dpmm = (height / y)
-    width_dpmm = (width / x)
-
-    offset_x = -(((width / 2) - center_x) / width_dpmm)
-    offset_y = ((height / 2) - center_y) / height_dpmm
-    sizes[colour] = {
-      "left": left,
-      "right": right,
-      "top": top,
-      "bottom": bottom,
-      "cx": center_x,
-      "cy": center_y,
-      "ox": offset_x,
-      "oy": offset_y,
-      "area": area
-    }
+    sizes[colour] = get_placement(box, x, y)
 
   job_id = make_id()
 
@@ -480,13 +397,13 @@ async def generate_multicolour_part(
   await scad_file.close()
 
   LOG.info("running colorscad")
-  process = await asyncio.subprocess.create_subprocess_shell(
-    f"colorscad -o /tmp/extruder/{job_id}.3mf -i /tmp/extruder/{job_id}.scad -j 8 -- --backend manifold", stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
-  )
-
-  returncode = await process.wait()
-  if returncode != 0:
-    LOG.info((await process.stderr.read()).decode())
+  with span("colorscad", stage="package"):
+    colorscad = await run_tool(
+      "colorscad",
+      f"colorscad -o /tmp/extruder/{job_id}.3mf -i /tmp/extruder/{job_id}.scad -j 8 -- --backend manifold",
+    )
+  if not colorscad.ok:
+    colorscad.log_output(logging.INFO)
     raise ValueError("ColorSCAD 3MF Failure!")
 
   f = await aiofiles.open(f"/tmp/extruder/{job_id}.3mf", "rb")
@@ -501,74 +418,30 @@ async def generate_multicolour_part(
   return threemf_data
 
 async def generate_backed_multicolour_part(
-  images: dict[str, bytes], z: float, x: float = 0, y: float = 0, black_thickness: float = 0
+  context: ImageContext, z: float, x: float = 0, y: float = 0, black_thickness: float = 0, *, tracer: str = None, quality: str = None
 ) -> bytes:
-  "Take multiple images by hexadecimal colour, and output a 3MF file backed with a single colour."
+  "Take an image separated into colour channels, and output a 3MF file backed with a single colour."
   "By default, black_thickness = z"
   if not black_thickness:
     black_thickness = z
   coloured_stls: dict[str, bytes] = {}
   # based off of the center of each image
   sizes: dict[str, dict[str, int]] = {}  # The real
-  # Convert each image to an STL
-  for colour, image in images.items():
+  # Convert each channel to an STL
+  for colour in context.channels:
     LOG.info(f"getting data for {colour} channel")
+    image, box = context.export(colour)
     try:
-      if colour == "background":
-        coloured_stls[colour] = await png_to_stl(image, black_thickness, x, y, size_based_on_total_image_size=True, error_empty_svg=True)
-      else:
-        coloured_stls[colour] = await png_to_stl(image, z, x, y, size_based_on_total_image_size=True, error_empty_svg=True)
+      with span("png_to_stl", colour=colour):
+        if colour == "background":
+          coloured_stls[colour] = await png_to_stl(image, black_thickness, x, y, size_based_on_total_image_size=True, error_empty_svg=True, tracer=tracer, quality=quality, box=box)
+        else:
+          coloured_stls[colour] = await png_to_stl(image, z, x, y, size_based_on_total_image_size=True, error_empty_svg=True, tracer=tracer, quality=quality, box=box)
     except ValueError:
       coloured_stls[colour] = "SKIPPED"
       continue
-    png_buffer = io.BytesIO(image)
-    img = Image.open(png_buffer)
-    img.convert("L")
-    width, height = img.size
-    top = height
-    bottom = 0
-    left = width
-    right = 0
-
-    pixels = img.load()
-
-    area = 0
-
-    for image_y in range(height):
-      for image_x in range(width):
-        r, g, b, a = pixels[image_x, image_y]
-        if r * g * b != 255 * 255 * 255:
-          area += 1
-          # This pixel is something other than white, mark it.
-          if image_y > bottom:
-            bottom = image_y
-          if image_x > right:
-            right = image_x
-          if image_y < top:
-            top = image_y
-          if image_x < left:
-            left = image_x
-
     # Now insert these into the sizes for postprocessing
-    center_x = (right + left) / 2
-    center_y = (top + bottom) / 2
-
-    height_dpmm = (height / y)
-    width_dpmm = (width / x)
-
-    offset_x = -(((width / 2) - center_x) / width_dpmm)
-    offset_y = ((height / 2) - center_y) / height_dpmm
-    sizes[colour] = {
-      "left": left,
-      "right": right,
-      "top": top,
-      "bottom": bottom,
-      "cx": center_x,
-      "cy": center_y,
-      "ox": offset_x,
-      "oy": offset_y,
-      "area": area
-    }
+    sizes[colour] = get_placement(box, x, y)
 
   job_id = make_id()
 
@@ -635,20 +508,14 @@ async def generate_backed_multicolour_part(
   await scad_file.close()
 
   LOG.info("running colorscad")
-  process = await asyncio.subprocess.create_subprocess_shell(
-    f"colorscad -o /tmp/extruder/{job_id}.3mf -i /tmp/extruder/{job_id}.scad -v -j 8 -- --backend manifold", stderr=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
-  )
-
-  while True:
-    line = await process.stdout.readline()
-    if not line:
-      break
-    line_str = line.decode().strip()
-    LOG.info(f"colorscad: {line_str}")
-
-  returncode = await process.wait()
-  if returncode != 0:
-    LOG.info((await process.stderr.read()).decode())
+  with span("colorscad", stage="package"):
+    colorscad = await run_tool(
+      "colorscad",
+      f"colorscad -o /tmp/extruder/{job_id}.3mf -i /tmp/extruder/{job_id}.scad -v -j 8 -- --backend manifold",
+      on_line=lambda line: LOG.info(f"colorscad: {line}"),
+    )
+  if not colorscad.ok:
+    colorscad.log_output(logging.INFO)
     raise ValueError("ColorSCAD 3MF Failure!")
 
   f = await aiofiles.open(f"/tmp/extruder/{job_id}.3mf", "rb")
@@ -662,20 +529,77 @@ async def generate_backed_multicolour_part(
 
   return threemf_data
 
+def get_separate_key(
+  png_data: bytes, x: float, y: float, generate_background: bool,
+  colours: int, palette: str | list[str], cleanup: bool,
+) -> tuple:
+  "Get the stage cache key of an image separated with these arguments."
+  # Palettes are compared by their colours, however they were written.
+  palette = tuple(map(tuple, parse_palette(palette).tolist())) if palette else None
+  return ("separate", digest(png_data), x, y, generate_background, colours, palette, cleanup)
+
+
+async def separate_image(
+  png_data: bytes, x: float = 0, y: float = 0, generate_background: bool = False, *,
+  colours: int = 0, palette: str = None, cleanup: bool = CLEANUP, store: bool = False,
+  stop: Callable[[], bool] = None,
+) -> ImageContext | None:
+  """Decode an image and separate it into channel masks, see `ImageContext`.
+
+  An image already separated ahead of time with the same arguments is
+  taken from the stage cache instead, and `store` puts it there. The
+  context is shared, so it must not be changed. `stop` is checked between
+  the stages, and None is returned if it says to stop."""
+  key = get_separate_key(png_data, x, y, generate_background, colours, palette, cleanup)
+  context = stage_cache.get(key)
+  if context is not None:
+    annotate(separated_ahead=True, channels=len(context.channels))
+    return context
+
+  stop = stop or (lambda: False)
+  loop = asyncio.get_event_loop()
+  executor = get_executor()
+  # Decode once, and shrink to the detail the print can show
+  with span("decode", stage="preprocess", png_bytes=len(png_data)):
+    context = await loop.run_in_executor(executor, ImageContext.from_png, png_data, x, y)
+  if (colours or palette) and not stop():
+    with span("reduce_colours", stage="palette", colours=colours):
+      await loop.run_in_executor(executor, context.reduce_colours, colours, palette)
+  if stop():
+    return None
+  with span("separate_png", stage="separate", cleanup=cleanup):
+    channels = await loop.run_in_executor(executor, functools.partial(
+      context.separate, get_closest_matches, generate_background,
+      cleanup=cleanup, x=x, y=y,
+    ))
+    annotate(channels=len(channels))
+  if store:
+    stage_cache.put(key, context, sum(mask.nbytes for mask in context.masks.values()))
+  return context
+
+
 async def png_to_3mf(
-  png_data: bytes, z: float, x: float = 0, y: float = 0
+  png_data: bytes, z: float, x: float = 0, y: float = 0, *, tracer: str = None, quality: str = None,
+  colours: int = 0, palette: str = None, cleanup: bool = CLEANUP,
 ) -> bytes:
   #images = separate_png(png_data)
-  loop = asyncio.get_event_loop()
-  with concurrent.futures.ThreadPoolExecutor() as pool:
-    images = await loop.run_in_executor(pool, separate_png, png_data)
-  return await generate_multicolour_part(images, z, x, y)
+  get_tracer(tracer, filled=True)
+  get_quality(quality)
+  check_options(colours, palette)
+  context = await separate_image(
+    png_data, x, y, colours=colours, palette=palette, cleanup=cleanup
+  )
+  return await generate_multicolour_part(context, z, x, y, tracer=tracer, quality=quality)
 
 async def png_to_backed3mf(
-  png_data: bytes, z: float, x: float = 0, y: float = 0, black_thickness: float = 0
+  png_data: bytes, z: float, x: float = 0, y: float = 0, black_thickness: float = 0, *, tracer: str = None, quality: str = None,
+  colours: int = 0, palette: str = None, cleanup: bool = CLEANUP,
 ) -> bytes:
   #images = separate_png(png_data)
-  loop = asyncio.get_event_loop()
-  with concurrent.futures.ThreadPoolExecutor() as pool:
-    images = await loop.run_in_executor(pool, separate_png, png_data, True)
-  return await generate_backed_multicolour_part(images, z, x, y, black_thickness)
\ No newline at end of file
+  get_tracer(tracer, filled=True)
+  get_quality(quality)
+  check_options(colours, palette)
+  context = await separate_image(
+    png_data, x, y, True, colours=colours, palette=palette, cleanup=cleanup
+  )
+  return await generate_backed_multicolour_part(context, z, x, y, black_thickness, tracer=tracer, quality=quality)
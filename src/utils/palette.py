@@ -0,0 +1,173 @@
+# Reduce an image to a few colours before it is separated into channels
+from __future__ import annotations
+
+import numpy
+
+# Pixels sampled to build a palette, the rest are mapped to it afterwards
+MAX_SAMPLES = 1 << 18
+# Unique colours matched to a palette at a time, to bound the distance matrix
+MATCH_CHUNK = 1 << 14
+KMEANS_ITERATIONS = 8
+MAX_COLOURS = 256
+
+# Pixels this colour are never part of a channel, so they are left alone
+SKIPPED_COLOUR = 0xFEFEFE
+
+
+def pack_rgb(rgb: numpy.ndarray) -> numpy.ndarray:
+  "Pack (..., 3) RGB values into single uint32s."
+  rgb = rgb.astype(numpy.uint32)
+  return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def unpack_rgb(packed: numpy.ndarray) -> numpy.ndarray:
+  "Unpack uint32 colours into (..., 3) uint8 RGB."
+  return numpy.stack(
+    [(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=-1
+  ).astype(numpy.uint8)
+
+
+def parse_palette(palette: str | list[str]) -> numpy.ndarray:
+  """Parse a filament palette of hex colours, as a list or comma separated.
+
+  Raises ValueError if a colour isn't 6 hex digits."""
+  if isinstance(palette, str):
+    palette = palette.split(",")
+  colours = []
+  for colour in palette:
+    colour = colour.strip().lstrip("#")
+    if len(colour) != 6:
+      raise ValueError(f"palette colour {colour!r} must be 6 hex digits")
+    try:
+      colours.append([int(colour[i:i + 2], 16) for i in (0, 2, 4)])
+    except ValueError:
+      raise ValueError(f"palette colour {colour!r} must be 6 hex digits") from None
+  if not colours:
+    raise ValueError("palette must have at least one colour")
+  return numpy.array(colours, dtype=numpy.uint8)
+
+
+def check_options(colours: int = 0, palette: str | list[str] = None) -> None:
+  "Raise ValueError for a bad colour count or palette, before doing any work."
+  if palette:
+    parse_palette(palette)
+  elif colours and not 1 <= colours <= MAX_COLOURS:
+    raise ValueError(f"colours must be between 1 and {MAX_COLOURS}")
+
+
+def colour_histogram(pixels: numpy.ndarray, max_samples: int = 0) -> tuple[numpy.ndarray, numpy.ndarray]:
+  """Count the colours of an RGB(A) image, skipping the skipped colour.
+
+  Every pixel is counted, unless `max_samples` is set and the image is
+  bigger than that, in which case every nth pixel along both axes is.
+  Returns the packed colours, and how many counted pixels have each."""
+  height, width = pixels.shape[:2]
+  step = 1
+  if max_samples:
+    step = max(1, int(numpy.ceil(numpy.sqrt(height * width / max_samples))))
+  packed = pack_rgb(pixels[::step, ::step, :3]).ravel()
+  packed = packed[packed != SKIPPED_COLOUR]
+  return numpy.unique(packed, return_counts=True)
+
+
+def sample_histogram(pixels: numpy.ndarray, max_samples: int = MAX_SAMPLES) -> tuple[numpy.ndarray, numpy.ndarray]:
+  """Count the colours of an evenly spaced sample of an RGB(A) image.
+
+  Returns the (N, 3) colours and how many sampled pixels have each."""
+  colours, counts = colour_histogram(pixels, max_samples)
+  return unpack_rgb(colours), counts
+
+
+def median_cut(colours: numpy.ndarray, counts: numpy.ndarray, count: int) -> numpy.ndarray:
+  """Split a colour histogram into `count` boxes, and return their means.
+
+  The box with the most pixels times its widest channel range is split at
+  the weighted median of that channel, until there are enough boxes."""
+  colours = colours.astype(numpy.float64)
+  boxes = [numpy.arange(len(colours))]
+  while len(boxes) < count:
+    scores = []
+    for box in boxes:
+      if len(box) < 2:
+        scores.append(-1)
+        continue
+      ranges = numpy.ptp(colours[box], axis=0)
+      scores.append(ranges.max() * counts[box].sum())
+    widest = int(numpy.argmax(scores))
+    if scores[widest] <= 0:
+      break
+    box = boxes.pop(widest)
+    channel = int(numpy.ptp(colours[box], axis=0).argmax())
+    box = box[numpy.argsort(colours[box, channel], kind="stable")]
+    weights = numpy.cumsum(counts[box])
+    split = int(numpy.searchsorted(weights, weights[-1] / 2))
+    split = min(max(split, 1), len(box) - 1)
+    boxes += [box[:split], box[split:]]
+  return numpy.array([
+    numpy.average(colours[box], axis=0, weights=counts[box]) for box in boxes
+  ])
+
+
+def nearest_colours(colours: numpy.ndarray, palette: numpy.ndarray) -> numpy.ndarray:
+  "Find the index of the nearest palette colour to each colour."
+  colours = colours.astype(numpy.float32)
+  palette = palette.astype(numpy.float32)
+  nearest = numpy.empty(len(colours), dtype=numpy.intp)
+  for start in range(0, len(colours), MATCH_CHUNK):
+    chunk = colours[start:start + MATCH_CHUNK]
+    distances = ((chunk[:, None, :] - palette[None, :, :]) ** 2).sum(axis=-1)
+    nearest[start:start + MATCH_CHUNK] = distances.argmin(axis=1)
+  return nearest
+
+
+def kmeans(
+  colours: numpy.ndarray, counts: numpy.ndarray, centres: numpy.ndarray,
+  iterations: int = KMEANS_ITERATIONS,
+) -> numpy.ndarray:
+  "Refine palette `centres` with k-means on a colour histogram, weighted by counts."
+  colours = colours.astype(numpy.float64)
+  centres = centres.astype(numpy.float64)
+  for _ in range(iterations):
+    nearest = nearest_colours(colours, centres)
+    totals = numpy.bincount(nearest, weights=counts, minlength=len(centres))
+    moved = centres.copy()
+    used = totals > 0
+    for channel in range(3):
+      sums = numpy.bincount(
+        nearest, weights=colours[:, channel] * counts, minlength=len(centres)
+      )
+      moved[used, channel] = sums[used] / totals[used]
+    if numpy.allclose(moved, centres, atol=0.5):
+      centres = moved
+      break
+    centres = moved
+  return centres
+
+
+def get_palette(pixels: numpy.ndarray, count: int) -> numpy.ndarray:
+  """Pick `count` colours that best cover an image, with median cut refined
+  by k-means on a sampled histogram.
+
+  Raises ValueError if the count is out of range."""
+  check_options(count)
+  colours, counts = sample_histogram(pixels)
+  if len(colours) <= count:
+    return colours
+  centres = kmeans(colours, counts, median_cut(colours, counts, count))
+  return numpy.clip(numpy.rint(centres), 0, 255).astype(numpy.uint8)
+
+
+def reduce_colours(pixels: numpy.ndarray, palette: numpy.ndarray) -> numpy.ndarray:
+  """Map every pixel of an RGBA image to its nearest palette colour.
+
+  Each unique colour is matched once and the result looked up for every
+  pixel. Alpha is kept, and pixels of the skipped colour are left as is."""
+  packed = pack_rgb(pixels[..., :3])
+  colours, inverse = numpy.unique(packed.ravel(), return_inverse=True)
+  lookup = palette[nearest_colours(unpack_rgb(colours), palette)]
+  skipped = colours == SKIPPED_COLOUR
+  lookup[skipped] = unpack_rgb(colours[skipped])
+
+  reduced = pixels.copy()
+  reduced[..., :3] = lookup[inverse].reshape(*packed.shape, 3)
+  return reduced
@@ -6,6 +6,8 @@ from aiohttp.web import Response
 
 from aiohttp.web import middleware
 
+from utils.metrics import REQUEST_SECONDS
+
 if TYPE_CHECKING:
   from aiohttp.web import Request
 
@@ -13,18 +15,30 @@ if TYPE_CHECKING:
 DISABLED_LOG_PATHS = [
   "/api/job/workers/",
   "/api/job/complete/",
-  "/api/job/current/"
+  "/api/job/current/",
+  "/api/metrics/",
 ]
 
 @middleware
 async def pg_pool_middleware(request: Request, handler):
   request.LOG = request.app.LOG
+  request.session = request.app.cs
   start = time.monotonic_ns()
   try:
     resp = await handler(request)
   except Exception:
     request.LOG.exception(f"Request to {request.path} failed!")
     resp = Response(status=500,body="internal server error")
+  if resp is not None and request.app is request.match_info.apps[-1]:
+    # Sub-apps run this middleware too, only time the innermost one.
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    REQUEST_SECONDS.observe(
+      request.method,
+      route,
+      str(resp.status),
+      value=(time.monotonic_ns() - start) / 1e9,
+    )
   if request.path not in DISABLED_LOG_PATHS:
     request.LOG.info(
       f"call to {request.path} took {(time.monotonic_ns()-start)/1000} microseconds"
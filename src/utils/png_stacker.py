@@ -1,185 +1,152 @@
 import asyncio
-import concurrent.futures
-import io
 import logging
 
 import aiofiles
 import aiofiles.os
-from PIL import Image
 
 from utils.extruder import png_to_stl
-from utils.multicolor_extruder import (generate_backed_multicolour_part,
-                                       generate_openscad_script_heights,
-                                       make_id, separate_png)
+from utils.image_context import ImageContext
+from utils.cleanup import CLEANUP
+from utils.layout import get_placement
+from utils.palette import check_options
+from utils.multicolor_extruder import (generate_openscad_script_heights,
+                                       get_closest_matches, make_id)
+from utils.tools import PROCESS_WORKERS, process_pool, run_tool
+from utils.simplify import get_quality
+from utils.tracers import get_tracer
+from utils.tracing import annotate, span
 
 LOG = logging.getLogger(__name__)
 
 PATH_TO_OPENSCAD = "/bin/OpenSCAD-2021.01-x86_64.AppImage"
 
 
+def separate_layer(
+  png: bytes, x: float, y: float, generate_background: bool = False,
+  colours: int = 0, palette: str = None, cleanup: bool = CLEANUP,
+) -> dict[str, dict]:
+  "Separate one layer into colour channels, skipping any that are empty."
+  context = ImageContext.from_png(png, x, y)
+  context.reduce_colours(colours, palette)
+  context.separate(
+    get_closest_matches, generate_background, cleanup=cleanup, x=x, y=y
+  )
+  channels = {}
+  for colour in context.channels:
+    image, box = context.export(colour)
+    if box["area"]:
+      channels[colour] = {"pbm": image, "box": box, **get_placement(box, x, y)}
+  return channels
+
+
 async def generate_stacked_multicolour_part(
-  images: list[dict[str, int | dict]], x: float = 0, y: float = 0
+  layers: list[dict[str, dict]],
+  z: float,
+  x: float = 0,
+  y: float = 0,
+  black_thickness: float = 0,
+  *,
+  tracer: str = None,
+  quality: str = None,
 ) -> bytes:
-  "Take multiple images by hex colour, ."
-  coloured_stls: dict[float, dict[str, bytes]] = {}
-  # based off of the center of each image
-  sizes: dict[float, dict[str, dict[str, int]]] = {}
-  # Convert each image to an STL
-  for num, layer in enumerate(images):
-    z = layer["height"]
-    if num > 0:
-      offset_z = z - images[num - 1]["height"]
-    if z not in coloured_stls:
-      coloured_stls[z] = {}
-    for colour, image in layer["pngs"].items():
-      LOG.info(f"getting data for {colour} channel")
-      try:
-        coloured_stls[num][colour] = await png_to_stl(
-          image,
-          z,
-          x,
-          y,
-          size_based_on_total_image_size=True,
-          error_empty_svg=True,
-        )
-      except ValueError:
-        coloured_stls[num][colour] = "SKIPPED"
-        continue
-      png_buffer = io.BytesIO(image)
-      img = Image.open(png_buffer)
-      img.convert("L")
-      width, height = img.size
-      top = height
-      bottom = 0
-      left = width
-      right = 0
-
-      pixels = img.load()
-
-      area = 0
-
-      for image_y in range(height):
-        for image_x in range(width):
-          r, g, b, a = pixels[image_x, image_y]
-          if r * g * b != 255 * 255 * 255:
-            area += 1
-            # This pixel is something other than white, mark it.
-            if image_y > bottom:
-              bottom = image_y
-            if image_x > right:
-              right = image_x
-            if image_y < top:
-              top = image_y
-            if image_x < left:
-              left = image_x
-
-      # Now insert these into the sizes for postprocessing
-      center_x = (right + left) / 2
-      center_y = (top + bottom) / 2
-
-      height_dpmm = height / y
-      width_dpmm = width / x
-
-      offset_x = -(((width / 2) - center_x) / width_dpmm)
-      offset_y = ((height / 2) - center_y) / height_dpmm
-      if num in sizes:
-        sizes[num][colour] = {
-          "left": left,
-          "right": right,
-          "top": top,
-          "bottom": bottom,
-          "cx": center_x,
-          "cy": center_y,
-          "ox": offset_x,
-          "oy": offset_y,
-          "oz": offset_z,
-          "height": z,
-          "area": area,
-        }
-      else:
-        sizes[num] = {
-          colour: {
-            "left": left,
-            "right": right,
-            "top": top,
-            "bottom": bottom,
-            "cx": center_x,
-            "cy": center_y,
-            "ox": offset_x,
-            "oy": offset_y,
-            "oz": offset_z,
-            "height": z,
-            "area": area,
-          }
-        }
+  """Extrude every channel of every layer, stack the layers `z` apart and
+  package them as a single 3MF.
 
+  A "background" channel in the bottom layer becomes a `black_thickness`
+  backing plate under the whole stack."""
   job_id = make_id()
+  await aiofiles.os.makedirs("/tmp/extruder/", exist_ok=True)
+
+  # The parts are centred on their own origin, so each is moved up by the
+  # layers below it plus half its own thickness.
+  parts: list[dict] = []
+  bottom = black_thickness if black_thickness else 0
+  for num, channels in enumerate(layers):
+    for colour, channel in channels.items():
+      if colour == "background":
+        if not black_thickness:
+          continue
+        thickness, offset_z = black_thickness, black_thickness / 2
+      else:
+        thickness, offset_z = z, bottom + z / 2
+      parts.append({
+        "layer": num,
+        "colour": colour,
+        "channel": channel,
+        "thickness": thickness,
+        "offset_z": offset_z,
+        "filepath": f"/tmp/extruder/{job_id}_{num}_{colour}.stl",
+      })
+    bottom += z
+
+  # Tracing and extruding happens in external tools, so every channel can
+  # run at once. Limit it to a couple per core to keep OpenSCAD from
+  # thrashing when there are dozens of layers.
+  limit = asyncio.Semaphore(max(4, PROCESS_WORKERS * 2))
+
+  async def extrude(part: dict) -> bytes | None:
+    channel = part["channel"]
+    async with limit:
+      with span("png_to_stl", colour=part["colour"], layer=part["layer"]):
+        try:
+          return await png_to_stl(
+            channel["pbm"], part["thickness"], channel["x"], channel["y"],
+            error_empty_svg=True, tracer=tracer, quality=quality, box=channel["box"],
+          )
+        except ValueError:
+          return None
+
+  stls = await asyncio.gather(*(extrude(part) for part in parts))
 
-  # write each STL to a file for orcaslicer to import
-  stls: list[str] = []
   models: list[dict[str, int | str]] = []
-  for num, colstl in coloured_stls.items():
-    for colour, stl in colstl.items():
-      if stl == "SKIPPED":
-        continue
-      height = sizes[num][colour]["height"]
-      # if colour in ["background","black"]:
-      #  continue # Merge these into one object
-      LOG.info(f"extruding {colour}")
-      f = await aiofiles.open(f"/tmp/extruder/{job_id}_{colour}.stl", "wb")
+  for part, stl in zip(parts, stls):
+    if stl is None:
+      continue
+    async with aiofiles.open(part["filepath"], "wb") as f:
       await f.write(stl)
-      await f.close()
-      stls.append(f"/tmp/extruder/{job_id}_{colour}.stl")
-      # translations are based off of the center of the part
-      # The bottom of the coloured parts are at `-(z/2)`
-      # The middle of the black parts are `black_thickness/2`
-      # To move them down the correct distance, we must do black_thickness+z
-      models.append(
-        {
-          "colour": colour,
-          "filepath": f"/tmp/extruder/{job_id}_{colour}.stl",
-          "offset_x": sizes[num][colour]["ox"],
-          "offset_y": sizes[num][colour]["oy"],
-          "offset_z": sizes[num][colour]["oz"],
-          "area": sizes[colour]["area"],
-          "thickness": height,
-          "id": make_id(),
-        }
-      )
+    models.append({
+      "colour": part["colour"],
+      "filepath": part["filepath"],
+      "offset_x": part["channel"]["ox"],
+      "offset_y": part["channel"]["oy"],
+      "offset_z": part["offset_z"],
+      "thickness": part["thickness"],
+      "area": part["channel"]["area"],
+      "id": make_id(),
+    })
+  if not models:
+    raise ValueError("every layer was empty")
 
   LOG.info("generating openscad script")
   scad_script = generate_openscad_script_heights(models)
-  scad_file = await aiofiles.open(f"/tmp/extruder/{job_id}.scad", "w")
-  await scad_file.write(scad_script)
-  await scad_file.close()
+  async with aiofiles.open(f"/tmp/extruder/{job_id}.scad", "w") as f:
+    await f.write(scad_script)
 
   LOG.info("running colorscad")
-  process = await asyncio.subprocess.create_subprocess_shell(
-    f"colorscad -o /tmp/extruder/{job_id}.3mf -i /tmp/extruder/{job_id}.scad -v -j 8 -- --backend manifold",
-    stderr=asyncio.subprocess.PIPE,
-    stdout=asyncio.subprocess.PIPE,
-  )
-
-  while True:
-    line = await process.stdout.readline()
-    if not line:
-      break
-    line_str = line.decode().strip()
-    LOG.info(f"colorscad: {line_str}")
-
-  returncode = await process.wait()
-  if returncode != 0:
-    LOG.info((await process.stderr.read()).decode())
-    raise ValueError("ColorSCAD 3MF Failure!")
-
-  f = await aiofiles.open(f"/tmp/extruder/{job_id}.3mf", "rb")
-  threemf_data = await f.read()
-  await f.close()
-
-  # Now clean up
-  await aiofiles.os.remove(f"/tmp/extruder/{job_id}.3mf")
-  for stl in stls:
-    await aiofiles.os.remove(stl)
+  with span("colorscad", stage="package"):
+    colorscad = await run_tool(
+      "colorscad",
+      f"colorscad -o /tmp/extruder/{job_id}.3mf -i /tmp/extruder/{job_id}.scad -v -j 8 -- --backend manifold",
+      on_line=lambda line: LOG.info(f"colorscad: {line}"),
+    )
+  try:
+    if not colorscad.ok:
+      colorscad.log_output(logging.INFO)
+      raise ValueError("ColorSCAD 3MF Failure!")
+
+    async with aiofiles.open(f"/tmp/extruder/{job_id}.3mf", "rb") as f:
+      threemf_data = await f.read()
+  finally:
+    # Now clean up
+    for path in [
+      f"/tmp/extruder/{job_id}.3mf",
+      f"/tmp/extruder/{job_id}.scad",
+      *(model["filepath"] for model in models),
+    ]:
+      try:
+        await aiofiles.os.remove(path)
+      except FileNotFoundError:
+        pass
 
   return threemf_data
 
@@ -190,14 +157,30 @@ async def pngs_to_stacked3mf(
   x: float = 0,
   y: float = 0,
   black_thickness: float = 0,
+  *,
+  tracer: str = None,
+  quality: str = None,
+  colours: int = 0,
+  palette: str = None,
+  cleanup: bool = CLEANUP,
 ) -> bytes:
+  """Stack one PNG per layer, bottom first, into a multicolour 3MF.
+
+  Each layer is reduced to `colours` or snapped to `palette` on its own,
+  so a palette keeps the colours the same from layer to layer."""
+  get_tracer(tracer, filled=True)
+  get_quality(quality)
+  check_options(colours, palette)
   loop = asyncio.get_event_loop()
-  layers = []
-  with concurrent.futures.ThreadPoolExecutor() as pool:
-    for image in png_data:
-      layers.append(
-        await loop.run_in_executor(pool, separate_png, png_data, False)
+  with span("separate_png", stage="separate", layers=len(png_data)):
+    layers = await asyncio.gather(*(
+      loop.run_in_executor(
+        process_pool, separate_layer, image, x, y, num == 0 and bool(black_thickness),
+        colours, palette, cleanup,
       )
-  return await generate_backed_multicolour_part(
-    layers, z, x, y, black_thickness
+      for num, image in enumerate(png_data)
+    ))
+    annotate(channels=sum(len(channels) for channels in layers))
+  return await generate_stacked_multicolour_part(
+    layers, z, x, y, black_thickness, tracer=tracer, quality=quality
   )
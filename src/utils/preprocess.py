@@ -0,0 +1,90 @@
+# Prepare uploaded images before they are separated and traced
+from __future__ import annotations
+
+import io
+import logging
+import math
+import tomllib
+
+from PIL import Image
+
+LOG = logging.getLogger(__name__)
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  # The smallest detail worth keeping, in mm. 0 turns downsampling off.
+  MIN_FEATURE_MM = config.get("preprocess", {}).get("min_feature_mm", 0.1)
+
+# Images with at most this many colours are treated as palettized art.
+PALETTE_COLOURS = 256
+
+
+def get_max_size(
+  width: int, height: int, x: float, y: float, min_feature: float = MIN_FEATURE_MM
+) -> tuple[int, int]:
+  """Get the largest size worth tracing for an image printed `x` by `y` mm.
+
+  That is one pixel per `min_feature` mm along the tighter axis, so the
+  aspect ratio is kept. The image is left as it is if either size is 0,
+  as OpenSCAD then takes that axis from the traced pixels."""
+  if min_feature <= 0 or x <= 0 or y <= 0:
+    return width, height
+  scale = min(1.0, x / min_feature / width, y / min_feature / height)
+  if scale >= 1:
+    return width, height
+  return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+
+def is_palettized(image: Image.Image) -> bool:
+  "Check if an image is flat colours, which blending would add new ones to."
+  if image.mode in ("1", "P"):
+    return True
+  return image.getcolors(PALETTE_COLOURS) is not None
+
+
+def downsample_image(
+  image: Image.Image,
+  x: float,
+  y: float,
+  *,
+  preserve_colours: bool = False,
+  min_feature: float = MIN_FEATURE_MM,
+) -> Image.Image:
+  """Shrink an image to the most detail a print `x` by `y` mm can show.
+
+  Flat colour art, or any image when `preserve_colours` is set, is
+  resampled by nearest neighbour so no new colours appear between the old
+  ones; anything else is averaged. Returns the image itself if it is
+  already small enough."""
+  width, height = image.size
+  size = get_max_size(width, height, x, y, min_feature)
+  if size == (width, height):
+    return image
+
+  if preserve_colours or is_palettized(image):
+    resample = Image.Resampling.NEAREST
+  else:
+    resample = Image.Resampling.BOX
+  LOG.info(f"downsampling {width}x{height} to {size[0]}x{size[1]} for a {x}x{y}mm print")
+  return image.resize(size, resample)
+
+
+def downsample_png(
+  png_data: bytes,
+  x: float,
+  y: float,
+  *,
+  preserve_colours: bool = False,
+  min_feature: float = MIN_FEATURE_MM,
+) -> bytes:
+  "Shrink a PNG like `downsample_image`, returning it untouched if it can't be."
+  image = Image.open(io.BytesIO(png_data))
+  resized = downsample_image(
+    image, x, y, preserve_colours=preserve_colours, min_feature=min_feature
+  )
+  if resized is image:
+    return png_data
+  stream = io.BytesIO()
+  # Only our own stages read this back, so favour speed over size.
+  resized.save(stream, "png", compress_level=1)
+  return stream.getvalue()
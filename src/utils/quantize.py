@@ -8,6 +8,14 @@ from io import BytesIO
 if TYPE_CHECKING:
   pass
 
+# 4x4 Bayer matrix, normalised to thresholds in [0, 1)
+BAYER_4X4 = numpy.array([
+  [0, 8, 2, 10],
+  [12, 4, 14, 6],
+  [3, 11, 1, 9],
+  [15, 7, 13, 5],
+], dtype=numpy.float32) / 16
+
 def get_palette(layers: int = 5) -> list[int]:
   return numpy.linspace(0, 255, layers, dtype=int).tolist()
 
@@ -16,22 +24,39 @@ def find_closest_match(shade: int, palette: list[int]) -> int:
   index = (numpy.abs(np_array - shade)).argmin()
   return int(np_array[index])
 
-def quantize_image(png_data: bytes, layers: int = 5) -> list[list[int]]:
-  "Take an image, and return a 2D list of greyscale values"
+def make_lookup(palette: list[int]) -> numpy.ndarray:
+  "Map every shade 0-255 to its closest palette entry, ties going to the darker one"
+  levels = numpy.sort(numpy.asarray(palette, dtype=numpy.int16))
+  midpoints = (levels[:-1] + levels[1:]) / 2
+  indexes = numpy.searchsorted(midpoints, numpy.arange(256), side="left")
+  return levels[indexes].astype(numpy.uint8)
+
+def quantize_array(
+  greyscale: numpy.ndarray, palette: list[int], dither: bool = False
+) -> numpy.ndarray:
+  "Snap a 2D uint8 greyscale array to the palette in one pass"
+  lookup = make_lookup(palette)
+  if not dither or len(palette) < 2:
+    return lookup[greyscale]
+
+  # Ordered dithering: nudge each pixel by up to half a palette step, so
+  # smooth gradients turn into a pattern instead of hard bands.
+  step = 255 / (len(palette) - 1)
+  height, width = greyscale.shape
+  thresholds = numpy.tile(BAYER_4X4, (height // 4 + 1, width // 4 + 1))
+  thresholds = thresholds[:height, :width]
+  nudged = greyscale + (thresholds - 0.5) * step
+  return lookup[numpy.clip(numpy.rint(nudged), 0, 255).astype(numpy.uint8)]
+
+def quantize_image(
+  png_data: bytes, layers: int = 5, *, dither: bool = False
+) -> numpy.ndarray:
+  "Take an image, and return a 2D uint8 array of greyscale values snapped to the palette"
   palette = get_palette(layers)
 
   bio = BytesIO(png_data)
   image = Image.open(bio)
   greyscale = image.convert("RGB").convert("L")
-  np_array = numpy.array(greyscale)
-  # The array should be completely greyscale, so it will be fine to use only the R channel.
-  output_data: list[list[int]] = []
-
-  for column in np_array:
-    output_column = []
-    for pixel in column:
-      quantized = find_closest_match(pixel[0], palette)
-      output_column.append(quantized)
-    output_data.append(output_column)
-
-  return output_data
\ No newline at end of file
+  np_array = numpy.asarray(greyscale, dtype=numpy.uint8)
+
+  return quantize_array(np_array, palette, dither)
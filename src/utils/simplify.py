@@ -0,0 +1,140 @@
+# Simplify traced outlines, and the speed/quality presets that control it
+from __future__ import annotations
+
+import tomllib
+
+import cv2
+import numpy
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  NOZZLE_WIDTH = config.get("simplify", {}).get("nozzle_width", 0.4)
+  DEFAULT_QUALITY = config.get("simplify", {}).get("quality", "balanced")
+
+
+class Quality:
+  """A speed/quality preset for tracing and extruding.
+
+  `tolerance` is how far a simplified outline may stray from the traced
+  one, as a fraction of the nozzle width, which is the smallest detail a
+  printer can show anyway. `alphamax` and `turdsize` are passed to potrace
+  (corner smoothing, and the largest speck dropped, in pixels), and `fn` is
+  the OpenSCAD `$fn` used to flatten curves in the imported SVG."""
+
+  name: str
+  description: str
+  tolerance: float
+  alphamax: float
+  turdsize: int
+  fn: int
+
+  def __init__(
+    self,
+    name: str,
+    description: str,
+    *,
+    tolerance: float,
+    alphamax: float,
+    turdsize: int,
+    fn: int,
+  ) -> None:
+    self.name = name
+    self.description = description
+    self.tolerance = tolerance
+    self.alphamax = alphamax
+    self.turdsize = turdsize
+    self.fn = fn
+
+  def get_tolerance(self, width: int, height: int, x: float, y: float) -> float:
+    """Get the tolerance in pixels for an image printed `x` by `y` mm.
+
+    A size of 0 leaves that axis as it is, so it can't be converted. Returns
+    0, meaning no simplification, if neither axis is known."""
+    mm_per_pixel = [
+      size / pixels for size, pixels in ((x, width), (y, height)) if size > 0 and pixels > 0
+    ]
+    if not mm_per_pixel or not self.tolerance:
+      return 0.0
+    # Stretching may make pixels longer one way, the error must fit both.
+    return self.tolerance * NOZZLE_WIDTH / max(mm_per_pixel)
+
+  def potrace_args(self, tolerance: float) -> str:
+    "Get the potrace options for this preset, with a tolerance in pixels."
+    args = f"-a {self.alphamax} -t {self.turdsize}"
+    if not tolerance:
+      # Without a tolerance, keep every curve as potrace traced it.
+      return f"{args} -n"
+    return f"{args} -O {tolerance:.3f}"
+
+  def to_dict(self) -> dict:
+    return {
+      "name": self.name,
+      "description": self.description,
+      "tolerance": self.tolerance,
+    }
+
+
+qualities: dict[str, Quality] = {}
+
+
+def register(quality: Quality) -> Quality:
+  qualities[quality.name] = quality
+  return quality
+
+
+def get_quality(name: str = None) -> Quality:
+  """Get a quality preset by name, or the server default.
+
+  Raises ValueError if there is no such preset."""
+  name = name or DEFAULT_QUALITY
+  if name not in qualities:
+    raise ValueError(f"quality must be one of {', '.join(qualities)}")
+  return qualities[name]
+
+
+def simplify_polyline(points: numpy.ndarray, tolerance: float, *, closed: bool = False) -> numpy.ndarray:
+  "Simplify an (N, 2) polyline with Douglas-Peucker, keeping its dtype."
+  points = numpy.asarray(points).reshape(-1, 2)
+  # A closed outline needs at least a triangle left.
+  if tolerance <= 0 or len(points) <= (3 if closed else 2):
+    return points
+  dtype = numpy.int32 if points.dtype.kind in "iu" else numpy.float32
+  simplified = cv2.approxPolyDP(points.astype(dtype), tolerance, closed).reshape(-1, 2)
+  if closed and len(simplified) < 3:
+    return points
+  return simplified.astype(points.dtype)
+
+
+def simplify_polylines(
+  polylines: list[numpy.ndarray], tolerance: float, *, closed: bool = False
+) -> list[numpy.ndarray]:
+  "Simplify every polyline in a list, dropping nothing."
+  if tolerance <= 0:
+    return polylines
+  return [simplify_polyline(polyline, tolerance, closed=closed) for polyline in polylines]
+
+
+register(Quality(
+  "fast",
+  "Coarse outlines and curves, quickest to extrude and smallest files",
+  tolerance=0.5,
+  alphamax=1.0,
+  turdsize=4,
+  fn=8,
+))
+register(Quality(
+  "balanced",
+  "Outlines simplified to a quarter of the nozzle width",
+  tolerance=0.25,
+  alphamax=1.0,
+  turdsize=2,
+  fn=24,
+))
+register(Quality(
+  "fine",
+  "Every traced vertex and finely flattened curves, slowest",
+  tolerance=0,
+  alphamax=1.0,
+  turdsize=2,
+  fn=1024,
+))
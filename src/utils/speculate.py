@@ -0,0 +1,151 @@
+# Separate and trace an image while the user is still picking settings
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+import tomllib
+
+from utils import jobs
+from utils.cleanup import CLEANUP
+from utils.extruder import cache_trace
+from utils.multicolor_extruder import separate_image
+from utils.palette import check_options
+from utils.simplify import get_quality
+from utils.tools import ToolGroup, tool_group
+from utils.tracers import get_tracer
+from utils.tracing import span
+
+LOG = logging.getLogger(__name__)
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  SPECULATE = config.get("speculate", {}).get("enabled", True)
+  # Seconds one image may be worked on ahead of time, before giving up.
+  SPECULATE_BUDGET: float = config.get("speculate", {}).get("budget", 60)
+  # Niceness of the tools and threads working ahead of time
+  SPECULATE_NICE: int = config.get("speculate", {}).get("nice", 10)
+
+# Seconds between checks that speculation should carry on
+WATCH_INTERVAL = 0.25
+
+# A single niced thread, so only one image is ever separated ahead of time,
+# and a replaced one holds up its replacement rather than a real job.
+executor = concurrent.futures.ThreadPoolExecutor(
+  max_workers=1, thread_name_prefix="speculate",
+  initializer=ToolGroup.lower_priority, initargs=(SPECULATE_NICE,),
+)
+
+
+def is_idle() -> bool:
+  "Check that no job is waiting for, or being run by, a worker."
+  if not jobs.job_queue.empty():
+    return False
+  return all(
+    worker is None or not worker["living"] or worker.get("status", "idle") == "idle"
+    for worker in jobs.workers.values()
+  )
+
+
+class Speculation:
+  """One image being separated and traced into the stage cache.
+
+  It stops as soon as a job arrives, its budget runs out or a newer image
+  replaces it: running tools are killed straight away, and the rest of
+  the work is checked for between stages. Work already running in a
+  thread finishes first, but at low priority."""
+
+  deadline: float
+  tools: ToolGroup
+  task: asyncio.Task | None
+
+  def __init__(self, budget: float = SPECULATE_BUDGET) -> None:
+    self.deadline = time.monotonic() + budget
+    self.tools = ToolGroup(executor, SPECULATE_NICE)
+    self.task = None
+
+  @property
+  def stopped(self) -> bool:
+    return self.tools.stopped
+
+  def should_stop(self) -> bool:
+    "Check if the work has to stop, stopping it if so."
+    if not self.stopped and (not is_idle() or time.monotonic() > self.deadline):
+      self.stop()
+    return self.stopped
+
+  def stop(self) -> None:
+    self.tools.stop()
+
+  async def watch(self) -> None:
+    "Stop in-flight work as soon as it has to, not only between channels."
+    while not self.should_stop():
+      await asyncio.sleep(WATCH_INTERVAL)
+
+  async def run(
+    self, png_data: bytes, x: float, y: float, backed: bool, *,
+    tracer: str, quality: str, colours: int, palette: str, cleanup: bool,
+  ) -> None:
+    # Tasks copy the context, so this only applies to this speculation.
+    tool_group.set(self.tools)
+    watcher = asyncio.get_event_loop().create_task(self.watch())
+    traced = 0
+    try:
+      with span("speculate", stage="speculate") as speculate_span:
+        context = await separate_image(
+          png_data, x, y, backed, colours=colours, palette=palette,
+          cleanup=cleanup, store=True, stop=self.should_stop,
+        )
+        if context is None:
+          return
+        # Smallest first, as they are the quickest to have ready.
+        for channel in sorted(context.channels, key=lambda channel: context.masks[channel].area):
+          if self.should_stop():
+            break
+          image, box = context.export(channel)
+          await cache_trace(
+            image, box, x, y, size_based_on_total_image_size=True,
+            tracer=tracer, quality=quality,
+          )
+          traced += 1
+        speculate_span.set(channels=len(context.channels), traced=traced)
+    except Exception:
+      if not self.stopped:
+        LOG.exception("speculation failed, the job will do the work instead")
+    finally:
+      watcher.cancel()
+      if self.stopped:
+        LOG.info(f"stopped speculating after {traced} channels")
+
+
+# The image being worked on ahead of time
+current: Speculation | None = None
+
+
+def speculate(
+  png_data: bytes, x: float = 0, y: float = 0, *, backed: bool = False,
+  tracer: str = None, quality: str = None, colours: int = 0, palette: str = None,
+  cleanup: bool = CLEANUP,
+) -> bool:
+  """Start separating and tracing an image into the stage cache, for a 3MF
+  job with the same arguments to pick up, while the server is idle.
+
+  A newer image stops the one being worked on. Returns False if
+  speculation is off or jobs are running, and raises ValueError for bad
+  arguments, like the job would."""
+  global current
+  get_tracer(tracer, filled=True)
+  get_quality(quality)
+  check_options(colours, palette)
+  if current is not None:
+    current.stop()
+    current = None
+  if not SPECULATE or not is_idle():
+    return False
+  current = Speculation()
+  current.task = asyncio.get_event_loop().create_task(current.run(
+    png_data, x, y, backed, tracer=tracer, quality=quality,
+    colours=colours, palette=palette, cleanup=cleanup,
+  ))
+  return True
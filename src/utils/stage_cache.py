@@ -0,0 +1,88 @@
+# Keep the results of pipeline stages, so a later job can skip them
+from __future__ import annotations
+
+import hashlib
+import time
+import tomllib
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+from utils.metrics import watch_cache
+
+if TYPE_CHECKING:
+  from typing import Any, Hashable
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  STAGE_CACHE_MB: float = config.get("stage_cache", {}).get("max_mb", 256)
+  STAGE_CACHE_TTL: float = config.get("stage_cache", {}).get("ttl", 900)
+
+
+def digest(data: bytes) -> str:
+  "Hash an upload or a channel, to key its stages by."
+  return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class StageCache:
+  """Bounded LRU cache of stage results, by the bytes they hold.
+
+  Keys start with the stage name, followed by the hash of the input and
+  every parameter the stage's output depends on. Entries older than `ttl`
+  seconds are dropped when they are next looked up, and the least recently
+  used go first once `max_bytes` is reached."""
+
+  entries: OrderedDict[Hashable, tuple[Any, int, float]]
+
+  def __init__(self, *, max_bytes: int, ttl: float = 900) -> None:
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.size = 0
+    self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def __contains__(self, key: Hashable) -> bool:
+    "Check for a live entry, without counting it as a lookup."
+    entry = self.entries.get(key)
+    return entry is not None and time.monotonic() - entry[2] < self.ttl
+
+  def get(self, key: Hashable) -> Any | None:
+    "Get a live entry, or None if it is missing or expired."
+    entry = self.entries.get(key)
+    if entry is None or time.monotonic() - entry[2] >= self.ttl:
+      if entry is not None:
+        self.remove(key)
+      self.stats["misses"] += 1
+      return None
+    self.entries.move_to_end(key)
+    self.stats["hits"] += 1
+    return entry[0]
+
+  def put(self, key: Hashable, value: Any, nbytes: int) -> bool:
+    "Store a result that holds `nbytes`. Returns False if it can never fit."
+    if nbytes > self.max_bytes:
+      return False
+    if key in self.entries:
+      self.remove(key)
+    self.entries[key] = (value, nbytes, time.monotonic())
+    self.size += nbytes
+    self.stats["stores"] += 1
+    while self.size > self.max_bytes:
+      _, (_, evicted, _) = self.entries.popitem(last=False)
+      self.size -= evicted
+      self.stats["evictions"] += 1
+    return True
+
+  def remove(self, key: Hashable) -> None:
+    _, nbytes, _ = self.entries.pop(key)
+    self.size -= nbytes
+
+  def clear(self) -> None:
+    self.entries.clear()
+    self.size = 0
+
+
+stage_cache = StageCache(max_bytes=int(STAGE_CACHE_MB * 1024 * 1024), ttl=STAGE_CACHE_TTL)
+watch_cache("stages", stage_cache.stats)
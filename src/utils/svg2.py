@@ -1,6 +1,11 @@
+from typing import Iterator
+
 import cv2
 import numpy
-import math
+
+from utils.geometry import find_close_ends
+from utils.simplify import simplify_polylines
+from utils.svg_writer import iter_svg
 
 
 def close_vertices(contour, max_distance=5):
@@ -28,72 +33,13 @@ def close_vertices(contour, max_distance=5):
 
   return numpy.array(result)
 
-def get_distance(x1: float,y1: float,x2: float,y2: float) -> float:
-  return math.sqrt(((x2-x1)**2) + ((y2-y1)**2))
-
-def create_polyline(start_x: int, start_y: int, end_x: int, end_y: int, points: int) -> list[tuple[int,int]]:
-  x_values = numpy.linspace(start_x, end_x, points)
-  y_values = numpy.linspace(start_y, end_y, points)
-
-  merged_points = numpy.column_stack((x_values, y_values))
-
-  return [tuple(row) for row in merged_points.tolist()]
-
-
-def find_close_ends(
-  polylines: list[list[tuple[int, int]]], max_distance: float = 5.0, resolution: int = 2
-) -> list[list[tuple[int, int]]]:
+def iter_png_to_svg(png_data: bytes, tolerance: float = 0) -> Iterator[str]:
   """
-  Find close ends of polylines.
-
-  Finds distance between ends of polylines using simple search, O(2n^2)
-
-  If the distance between the start and end are less than max_distance, it creates a new polyline connecting them.
-  
-  The resolution argument is how many points the joining polyline consists of."""
-
-  output_polylines = []
-
-  for i,src_polyline in enumerate(polylines):
-    output_polylines.append(src_polyline)
-    src_start = src_polyline[0]
-    src_end = src_polyline[-1]
-
-    for o,dst_polyline in enumerate(polylines):
-      if o == i:
-        continue
-      dst_start = dst_polyline[0]
-      dst_end = dst_polyline[-1]
-
-      # Check the distances
-      start_start_distance = get_distance(*src_start, *dst_start)
-      start_end_distance = get_distance(*src_start, *dst_end)
-      end_start_distance = get_distance(*src_end, *dst_start)
-      end_end_distance = get_distance(*src_end, *dst_end)
-
-      if start_start_distance <= max_distance:
-        output_polylines.append(create_polyline(*src_start, *dst_start, resolution))
-
-      if start_end_distance <= max_distance:
-        output_polylines.append(create_polyline(*src_start, *dst_end, resolution))
-
-      if end_start_distance <= max_distance:
-        output_polylines.append(create_polyline(*src_end, *dst_start, resolution))
-
-      if end_end_distance <= max_distance:
-        output_polylines.append(create_polyline(*src_end, *dst_end, resolution))
-
-  return output_polylines
-
-
-
-def png_to_svg(png_data: bytes) -> str:
-  """
-  Convert PNG image to SVG using OpenCV.
+  Convert PNG image to SVG using OpenCV, yielding the SVG in chunks.
 
   Args:
-  image_path (str): Path to inumpyut PNG image
-  output_path (str): Path to output SVG file
+  png_data (bytes): Input PNG image
+  tolerance (float): How far the polylines may be simplified, in pixels
   """
   # Read the image
   image = cv2.imdecode(
@@ -119,11 +65,6 @@ def png_to_svg(png_data: bytes) -> str:
     edges, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_TC89_L1
   )
 
-  # Create SVG file
-  width, height = image.shape[1], image.shape[0]
-  svg_style = " style=\"fill:none;stroke:black;stroke-width:1\""
-  svg_output = f'<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">\n'
-
   polylines = []
 
   for contour in contours:
@@ -132,27 +73,13 @@ def png_to_svg(png_data: bytes) -> str:
     approx_contour = cv2.approxPolyDP(contour, epsilon, True)
 
     # Close vertices
-    closed_contour = close_vertices(approx_contour[:, 0])
-
-    # Write polyline to SVG
-    polyline = []
-    for x, y in closed_contour:
-      polyline.append((x, y))
-    polylines.append(polyline)
-
-    # svg_output += '<polyline points="'
-    # for x, y in closed_contour:
-    #  svg_output += f"{x},{y} "
-    # svg_output += '" style="fill:none;stroke:black;stroke-width:1" />\n'
+    polylines.append(close_vertices(approx_contour[:, 0]))
 
   # Find polylines that have close ends
-  closed_polylines = find_close_ends(polylines, 5)
-  for polyline in closed_polylines:
-    svg_output += "  <polyline points=\""
-    for x,y in polyline:
-      svg_output += f"{x},{y} "
-    svg_output += f"\" {svg_style} />\n"
+  closed_polylines = simplify_polylines(find_close_ends(polylines, 5), tolerance)
+  width, height = image.shape[1], image.shape[0]
+  yield from iter_svg(closed_polylines, width, height)
 
-  svg_output += "</svg>\n"
 
-  return svg_output
+def png_to_svg(png_data: bytes) -> str:
+  return "".join(iter_png_to_svg(png_data))
@@ -1,11 +1,15 @@
-import asyncio
 import logging
 import random
 import string
+from typing import AsyncIterator
 
 import aiofiles
 import aiofiles.os
 
+from utils.simplify import Quality, get_quality
+from utils.svg_writer import read_chunks
+from utils.tools import run_tool
+
 LOG = logging.getLogger(__name__)
 
 def make_job_id() -> str:
@@ -13,47 +17,62 @@ def make_job_id() -> str:
   return "".join(random.choices(pool, k=16))
 
 
-async def png_to_svg(png_data: bytes) -> str:
+async def png_to_svg_file(
+  png_data: bytes, svg_path: str, *, quality: Quality = None, tolerance: float = 0
+) -> None:
+  """Trace a PNG with potrace, which writes the SVG straight to `svg_path`.
+
+  A binary PBM, like a packed channel mask, is passed to potrace as it is,
+  skipping ImageMagick. potrace simplifies its own curves, up to
+  `tolerance` pixels."""
   job_id = make_job_id()
+  quality = quality or get_quality()
 
   await aiofiles.os.makedirs("/tmp/extruder/", exist_ok=True)
 
-  async with aiofiles.open(f"/tmp/extruder/{job_id}.png", "wb") as f:
+  is_pbm = png_data.startswith(b"P4")
+  input_path = f"/tmp/extruder/{job_id}.{'pnm' if is_pbm else 'png'}"
+  async with aiofiles.open(input_path, "wb") as f:
     await f.write(png_data)
 
-  convert_proc = await asyncio.create_subprocess_shell(
-    f"convert /tmp/extruder/{job_id}.png /tmp/extruder/{job_id}.pnm",
-    stderr=asyncio.subprocess.PIPE,
-    stdout=asyncio.subprocess.PIPE,
-  )
-  convert_code = await convert_proc.wait()
-
-  if convert_code != 0:
-    LOG.error((await convert_proc.stdout.read()).decode())
-    LOG.error((await convert_proc.stderr.read()).decode())
-    raise RuntimeError("convert failure")
-
-  potrace_proc = await asyncio.create_subprocess_shell(
-    f"potrace /tmp/extruder/{job_id}.pnm -n -s -o /tmp/extruder/{job_id}.svg",
-    stderr=asyncio.subprocess.PIPE,
-    stdout=asyncio.subprocess.PIPE,
-  )
-
-  potrace_code = await potrace_proc.wait()
+  try:
+    if not is_pbm:
+      convert = await run_tool(
+        "convert", f"convert /tmp/extruder/{job_id}.png /tmp/extruder/{job_id}.pnm"
+      )
+      if not convert.ok:
+        convert.log_output()
+        raise RuntimeError("convert failure")
 
-  if potrace_code != 0:
-    print((await potrace_proc.stdout.read()).decode())
-    print((await potrace_proc.stderr.read()).decode())
-    raise RuntimeError("potrace failure")
+    potrace = await run_tool(
+      "potrace",
+      f"potrace /tmp/extruder/{job_id}.pnm {quality.potrace_args(tolerance)} -s -o {svg_path}",
+    )
+    if not potrace.ok:
+      potrace.log_output()
+      raise RuntimeError("potrace failure")
+  finally:
+    for path in (f"/tmp/extruder/{job_id}.png", f"/tmp/extruder/{job_id}.pnm"):
+      try:
+        await aiofiles.os.remove(path)
+      except Exception:
+        pass
 
-  async with aiofiles.open(f"/tmp/extruder/{job_id}.svg", "r") as f:
-    svg_contents = await f.read()
 
+async def iter_png_to_svg(png_data: bytes) -> AsyncIterator[bytes]:
+  "Trace a PNG, then stream the SVG from disk in chunks."
+  svg_path = f"/tmp/extruder/{make_job_id()}.svg"
   try:
-    await aiofiles.os.remove(f"/tmp/extruder/{job_id}.png")
-    await aiofiles.os.remove(f"/tmp/extruder/{job_id}.pnm")
-    await aiofiles.os.remove(f"/tmp/extruder/{job_id}.svg")
-  except Exception:
-    pass
+    await png_to_svg_file(png_data, svg_path)
+    async for chunk in read_chunks(svg_path):
+      yield chunk
+  finally:
+    try:
+      await aiofiles.os.remove(svg_path)
+    except Exception:
+      pass
 
-  return svg_contents
\ No newline at end of file
+
+async def png_to_svg(png_data: bytes) -> str:
+  chunks = [chunk async for chunk in iter_png_to_svg(png_data)]
+  return b"".join(chunks).decode()
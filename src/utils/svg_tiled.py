@@ -0,0 +1,255 @@
+# Trace the outline of every dark pixel region, tile by tile.
+#
+# The outlines follow the pixel edges ("crack edges"), walked with the dark
+# pixels on the left, so outer outlines and holes wind opposite ways and
+# every outline is closed. Each tile only walks the edges it owns, so tiles
+# can be traced in separate processes, and the chains that run off a tile
+# are joined back up where they meet at the seams.
+from __future__ import annotations
+
+import asyncio
+import io
+from typing import TYPE_CHECKING
+
+import numpy
+from PIL import Image
+
+from utils.simplify import simplify_polyline
+from utils.svg_writer import SVG_FOOTER, SVG_HEADER, format_points, iter_in_thread
+from utils.tools import get_executor, process_pool
+
+if TYPE_CHECKING:
+  from typing import AsyncIterator, Iterator
+
+  from utils.simplify import Quality
+
+# Pixels per side of a tile. Smaller tiles spread a channel over more
+# processes, but leave more chains to join at the seams.
+TILE_SIZE = 1024
+# Pixels darker than this are traced, the same as potrace's default
+THRESHOLD = 128
+
+# Edge directions, clockwise on screen where y points down
+EAST, SOUTH, WEST, NORTH = range(4)
+STEPS = numpy.array([(1, 0), (0, 1), (-1, 0), (0, -1)])
+
+PATH_START = '  <path fill-rule="evenodd" fill="black" d="'
+PATH_END = '" />\n'
+
+Chain = list[tuple[int, int]]
+
+
+def get_mask(png_data: bytes) -> numpy.ndarray:
+  "Threshold a PNG into a bool array of the pixels to trace, padded by one."
+  image = Image.open(io.BytesIO(png_data)).convert("RGBA")
+  background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+  grey = numpy.asarray(Image.alpha_composite(background, image).convert("L"))
+  # The padding means every outline is closed, even at the image edge.
+  return numpy.pad(grey < THRESHOLD, 1)
+
+
+def get_tiles(shape: tuple[int, int], size: int = TILE_SIZE) -> list[tuple[int, int, int, int]]:
+  """Split a padded mask into (top, left, bottom, right) tiles.
+
+  A tile owns the edges above and left of each of its pixels. Row and
+  column 0 are padding, so no edges sit above or left of them."""
+  rows, columns = shape
+  return [
+    (top, left, min(top + size, rows), min(left + size, columns))
+    for top in range(1, rows, size)
+    for left in range(1, columns, size)
+  ]
+
+
+def trace_tile(
+  tile: numpy.ndarray, top: int, left: int, bottom: int, right: int
+) -> tuple[list[Chain], list[Chain]]:
+  """Walk the edges a tile owns into chains of corner points.
+
+  `tile` is the padded mask from row top-1 to bottom+1 and column left-1
+  to right+1 (clipped to the mask), so every pixel around an owned edge is
+  there. Returns the closed outlines, and the open chains that leave the
+  tile, in padded mask coordinates."""
+  rows, columns = bottom - top, right - left
+  inside = tile[1:rows + 1, 1:columns + 1]
+
+  # Vertical edges sit left of a pixel, horizontal edges above it.
+  left_of = tile[1:rows + 1, :columns]
+  above = tile[:rows, 1:columns + 1]
+  y, x = numpy.mgrid[top:bottom, left:right]
+  edges = []
+  for mask, start_x, start_y, direction in [
+    (inside & ~left_of, x, y, SOUTH),
+    (left_of & ~inside, x, y + 1, NORTH),
+    (above & ~inside, x, y, EAST),
+    (inside & ~above, x + 1, y, WEST),
+  ]:
+    edges.append((start_x[mask], start_y[mask], numpy.full(mask.sum(), direction)))
+  start_x, start_y, direction = (numpy.concatenate(part) for part in zip(*edges))
+  if not len(direction):
+    return [], []
+  end_x = start_x + STEPS[direction, 0]
+  end_y = start_y + STEPS[direction, 1]
+
+  # Where two dark pixels only touch at a corner, two outlines meet at one
+  # point. Always turning right there keeps them apart.
+  local_x, local_y = end_x - left + 1, end_y - top + 1
+  height, width = tile.shape
+  valid = (local_x < width) & (local_y < height)
+  local_x, local_y = local_x.clip(max=width - 1), local_y.clip(max=height - 1)
+  top_left = tile[local_y - 1, local_x - 1]
+  top_right = tile[local_y - 1, local_x]
+  bottom_left = tile[local_y, local_x - 1]
+  bottom_right = tile[local_y, local_x]
+  saddle = valid & (top_left == bottom_right) & (top_right == bottom_left) & (top_left != top_right)
+
+  # Find each edge's successor by its start point, and its direction too
+  # at a saddle, where two edges start.
+  columns_total = int(max(end_x.max(), start_x.max())) + 2
+  start_key = (start_y * columns_total + start_x) * 4 + direction
+  order = numpy.argsort(start_key)
+  sorted_keys = start_key[order]
+  end_key = (end_y * columns_total + end_x) * 4
+  wanted = numpy.where(saddle, end_key + (direction + 1) % 4, end_key)
+  index = numpy.searchsorted(sorted_keys, wanted, side="left")
+  clipped = index.clip(max=len(sorted_keys) - 1)
+  match = sorted_keys[clipped]
+  # The successor may belong to another tile, then the chain is left open.
+  found = (index < len(sorted_keys)) & numpy.where(
+    saddle, match == wanted, match < end_key + 4
+  )
+  successor = numpy.where(found, order[clipped], -1)
+
+  has_predecessor = numpy.zeros(len(direction), dtype=bool)
+  has_predecessor[successor[successor >= 0]] = True
+
+  # Walk the chains, keeping only the points where the direction changes.
+  successor = successor.tolist()
+  direction = direction.tolist()
+  start_x, start_y = start_x.tolist(), start_y.tolist()
+  end_x, end_y = end_x.tolist(), end_y.tolist()
+  visited = [False] * len(direction)
+  closed: list[Chain] = []
+  open_chains: list[Chain] = []
+
+  for edge in numpy.flatnonzero(~has_predecessor).tolist():
+    chain = [(start_x[edge], start_y[edge])]
+    while True:
+      visited[edge] = True
+      following = successor[edge]
+      if following < 0:
+        chain.append((end_x[edge], end_y[edge]))
+        break
+      if direction[following] != direction[edge]:
+        chain.append((end_x[edge], end_y[edge]))
+      edge = following
+    open_chains.append(chain)
+
+  for first in range(len(direction)):
+    if visited[first]:
+      continue
+    chain = []
+    edge = first
+    while not visited[edge]:
+      visited[edge] = True
+      following = successor[edge]
+      if direction[following] != direction[edge]:
+        chain.append((end_x[edge], end_y[edge]))
+      edge = following
+    closed.append(chain)
+
+  return closed, open_chains
+
+
+def join_chains(open_chains: list[Chain]) -> list[Chain]:
+  "Join open chains from different tiles end to start into closed outlines."
+  starts: dict[tuple[int, int], list[int]] = {}
+  for index, chain in enumerate(open_chains):
+    starts.setdefault(chain[0], []).append(index)
+  used = [False] * len(open_chains)
+
+  closed: list[Chain] = []
+  for index, chain in enumerate(open_chains):
+    if used[index]:
+      continue
+    used[index] = True
+    starts[chain[0]].remove(index)
+    outline = list(chain)
+    while outline[-1] != outline[0]:
+      following = starts[outline[-1]].pop()
+      used[following] = True
+      outline.extend(open_chains[following][1:])
+    closed.append(outline[:-1])
+  return closed
+
+
+def iter_outlines_svg(
+  outlines: list[Chain], width: int, height: int, tolerance: float = 0
+) -> Iterator[str]:
+  """Yield an SVG with every outline as a subpath of a single evenodd path.
+
+  Outlines are simplified to `tolerance` pixels first, which mostly turns
+  the pixel steps along a slope into one straight line."""
+  yield SVG_HEADER.format(width=width, height=height)
+  # Leave the path out when there is nothing to trace, like potrace does.
+  if not outlines:
+    yield SVG_FOOTER
+    return
+  yield PATH_START
+  for start in range(0, len(outlines), 2000):
+    batch = outlines[start:start + 2000]
+    batch = [simplify_polyline(outline, tolerance, closed=True) for outline in batch]
+    counts = [len(outline) for outline in batch]
+    # The padding shifted everything one pixel down and right.
+    points = numpy.concatenate(batch) - 1
+    pairs = format_points(points)
+    subpaths = []
+    offset = 0
+    for count in counts:
+      subpaths.append(f"M{pairs[offset]} L{' '.join(pairs[offset + 1:offset + count])} Z")
+      offset += count
+    yield " ".join(subpaths) + " "
+  yield PATH_END
+  yield SVG_FOOTER
+
+
+async def trace_png(png_data: bytes) -> tuple[list[Chain], int, int]:
+  "Trace the tiles of a PNG in parallel processes, returning the outlines and size."
+  loop = asyncio.get_event_loop()
+  executor = get_executor()
+  mask = await loop.run_in_executor(executor, get_mask, png_data)
+  tiles = get_tiles(mask.shape)
+
+  results = await asyncio.gather(*(
+    loop.run_in_executor(
+      process_pool, trace_tile,
+      mask[top - 1:bottom + 1, left - 1:right + 1], top, left, bottom, right,
+    )
+    for top, left, bottom, right in tiles
+  ))
+  closed = [outline for tile_closed, _ in results for outline in tile_closed]
+  open_chains = [chain for _, tile_open in results for chain in tile_open]
+  del results
+
+  joined = await loop.run_in_executor(executor, join_chains, open_chains)
+  return closed + joined, mask.shape[1] - 2, mask.shape[0] - 2
+
+
+async def png_to_svg_file(
+  png_data: bytes, svg_path: str, *, quality: Quality = None, tolerance: float = 0
+) -> None:
+  "Trace the tiles of a PNG in parallel processes, and write the SVG."
+  outlines, width, height = await trace_png(png_data)
+
+  def write() -> None:
+    with open(svg_path, "w") as f:
+      for chunk in iter_outlines_svg(outlines, width, height, tolerance):
+        f.write(chunk)
+  await asyncio.get_event_loop().run_in_executor(get_executor(), write)
+
+
+async def iter_svg_chunks(png_data: bytes, tolerance: float = 0) -> AsyncIterator[bytes]:
+  "Trace the tiles of a PNG in parallel processes, and stream the SVG as it is formatted."
+  outlines, width, height = await trace_png(png_data)
+  async for chunk in iter_in_thread(iter_outlines_svg(outlines, width, height, tolerance)):
+    yield chunk
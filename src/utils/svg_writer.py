@@ -0,0 +1,99 @@
+# Serialize traced polylines into an SVG, in chunks
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+import aiofiles
+import numpy
+
+if TYPE_CHECKING:
+  from typing import AsyncIterator, Iterable, Iterator
+
+SVG_HEADER = '<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">\n'
+SVG_FOOTER = "</svg>\n"
+POLYLINE_STYLE = "fill:none;stroke:black;stroke-width:1"
+
+# Polylines formatted per chunk, bigger chunks are faster but stream later.
+CHUNK_POLYLINES = 2000
+# Bytes read per chunk when streaming an SVG file from disk
+CHUNK_BYTES = 64 * 1024
+
+
+def format_points(points: numpy.ndarray) -> list[str]:
+  "Format an (N, 2) point array as a list of 'x,y' strings, all at once."
+  points = numpy.asarray(points).reshape(-1, 2)
+  if not len(points):
+    return []
+  numbers = points.astype(str)
+  return numpy.char.add(numpy.char.add(numbers[:, 0], ","), numbers[:, 1]).tolist()
+
+
+def format_polylines(
+  polylines: list[numpy.ndarray], style: str = POLYLINE_STYLE
+) -> str:
+  "Format a batch of polylines as SVG <polyline> elements."
+  polylines = [numpy.asarray(polyline).reshape(-1, 2) for polyline in polylines]
+  counts = [len(polyline) for polyline in polylines]
+  if not sum(counts):
+    return ""
+  # Format integer and float polylines apart, so ints aren't written with a
+  # trailing ".0" just because they share a batch with a float polyline.
+  is_int = [polyline.dtype.kind in "iu" for polyline in polylines]
+  pairs = {
+    kind: format_points(numpy.concatenate(
+      [polyline for polyline, int_polyline in zip(polylines, is_int) if int_polyline == kind]
+      or [numpy.empty((0, 2))]
+    ))
+    for kind in (True, False)
+  }
+  starts = {True: 0, False: 0}
+  elements = []
+  for count, kind in zip(counts, is_int):
+    start = starts[kind]
+    points = " ".join(pairs[kind][start:start + count])
+    starts[kind] += count
+    elements.append(f'  <polyline points="{points}" style="{style}" />\n')
+  return "".join(elements)
+
+
+def iter_svg(
+  polylines: Iterable[numpy.ndarray],
+  width: int,
+  height: int,
+  *,
+  style: str = POLYLINE_STYLE,
+  chunk: int = CHUNK_POLYLINES,
+) -> Iterator[str]:
+  "Yield an SVG of polylines piece by piece, `chunk` polylines at a time."
+  yield SVG_HEADER.format(width=width, height=height)
+  batch = []
+  for polyline in polylines:
+    batch.append(polyline)
+    if len(batch) >= chunk:
+      yield format_polylines(batch, style)
+      batch = []
+  if batch:
+    yield format_polylines(batch, style)
+  yield SVG_FOOTER
+
+
+async def write_svg(chunks: Iterable[str], path: str) -> None:
+  "Write SVG chunks to a file as they are made."
+  async with aiofiles.open(path, "w") as f:
+    for chunk in chunks:
+      await f.write(chunk)
+
+
+async def read_chunks(path: str, size: int = CHUNK_BYTES) -> AsyncIterator[bytes]:
+  "Stream a file from disk in `size` byte chunks."
+  async with aiofiles.open(path, "rb") as f:
+    while chunk := await f.read(size):
+      yield chunk
+
+
+async def iter_in_thread(chunks: Iterator[str]) -> AsyncIterator[bytes]:
+  "Pull the chunks of a slow generator in a thread, passing each on as it comes."
+  loop = asyncio.get_event_loop()
+  while (chunk := await loop.run_in_executor(None, next, chunks, None)) is not None:
+    yield chunk.encode()
@@ -0,0 +1,195 @@
+# Run the external tools (ImageMagick, potrace, OpenSCAD, colorscad)
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import shlex
+import signal
+import subprocess
+import threading
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+
+from utils.metrics import SUBPROCESSES
+from utils.tracing import span
+
+if TYPE_CHECKING:
+  import resource
+  from typing import Callable
+
+LOG = logging.getLogger(__name__)
+
+# Each running tool holds one of these threads while it waits on the tool.
+tool_pool = concurrent.futures.ThreadPoolExecutor(
+  max_workers=32, thread_name_prefix="tool"
+)
+
+# CPU bound Python work (separating colours, tracing tiles) only runs in
+# parallel in its own processes. forkserver avoids forking the threads of
+# the running server.
+PROCESS_WORKERS = os.cpu_count() or 1
+process_pool = concurrent.futures.ProcessPoolExecutor(
+  PROCESS_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+)
+
+
+class ToolGroup:
+  """Tools and threads run for background work, which can be stopped at once.
+
+  While a group is current, see `tool_group`, tools run under `nice` in a
+  process group of their own, so `stop` kills them and anything they
+  started, and CPU bound Python work runs in the group's `executor`,
+  whose threads are niced too. Tools started after `stop` fail at once."""
+
+  nice: int
+  executor: concurrent.futures.ThreadPoolExecutor
+  stopped: bool
+  running: set[subprocess.Popen]
+
+  def __init__(self, executor: concurrent.futures.ThreadPoolExecutor, nice: int = 10) -> None:
+    self.executor = executor
+    self.nice = nice
+    self.stopped = False
+    self.running = set()
+    self.lock = threading.Lock()
+
+  def wrap(self, command: str) -> str:
+    "Run a shell command, and everything it starts, at the group's priority."
+    return f"nice -n {self.nice} sh -c {shlex.quote(command)}"
+
+  def add(self, proc: subprocess.Popen) -> None:
+    with self.lock:
+      self.running.add(proc)
+      stopped = self.stopped
+    if stopped:
+      self.kill(proc)
+
+  def discard(self, proc: subprocess.Popen) -> None:
+    with self.lock:
+      self.running.discard(proc)
+
+  def stop(self) -> None:
+    "Kill the running tools, and fail any started from now on."
+    with self.lock:
+      self.stopped = True
+      running = list(self.running)
+    for proc in running:
+      self.kill(proc)
+
+  @staticmethod
+  def kill(proc: subprocess.Popen) -> None:
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+
+  @staticmethod
+  def lower_priority(nice: int) -> None:
+    "Nice the calling thread, as an executor initializer. Linux nices per thread."
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+
+
+# The group the tools of the current task belong to, None for real jobs
+tool_group: ContextVar[ToolGroup | None] = ContextVar("tool_group", default=None)
+
+
+def get_executor() -> concurrent.futures.Executor | None:
+  "Get the executor for CPU bound work in threads, None being the loop's default."
+  group = tool_group.get()
+  return group.executor if group is not None else None
+
+
+class ToolResult:
+  tool: str
+  returncode: int
+  stdout: bytes
+  stderr: bytes
+
+  def __init__(
+    self, *, tool: str, returncode: int, stdout: bytes, stderr: bytes
+  ) -> None:
+    self.tool = tool
+    self.returncode = returncode
+    self.stdout = stdout
+    self.stderr = stderr
+
+  @property
+  def ok(self) -> bool:
+    return self.returncode == 0
+
+  def log_output(self, level: int = logging.ERROR) -> None:
+    "Log the output of the tool, used when it has failed."
+    if self.stdout:
+      LOG.log(level, self.stdout.decode(errors="replace"))
+    if self.stderr:
+      LOG.log(level, self.stderr.decode(errors="replace"))
+
+
+def _run_blocking(
+  command: str, on_line: Callable[[str], None] = None, group: ToolGroup = None
+) -> tuple[int, bytes, bytes, resource.struct_rusage]:
+  if group is not None:
+    command = group.wrap(command)
+  proc = subprocess.Popen(
+    command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    start_new_session=group is not None,
+  )
+  if group is not None:
+    group.add(proc)
+  stderr_chunks: list[bytes] = []
+  stderr_reader = threading.Thread(
+    target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True
+  )
+  stderr_reader.start()
+  if on_line is None:
+    stdout = proc.stdout.read()
+  else:
+    stdout = b""
+    for line in proc.stdout:
+      on_line(line.decode(errors="replace").strip())
+  stderr_reader.join()
+  proc.stdout.close()
+  proc.stderr.close()
+
+  # Reap it ourselves, as wait4 is the only way to get the rusage of just
+  # this child. With a shell, that includes the tool the shell ran.
+  _, status, rusage = os.wait4(proc.pid, 0)
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  if group is not None:
+    group.discard(proc)
+  return proc.returncode, stdout, b"".join(stderr_chunks), rusage
+
+
+async def run_tool(
+  tool: str, command: str, *, on_line: Callable[[str], None] = None
+) -> ToolResult:
+  """Run a shell command and collect its output.
+
+  If `on_line` is passed, it is called with each line of stdout as the tool
+  prints it (from another thread), instead of stdout being collected.
+
+  The run is recorded as a span with its CPU time and peak memory. Tools
+  of a stopped `tool_group` fail without running."""
+  group = tool_group.get()
+  if group is not None and group.stopped:
+    return ToolResult(tool=tool, returncode=-signal.SIGKILL, stdout=b"", stderr=b"stopped")
+  loop = asyncio.get_running_loop()
+  with span(f"tool:{tool}", tool=tool) as tool_span:
+    returncode, stdout, stderr, rusage = await loop.run_in_executor(
+      tool_pool, _run_blocking, command, on_line, group
+    )
+    tool_span.set(
+      exit_code=returncode,
+      user_cpu_s=round(rusage.ru_utime, 4),
+      system_cpu_s=round(rusage.ru_stime, 4),
+      # ru_maxrss is in kilobytes on Linux
+      peak_rss_kb=rusage.ru_maxrss,
+    )
+
+  SUBPROCESSES.inc(tool, str(returncode))
+  return ToolResult(
+    tool=tool, returncode=returncode, stdout=stdout, stderr=stderr
+  )
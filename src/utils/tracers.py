@@ -0,0 +1,187 @@
+# Registry of the engines that can trace a PNG into an SVG
+from __future__ import annotations
+
+import asyncio
+import tomllib
+from typing import TYPE_CHECKING
+
+import aiofiles
+import aiofiles.os
+
+from utils import svg, svg2, svg3, svg_tiled
+from utils.simplify import Quality
+from utils.svg3 import make_job_id
+from utils.svg_writer import iter_in_thread, read_chunks
+from utils.tools import get_executor
+
+if TYPE_CHECKING:
+  from typing import AsyncIterator, Awaitable, Callable, Iterator
+
+with open("config.toml") as f:
+  config = tomllib.loads(f.read())
+  DEFAULT_TRACER = config.get("trace", {}).get("default", "potrace")
+
+
+class Tracer:
+  """A way of tracing a PNG into an SVG.
+
+  `filled` tracers output closed, filled shapes, which is what OpenSCAD
+  needs to extrude. The others only output outlines as stroked polylines,
+  which are fine to look at or cut, but extrude into nothing.
+
+  `in_process` tracers run in Python without any external tools, and
+  `cost` roughly ranks them by how long they take, 1 being the fastest.
+
+  `to_file` takes the quality preset and a tolerance in pixels, how far
+  the outlines may be simplified. A tolerance of 0 keeps every vertex.
+  Tracers with `iter_chunks` can also stream the SVG as it is made, the
+  others are traced to disk first."""
+
+  name: str
+  description: str
+  filled: bool
+  in_process: bool
+  cost: int
+  to_file: Callable[..., Awaitable[None]]
+  iter_chunks: Callable[[bytes, float], AsyncIterator[bytes]] | None
+
+  def __init__(
+    self,
+    name: str,
+    description: str,
+    to_file: Callable[..., Awaitable[None]],
+    *,
+    filled: bool,
+    in_process: bool,
+    cost: int,
+    iter_chunks: Callable[[bytes, float], AsyncIterator[bytes]] = None,
+  ) -> None:
+    self.name = name
+    self.description = description
+    self.to_file = to_file
+    self.filled = filled
+    self.in_process = in_process
+    self.cost = cost
+    self.iter_chunks = iter_chunks
+
+  async def iter_svg(
+    self, png: bytes, *, quality: Quality = None, tolerance: float = 0
+  ) -> AsyncIterator[bytes]:
+    "Stream the SVG of a PNG in chunks, as it is made if the tracer can."
+    if self.iter_chunks is not None:
+      async for chunk in self.iter_chunks(png, tolerance):
+        yield chunk
+      return
+    await aiofiles.os.makedirs("/tmp/extruder/", exist_ok=True)
+    svg_path = f"/tmp/extruder/{make_job_id()}.svg"
+    try:
+      await self.to_file(png, svg_path, quality=quality, tolerance=tolerance)
+      async for chunk in read_chunks(svg_path):
+        yield chunk
+    finally:
+      try:
+        await aiofiles.os.remove(svg_path)
+      except Exception:
+        pass
+
+  async def trace(
+    self, png: bytes, *, quality: Quality = None, tolerance: float = 0
+  ) -> str:
+    chunks = [
+      chunk async for chunk in self.iter_svg(png, quality=quality, tolerance=tolerance)
+    ]
+    return b"".join(chunks).decode()
+
+  def to_dict(self) -> dict:
+    return {
+      "name": self.name,
+      "description": self.description,
+      "filled": self.filled,
+      "in_process": self.in_process,
+      "cost": self.cost,
+    }
+
+
+def in_process_to_file(
+  iter_png_to_svg: Callable[[bytes, float], Iterator[str]],
+) -> Callable[..., Awaitable[None]]:
+  "Run a Python tracer in a thread, writing its chunks to disk as they come."
+  def write(png: bytes, svg_path: str, tolerance: float) -> None:
+    with open(svg_path, "w") as f:
+      for chunk in iter_png_to_svg(png, tolerance):
+        f.write(chunk)
+
+  async def to_file(
+    png: bytes, svg_path: str, *, quality: Quality = None, tolerance: float = 0
+  ) -> None:
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(get_executor(), write, png, svg_path, tolerance)
+  return to_file
+
+
+def in_process_iter(
+  iter_png_to_svg: Callable[[bytes, float], Iterator[str]],
+) -> Callable[[bytes, float], AsyncIterator[bytes]]:
+  "Run a Python tracer in a thread, passing its chunks on as they come."
+  def iter_chunks(png: bytes, tolerance: float = 0) -> AsyncIterator[bytes]:
+    return iter_in_thread(iter_png_to_svg(png, tolerance))
+  return iter_chunks
+
+
+tracers: dict[str, Tracer] = {}
+
+
+def register(tracer: Tracer) -> Tracer:
+  tracers[tracer.name] = tracer
+  return tracer
+
+
+def get_tracer(name: str = None, *, filled: bool = False) -> Tracer:
+  """Get a tracer by name, or the server default.
+
+  Raises ValueError if there is no such tracer, or if `filled` is set and
+  the tracer can't make shapes to extrude."""
+  name = name or DEFAULT_TRACER
+  if name not in tracers:
+    raise ValueError(f"tracer must be one of {', '.join(tracers)}")
+  tracer = tracers[name]
+  if filled and not tracer.filled:
+    raise ValueError(f"tracer {name} only outlines, it can't be extruded")
+  return tracer
+
+
+register(Tracer(
+  "potrace",
+  "ImageMagick and potrace, smooth filled curves",
+  svg3.png_to_svg_file,
+  filled=True,
+  in_process=False,
+  cost=3,
+))
+register(Tracer(
+  "canny",
+  "OpenCV Canny edges, outlines only",
+  in_process_to_file(svg.iter_png_to_svg),
+  filled=False,
+  in_process=True,
+  cost=2,
+  iter_chunks=in_process_iter(svg.iter_png_to_svg),
+))
+register(Tracer(
+  "sobel",
+  "OpenCV Sobel edges, simplified outlines only",
+  in_process_to_file(svg2.iter_png_to_svg),
+  filled=False,
+  in_process=True,
+  cost=1,
+  iter_chunks=in_process_iter(svg2.iter_png_to_svg),
+))
+register(Tracer(
+  "tiled",
+  "Pixel-exact filled outlines, traced in tiles across processes",
+  svg_tiled.png_to_svg_file,
+  filled=True,
+  in_process=True,
+  cost=1,
+  iter_chunks=svg_tiled.iter_svg_chunks,
+))
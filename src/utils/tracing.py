@@ -0,0 +1,83 @@
+# Nested timing spans, recorded per job
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+
+from utils.metrics import STAGE_SECONDS
+
+if TYPE_CHECKING:
+  from typing import Any, Iterator
+
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+class Span:
+  name: str
+  attrs: dict[str, Any]
+  children: list[Span]
+  start: float
+  end: float | None
+
+  def __init__(self, name: str, attrs: dict[str, Any] = None) -> None:
+    self.name = name
+    self.attrs = attrs or {}
+    self.children = []
+    self.start = time.perf_counter()
+    self.end = None
+
+  @property
+  def duration(self) -> float:
+    "Seconds this span took, or has taken so far if it is still open."
+    end = self.end if self.end is not None else time.perf_counter()
+    return end - self.start
+
+  def set(self, **attrs: Any) -> None:
+    self.attrs.update(attrs)
+
+  def to_dict(self, origin: float = None) -> dict:
+    "Make a JSON-able dict, with times in milliseconds since `origin`."
+    if origin is None:
+      origin = self.start
+    return {
+      "name": self.name,
+      "start_ms": round((self.start - origin) * 1000, 3),
+      "duration_ms": round(self.duration * 1000, 3),
+      "attrs": self.attrs,
+      "children": [child.to_dict(origin) for child in self.children],
+    }
+
+
+@contextmanager
+def span(name: str, *, stage: str = None, **attrs: Any) -> Iterator[Span]:
+  """Time a block as a child of the current span.
+
+  Spans follow the async call stack, so anything awaited inside the block
+  nests under it. Passing `stage` also records the duration in the stage
+  histogram of the metrics endpoint."""
+  parent = current_span.get()
+  new = Span(name, attrs)
+  if stage is not None:
+    new.attrs["stage"] = stage
+  if parent is not None:
+    parent.children.append(new)
+  token = current_span.set(new)
+  try:
+    yield new
+  except BaseException as e:
+    new.attrs["error"] = repr(e)
+    raise
+  finally:
+    new.end = time.perf_counter()
+    current_span.reset(token)
+    if stage is not None:
+      STAGE_SECONDS.observe(stage, value=new.duration)
+
+
+def annotate(**attrs: Any) -> None:
+  "Add attributes to the current span, if there is one."
+  current = current_span.get()
+  if current is not None:
+    current.set(**attrs)